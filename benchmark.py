@@ -0,0 +1,155 @@
+## Import modules
+import argparse
+import gc
+import os
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+
+## Import other python files
+from util import import_hostnames
+from util import probe_result
+from util import resolve_hostname
+
+## Functions
+
+def make_fields(count):
+    """Make probe fields for count fake hosts, like check_matrix_server would find them
+
+    Every call makes new strings, so each way of storing results pays for the strings it keeps.
+    """
+
+    for i in range(count):
+        # About half of all hosts serve Matrix themselves, the rest delegate to another hostname
+        delegated_hostname = f'host{i}.example.org' if i % 2 else f'matrix.host{i}.example.org'
+        yield((f'host{i}.example.org', delegated_hostname, f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}',
+               int('8448'), ''.join('wellknown'), ''.join('Synapse'), f'1.{i % 120}.0', i % 10 != 0))
+
+
+def string_results(count):
+    """Build, deduplicate and parse results the way semicolon strings were handled"""
+
+    results = [f'{f[0]};{f[1]};{f[2]};{f[3]};{f[4]};{f[5]};{f[6]};{"yes" if f[7] else "no"}' for f in make_fields(count)]
+    results = import_hostnames.unique_list(results)
+    parsed = []
+    for result in results:
+        host_list = result.split(';')
+        host_list[3] = int(host_list[3])
+        parsed.append(host_list)
+    return(results)
+
+
+def record_results(count):
+    """Build, deduplicate and read results as ProbeResult records"""
+
+    results = [probe_result.ProbeResult.found(*f) for f in make_fields(count)]
+    results = import_hostnames.unique_list(results)
+    parsed = []
+    for result in results:
+        if result.ok:
+            parsed.append(list(result[:8]))
+    return(results)
+
+
+def traced_size(function, count):
+    """Measure the memory the results of a function hold on to
+
+    Returns:
+        Bytes per result.
+    """
+
+    gc.collect()
+    tracemalloc.start()
+    results = function(count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return(size / count)
+
+
+def measure(function, count, rounds):
+    """Time a function, and measure the memory the results it returns hold on to
+
+    Memory is measured in a fresh interpreter, so values the timed rounds left in caches, like interned ports, are
+    counted as well.
+
+    Returns:
+        A tuple of (best seconds per result, bytes per result).
+    """
+
+    best = None
+    for _ in range(rounds):
+        gc.collect()
+        started = time.perf_counter()
+        function(count)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+
+    work_dir = os.path.dirname(os.path.realpath(__file__))
+    code = f'import benchmark; print(benchmark.traced_size(benchmark.{function.__name__}, {count}))'
+    size = float(subprocess.run([sys.executable, '-c', code], cwd=work_dir, capture_output=True, check=True, text=True).stdout)
+    return((best / count, size))
+
+
+def benchmark_results(count, rounds):
+    print(f'Probe results, {count} results, best of {rounds}')
+    for label, function in (('string', string_results), ('record', record_results)):
+        seconds, size = measure(function, count, rounds)
+        print(f'{label:8} {seconds * 1e6:8.2f} us/result {size:8.1f} bytes/result')
+
+
+def benchmark_startup(modules, rounds):
+    """Time importing modules in fresh interpreters, the way every script starts"""
+
+    work_dir = os.path.dirname(os.path.realpath(__file__))
+    print(f'Startup, median of {rounds} fresh interpreters')
+    for module in modules:
+        code = f'import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)'
+        times = [float(subprocess.run([sys.executable, '-c', code], cwd=work_dir, capture_output=True, check=True, text=True).stdout)
+                 for _ in range(rounds)]
+        print(f'{module:28} {statistics.median(times) * 1000:8.1f} ms')
+
+
+def benchmark_calls(count):
+    """Time the setup every probe does before it sends a request"""
+
+    print(f'Per call overhead, {count} calls')
+    calls = (
+        ('random_headers', lambda: resolve_hostname.random_headers()),
+        ('is_ip_literal hostname', lambda: resolve_hostname.is_ip_literal('matrix.example.org')),
+        ('is_ip_literal IPv6', lambda: resolve_hostname.is_ip_literal('[2001:db8::1]')),
+        ('resolve_delegated IP', lambda: resolve_hostname.resolve_delegated_homeserver('192.0.2.1')),
+    )
+    for label, call in calls:
+        seconds = min(timeit.repeat(call, number=count, repeat=3))
+        print(f'{label:28} {seconds / count * 1e6:8.2f} us/call')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark parts of the scanner that run once per host')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('results', help='Semicolon strings against ProbeResult records')
+    command.add_argument('--count', type=int, default=100000, help='How many results to make. Default 100000')
+    command.add_argument('--rounds', type=int, default=5, help='How many times to run. Default 5')
+
+    command = commands.add_parser('startup', help='Time to import the scanner modules')
+    command.add_argument('--rounds', type=int, default=5, help='How many interpreters to start per module. Default 5')
+    command.add_argument('modules', nargs='*', default=['util.resolve_hostname', 'util.import_hostnames', 'util'],
+                         help='Modules to import. Default util.resolve_hostname, util.import_hostnames and util')
+
+    command = commands.add_parser('calls', help='Setup done by every probe before it sends a request')
+    command.add_argument('--count', type=int, default=10000, help='How many calls to time. Default 10000')
+
+    args = parser.parse_args()
+
+    if args.command == 'results':
+        benchmark_results(args.count, args.rounds)
+    elif args.command == 'startup':
+        benchmark_startup(args.modules, args.rounds)
+    elif args.command == 'calls':
+        benchmark_calls(args.count)
@@ -0,0 +1,269 @@
+## Import modules
+import configparser
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+## Import other python files
+from util import discovery
+from util import import_hostnames
+from util import probe_result
+from util import process_data
+from util import work_queue
+
+## Classes
+
+class CoordinatorHandler(http.server.BaseHTTPRequestHandler):
+    """Serve leased batches of work to scanner nodes and merge their results
+
+    Endpoints:
+        GET  /lease?queue=work_queue&node=name&limit=100  Lease a batch of hostnames
+        POST /results                                     Report results for a lease
+        GET  /status                                      Queue lengths
+    """
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            super().log_message(format, *args)
+
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def authorized(self):
+        if not self.server.token:
+            return(True)
+        if self.headers.get('Authorization') == f'Bearer {self.server.token}':
+            return(True)
+        self.send_json(401, {'error': 'Unauthorized'})
+        return(False)
+
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/status':
+            with self.server.db_lock:
+                status = {queue: work_queue.queue_length(self.server.db_file_path, queue) for queue in work_queue.QUEUES}
+            self.send_json(200, status)
+
+        elif url.path == '/lease':
+            queue = query.get('queue', ['work_queue'])[0]
+            node = query.get('node', ['node'])[0]
+            try:
+                limit = min(int(query.get('limit', ['100'])[0]), self.server.max_batch)
+            except ValueError:
+                self.send_json(400, {'error': 'limit must be an integer'})
+                return
+            if queue not in work_queue.QUEUES:
+                self.send_json(400, {'error': f'Unknown queue {queue}'})
+                return
+
+            with self.server.db_lock:
+                lease_id, hostnames, expires = work_queue.lease(self.server.db_file_path,
+                                                                limit,
+                                                                node,
+                                                                self.server.lease_duration,
+                                                                queue)
+                hosts = []
+                if queue == 'room_queue' and hostnames:
+                    hosts = process_data.get_delegated_hosts(self.server.db_file_path, hostnames)
+            self.send_json(200, {'lease_id': lease_id, 'hostnames': hostnames, 'hosts': hosts, 'expires': expires})
+
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+
+        if self.path != '/results':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length))
+            queue = data.get('queue', 'work_queue')
+            lease_id = data['lease_id']
+            succeeded = data.get('succeeded', {})
+            failed = data.get('failed', [])
+            if queue == 'work_queue':
+                succeeded = {hostname: probe_result.ProbeResult.from_json(result) for hostname, result in succeeded.items()}
+        except (ValueError, KeyError, AttributeError, TypeError):
+            self.send_json(400, {'error': 'Invalid results'})
+            return
+        if queue not in work_queue.QUEUES:
+            self.send_json(400, {'error': f'Unknown queue {queue}'})
+            return
+
+        with self.server.db_lock:
+            # Only accept results for hostnames the lease still holds. If the lease expired and the hostname
+            # was handed to another node, that node's results win
+            held = work_queue.leased_hostnames(self.server.db_file_path, lease_id, queue)
+            succeeded = {hostname: result for hostname, result in succeeded.items() if hostname in held}
+            failed = [hostname for hostname in failed if hostname in held]
+
+            if queue == 'work_queue' and succeeded:
+                process_data.write_delegated(self.server.db_file_path, import_hostnames.unique_list(succeeded.values()))
+            elif queue == 'room_queue' and succeeded:
+                process_data.write_node_rooms(self.server.db_file_path, succeeded)
+
+            if queue == 'work_queue':
+                rescan_interval = self.server.rescan_interval
+            else:
+                rescan_interval = self.server.rooms_interval
+            work_queue.reschedule(self.server.db_file_path,
+                                  succeeded.keys(),
+                                  failed,
+                                  rescan_interval,
+                                  self.server.retry_interval,
+                                  queue)
+
+        self.send_json(200, {'accepted': len(succeeded) + len(failed)})
+
+
+if __name__ == "__main__":
+    print('Setting up')
+    # Load config
+    work_dir = os.path.dirname(os.path.realpath(__file__)) # Get the path for the directory this python file is stored in
+    config = configparser.ConfigParser()
+    config.read(os.path.join(work_dir, 'config.ini'))
+
+    # Global
+    conf_global_data_directory = config.get('Global', 'data_directory')
+
+    # PostgreSQL
+    conf_psql_enabled = config.get('PostgreSQL', 'enabled')
+    if conf_psql_enabled not in ('Yes', 'No'):
+        print('Config error. PostgreSQL: enabled must be either Yes or No')
+        exit(1)
+    psql_settings = None
+    if conf_psql_enabled == 'Yes':
+        try:
+            conf_psql_port = int(config.get('PostgreSQL', 'port'))
+        except ValueError:
+            print('Config error. PostgreSQL: port must be an integer')
+            exit(1)
+        conf_psql_limit = config.get('PostgreSQL', 'limit')
+        if conf_psql_limit == 'None':
+            conf_psql_limit = None
+        else:
+            try:
+                conf_psql_limit = int(conf_psql_limit)
+            except ValueError:
+                print('Config error. PostgreSQL: limit must be an integer or None')
+                exit(1)
+        psql_settings = (config.get('PostgreSQL', 'server'),
+                         conf_psql_port,
+                         config.get('PostgreSQL', 'database'),
+                         config.get('PostgreSQL', 'username'),
+                         config.get('PostgreSQL', 'password'),
+                         conf_psql_limit)
+
+    # Files
+    conf_files_hs_filename = config.get('Files', 'hs_filename')
+    conf_files_shodan_filename = config.get('Files', 'shodan_filename')
+    conf_files_del_hs_data = config.get('Files', 'delegated_hs_data')
+
+    # Settings
+    conf_settings_parse_processes = config.get('Settings', 'parse_processes', fallback='None')
+    if conf_settings_parse_processes == 'None':
+        conf_settings_parse_processes = None
+    else:
+        try:
+            conf_settings_parse_processes = int(conf_settings_parse_processes)
+        except ValueError:
+            print('Config error. Settings: parse_processes must be an integer or None')
+            exit(1)
+    conf_settings_debug = config.get('Settings', 'debug')
+    if conf_settings_debug not in ('Yes', 'No'):
+        print('Config error. Settings: debug must be either Yes or No')
+        exit(1)
+
+    # Daemon
+    try:
+        conf_daemon_batch_size = int(config.get('Daemon', 'batch_size', fallback='1000'))
+        conf_daemon_rescan = float(config.get('Daemon', 'rescan_hours', fallback='24')) * 3600
+        conf_daemon_retry = float(config.get('Daemon', 'retry_hours', fallback='6')) * 3600
+        conf_daemon_feed = float(config.get('Daemon', 'feed_minutes', fallback='10')) * 60
+        conf_daemon_rooms = float(config.get('Daemon', 'rooms_hours', fallback='24')) * 3600
+    except ValueError:
+        print('Config error. Daemon: batch_size must be an integer, the rest must be numbers')
+        exit(1)
+
+    # Coordinator
+    conf_coordinator_address = config.get('Coordinator', 'listen_address', fallback='127.0.0.1')
+    conf_coordinator_token = config.get('Coordinator', 'token', fallback='')
+    try:
+        conf_coordinator_port = int(config.get('Coordinator', 'port', fallback='8470'))
+        conf_coordinator_lease = float(config.get('Coordinator', 'lease_minutes', fallback='15')) * 60
+    except ValueError:
+        print('Config error. Coordinator: port must be an integer, lease_minutes must be a number')
+        exit(1)
+
+    # Set paths
+    hostnames_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_hs_filename)
+    shodan_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_shodan_filename)
+    db_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_del_hs_data)
+
+    process_data.initialize_database(db_file_path)
+
+    # Start serving leases
+    server = http.server.ThreadingHTTPServer((conf_coordinator_address, conf_coordinator_port), CoordinatorHandler)
+    server.db_file_path = db_file_path
+    # Keeps the checks and writes of one lease or results request from interleaving with another's
+    server.db_lock = threading.Lock()
+    server.lease_duration = conf_coordinator_lease
+    server.max_batch = conf_daemon_batch_size
+    server.rescan_interval = conf_daemon_rescan
+    server.rooms_interval = conf_daemon_rooms
+    server.retry_interval = conf_daemon_retry
+    server.token = conf_coordinator_token
+    server.debug = conf_settings_debug == 'Yes'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f'Serving leases on {conf_coordinator_address}:{conf_coordinator_port}. Press Ctrl+C to stop')
+
+    # Keep feeding the queues. This runs without db_lock: reading the sources, building the Shodan cache and locating
+    # servers can take minutes, and every write it does is a short SQLite transaction of its own
+    seen_mtimes = {}
+    located_mtimes = {}
+    last_located = None
+    try:
+        while True:
+            work_queue.feed_queue(db_file_path,
+                                  hostnames_file_path,
+                                  shodan_file_path,
+                                  psql_settings,
+                                  conf_settings_parse_processes,
+                                  seen_mtimes)
+            work_queue.enqueue_known_hosts(db_file_path)
+            process_data.purge_db_duplicates(db_file_path)
+
+            # Locate every server when the export is new, otherwise only those that got new addresses
+            since = None if work_queue.file_changed(shodan_file_path, located_mtimes) else last_located
+            last_located = time.time()
+            process_data.write_locations(db_file_path, shodan_file_path, conf_settings_parse_processes, since)
+
+            # Probe servers that only turned up in rooms the nodes crawled
+            discovered = discovery.enqueue_discovered(db_file_path)
+            if discovered:
+                print(f'Queued {discovered} new hostnames from public rooms')
+            time.sleep(conf_daemon_feed)
+    except KeyboardInterrupt:
+        print('Stopping')
+        server.shutdown()
@@ -0,0 +1,167 @@
+## Import modules
+import configparser
+import gzip
+import hashlib
+import http.server
+import json
+import mimetypes
+import os
+import sqlite3
+import urllib.parse
+
+## Import other python files
+from util import database
+from util import map_data
+
+## Settings
+
+# Responses smaller than this many bytes are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+# Files under html/ the API serves, so the map can load its data from the same origin
+STATIC_FILES = ('index.html', 'screen.css', 'matrix_servers.js', 'dist/MarkerCluster.css',
+                'dist/MarkerCluster.Default.css', 'dist/leaflet.markercluster-src.js')
+
+## Classes
+
+class MapApiHandler(http.server.BaseHTTPRequestHandler):
+    """Serve map points, server details and statistics from the database, read only
+
+    Every response has an ETag. Requests with a matching If-None-Match get 304 without a body, and bodies are
+    gzipped for clients that accept it.
+
+    Endpoints:
+        GET /api/points                  All servers, with as_of to ask for changes since
+        GET /api/points?since=as_of      Servers added or changed, and hostnames removed, since as_of
+        GET /api/servers/<hostname>      Everything known about one server
+        GET /api/stats                   Host counts per dimension and servers with most rooms
+        GET /                            The map
+    """
+
+    def log_message(self, format, *args):
+        if self.server.debug:
+            super().log_message(format, *args)
+
+
+    def send_body(self, status, body, content_type, cache_control='no-cache'):
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if status == 200 and etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return
+
+        compress = len(body) >= GZIP_MIN_BYTES and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if compress:
+            body = gzip.compress(body, compresslevel=6)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_json(self, status, data):
+        body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+        self.send_body(status, body, 'application/json')
+
+
+    def send_static(self, path):
+        file_path = os.path.join(self.server.html_directory, path)
+        try:
+            with open(file_path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            self.send_json(404, {'error': 'Not found'})
+            return
+        content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        self.send_body(200, body, content_type)
+
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/api/points':
+            since = query.get('since', [None])[0]
+            if since is not None:
+                try:
+                    since = float(since)
+                except ValueError:
+                    self.send_json(400, {'error': 'since must be a number'})
+                    return
+            self.send_json(200, map_data.get_points(self.server.db_file_path, since))
+
+        elif url.path.startswith('/api/servers/'):
+            server = map_data.get_server(self.server.db_file_path, urllib.parse.unquote(url.path[len('/api/servers/'):]))
+            if server is None:
+                self.send_json(404, {'error': 'Unknown server'})
+            else:
+                self.send_json(200, server)
+
+        elif url.path == '/api/stats':
+            self.send_json(200, map_data.get_summary(self.server.db_file_path))
+
+        elif url.path in ('/', '/index.html'):
+            self.send_static('index.html')
+
+        elif url.path.lstrip('/') in STATIC_FILES:
+            self.send_static(url.path.lstrip('/'))
+
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+
+if __name__ == "__main__":
+    print('Setting up')
+    # Load config
+    work_dir = os.path.dirname(os.path.realpath(__file__)) # Get the path for the directory this python file is stored in
+    config = configparser.ConfigParser()
+    config.read(os.path.join(work_dir, 'config.ini'))
+
+    # Global
+    conf_global_data_directory = config.get('Global', 'data_directory')
+
+    # Files
+    conf_files_del_hs_data = config.get('Files', 'delegated_hs_data')
+
+    # Settings
+    conf_settings_debug = config.get('Settings', 'debug')
+    if conf_settings_debug not in ('Yes', 'No'):
+        print('Config error. Settings: debug must be either Yes or No')
+        exit(1)
+
+    # API
+    conf_api_address = config.get('API', 'listen_address', fallback='127.0.0.1')
+    try:
+        conf_api_port = int(config.get('API', 'port', fallback='8471'))
+    except ValueError:
+        print('Config error. API: port must be an integer')
+        exit(1)
+
+    # Set paths
+    db_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_del_hs_data)
+
+    # Never migrate or write the scanner's database, only check that it can be read
+    try:
+        database.connect_readonly(db_file_path)
+    except sqlite3.Error as error:
+        print(f'Can not read the database {db_file_path}: {error}')
+        exit(1)
+
+    server = http.server.ThreadingHTTPServer((conf_api_address, conf_api_port), MapApiHandler)
+    server.db_file_path = db_file_path
+    server.html_directory = os.path.join(work_dir, 'html')
+    server.debug = conf_settings_debug == 'Yes'
+    print(f'Serving the map on http://{conf_api_address}:{conf_api_port}/. Press Ctrl+C to stop')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping')
@@ -1,32 +1,49 @@
 ## Import modules
-import asyncio
 import configparser
 import os
-import random
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 ## Import other python files
+from util import discovery
 from util import import_hostnames
+from util import probe_result
 from util import process_data
 from util import resolve_hostname
+from util import staging
+from util import tracing
 
 ## Functions
 
-async def get_data_asynchronous(workers, delegated_details):
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        # Set any session parameters here before calling check_matrix_server
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(
-                executor,
-                resolve_hostname.check_matrix_server,
-                hostname # Allows us to pass in multiple arguments
-            )
-            for hostname in hostnames
-        ]
-        for response in await asyncio.gather(*tasks):
-            if response:
-                delegated_details.append(response)
+def probe_stream(executor, hostnames, in_flight):
+    """Probe hostnames, keeping at most in_flight probes queued or running
+
+    Args:
+        executor: ThreadPoolExecutor to probe with.
+        hostnames: Iterable of hostnames. Read as probes finish, not all at once.
+        in_flight: Maximum number of probes submitted and not yet finished.
+
+    Yields:
+        A ProbeResult per hostname, in the order the probes finish.
+    """
+
+    hostnames = iter(hostnames)
+    pending = {}
+    while True:
+        for hostname in hostnames:
+            pending[executor.submit(resolve_hostname.check_matrix_server, hostname)] = hostname
+            if len(pending) >= in_flight:
+                break
+        if not pending:
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            hostname = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as error:
+                print(f'Probing {hostname} failed: {error!r}')
+                result = probe_result.ProbeResult.failure(hostname, probe_result.ProbeError.UNEXPECTED)
+            yield(result)
 
 
 if __name__ == "__main__":
@@ -77,6 +94,20 @@ if __name__ == "__main__":
     except ValueError:
         print('Config error. Settings: hs_workers must be an integer')
         exit(1)
+    try:
+        conf_settings_batch_size = int(config.get('Settings', 'batch_size', fallback='1000'))
+    except ValueError:
+        print('Config error. Settings: batch_size must be an integer')
+        exit(1)
+    conf_settings_parse_processes = config.get('Settings', 'parse_processes', fallback='None')
+    if conf_settings_parse_processes == 'None':
+        conf_settings_parse_processes = None
+    else:
+        try:
+            conf_settings_parse_processes = int(conf_settings_parse_processes)
+        except ValueError:
+            print('Config error. Settings: parse_processes must be an integer or None')
+            exit(1)
     conf_settings_debug = config.get('Settings', 'debug')
     if conf_settings_debug == 'Yes':
         debug = True
@@ -85,78 +116,117 @@ if __name__ == "__main__":
     else:
         print('Config error. Settings: debug must be either Yes or No')
         exit(1)
-    
+
+    # Timeouts
+    try:
+        conf_timeouts_percentile = int(config.get('Timeouts', 'percentile', fallback='99'))
+        conf_timeouts_factor = float(config.get('Timeouts', 'factor', fallback='2'))
+        conf_timeouts_minimum = float(config.get('Timeouts', 'minimum', fallback='0.5'))
+        conf_timeouts_maximum = float(config.get('Timeouts', 'maximum', fallback='10'))
+    except ValueError:
+        print('Config error. Timeouts: percentile must be an integer, factor, minimum and maximum must be numbers')
+        exit(1)
+    conf_timeouts_hedge = config.get('Timeouts', 'hedge_percentile', fallback='None')
+    if conf_timeouts_hedge == 'None':
+        conf_timeouts_hedge = None
+    else:
+        try:
+            conf_timeouts_hedge = int(conf_timeouts_hedge)
+        except ValueError:
+            print('Config error. Timeouts: hedge_percentile must be an integer or None')
+            exit(1)
+    resolve_hostname.configure_timeouts(conf_timeouts_percentile,
+                                        conf_timeouts_factor,
+                                        conf_timeouts_minimum,
+                                        conf_timeouts_maximum,
+                                        conf_timeouts_hedge,
+                                        conf_settings_workers)
+
+    # Tracing
+    conf_tracing_trace_file = config.get('Tracing', 'trace_file', fallback='None')
+    conf_tracing_profile_file = config.get('Tracing', 'profile_file', fallback='None')
+    try:
+        conf_tracing_profile_interval = float(config.get('Tracing', 'profile_interval_ms', fallback='5')) / 1000
+    except ValueError:
+        print('Config error. Tracing: profile_interval_ms must be a number')
+        exit(1)
 
 
     # Set paths
     hostnames_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_hs_filename)
     shodan_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_shodan_filename)
     db_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_del_hs_data)
-    
-    # Load hostnames
-    print('Loading hostnames')
-    hostnames = []
-    hostnames_from_file = import_hostnames.load_hostnames_file(hostnames_file_path)
-    hostnames_from_shodan = import_hostnames.load_shodan_file(shodan_file_path)
-    hostnames_from_postgres = False
-    if try_sql:
-        hostnames_from_postgres = import_hostnames.get_hostnames_from_postgres(conf_psql_server,
-                                                                                conf_psql_port,
-                                                                                conf_psql_database,
-                                                                                conf_psql_username,
-                                                                                conf_psql_password,
-                                                                                conf_psql_limit)
-    if hostnames_from_file:
-        hostnames.extend(hostnames_from_file)
-    if hostnames_from_shodan:
-        hostnames.extend(hostnames_from_shodan)
-    if hostnames_from_postgres:
-        hostnames.extend(hostnames_from_postgres)
-    
-    # Quit if no hostnames found
-    if len(hostnames) < 1:
-        print('No hostnames found, quitting')
-        exit(1)
 
-    # Split into workers
-    # line_index = int(sys.argv[1])
-    # processes = int(sys.argv[2])
-    # line_count = file_len(hostnames_file))
-    # index = int(line_count / processes)
-
-    # Split the list of hostnames into multiple sets
-    # if line_index > processes - 2:
-    #     hostnames = hostnames[line_index * index :]
-    # else:
-    #     hostnames = hostnames[line_index * index : (line_index + 1) * index]
-
-    # Uniq and randomize the order of the hostname list
-    hostnames = import_hostnames.unique_list(hostnames)
-    random.shuffle(hostnames)
-
-    # for x in hostnames:
-    #     print(x)
-    # print(len(hostnames))
-    # exit(0)
-
-    # Print headers for debug
-    if debug:
-        print('Hostname;Delegated hostname;Delegated IP;Delegated port;Server lookup type;Name;Matrix server version;Valid SSL')
-
-    # Run async stuff
-    print(f'Found {len(hostnames)} unique hostnames. Validating hostnames. This may take a long time')
-    delegated_details = []
-    loop = asyncio.get_event_loop()
-    future = asyncio.ensure_future(get_data_asynchronous(conf_settings_workers, delegated_details))
-    loop.run_until_complete(future)
-
-    # Check again for and remove duplicates
-    delegated_details = import_hostnames.unique_list(delegated_details)
-
-    # Save to database
-    print('Inserting data into SQLite3 database')
-    process_data.write_delegated(db_file_path, delegated_details)
-
-    # Clean up duplicates
-    print('Cleaning up duplicates')
-    process_data.purge_db_duplicates(db_file_path)
+    # Trace probes and profile the run, if enabled
+    if conf_tracing_trace_file != 'None':
+        tracing.enable(os.path.join(work_dir, conf_global_data_directory, conf_tracing_trace_file))
+    profiler = None
+    if conf_tracing_profile_file != 'None':
+        profiler = tracing.SamplingProfiler(os.path.join(work_dir, conf_global_data_directory, conf_tracing_profile_file),
+                                            conf_tracing_profile_interval)
+        profiler.start()
+
+    # The profile is written however the run ends, also when it quits early or fails
+    try:
+        # Load hostnames. They are normalized, deduplicated and shuffled on disk, so memory use does not grow with the number of hostnames
+        print('Loading hostnames')
+        with staging.HostnameStaging(os.path.join(work_dir, conf_global_data_directory)) as hostnames:
+            hostnames.add(import_hostnames.iter_hostnames_file(hostnames_file_path))
+            hostnames.add(import_hostnames.iter_shodan_file(shodan_file_path, conf_settings_parse_processes))
+            if try_sql:
+                try:
+                    for batch in import_hostnames.iter_hostnames_from_postgres(conf_psql_server,
+                                                                               conf_psql_port,
+                                                                               conf_psql_database,
+                                                                               conf_psql_username,
+                                                                               conf_psql_password,
+                                                                               conf_psql_limit):
+                        hostnames.add(batch)
+                except Exception as error:
+                    import_hostnames.postgres_error(error)
+            if os.path.isfile(db_file_path):
+                hostnames_from_rooms = 0
+                for batch in discovery.discover_hostnames(db_file_path):
+                    hostnames_from_rooms += len(batch)
+                    hostnames.add(batch)
+                if hostnames_from_rooms:
+                    print(f'Found {hostnames_from_rooms} hostnames in public rooms that were never probed')
+
+            # Quit if no hostnames found
+            total = len(hostnames)
+            if total < 1:
+                print('No hostnames found, quitting')
+                exit(1)
+            print(f'Normalizing hostnames removed {hostnames.probes_saved()} duplicate or invalid hostnames')
+
+            # Print headers for debug
+            if debug:
+                print('Hostname;Delegated hostname;Delegated IP;Delegated port;Server lookup type;Name;Matrix server version;Valid SSL')
+
+            # Probe in random order, keeping a bounded number of probes in flight and saving results as they come in
+            print(f'Found {total} unique hostnames. Validating hostnames. This may take a long time')
+            found = 0
+            delegated_details = []
+            with ThreadPoolExecutor(max_workers=conf_settings_workers) as executor:
+                stream = (hostname for batch in hostnames.batches(conf_settings_batch_size) for hostname in batch)
+                for result in probe_stream(executor, stream, conf_settings_workers * 2):
+                    if result.ok:
+                        delegated_details.append(result)
+                    if len(delegated_details) >= conf_settings_batch_size:
+                        process_data.write_delegated(db_file_path, delegated_details)
+                        found += len(delegated_details)
+                        delegated_details = []
+            process_data.write_delegated(db_file_path, delegated_details)
+            found += len(delegated_details)
+            print(f'Found {found} Matrix servers')
+
+        # Clean up duplicates
+        print('Cleaning up duplicates')
+        process_data.purge_db_duplicates(db_file_path)
+
+        # Put servers on the map
+        print(f'Updated the location of {process_data.write_locations(db_file_path, shodan_file_path, conf_settings_parse_processes)} servers')
+    finally:
+        if profiler:
+            profiler.stop()
+            print(f'Wrote profile to {profiler.path}')
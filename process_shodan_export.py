@@ -1,6 +1,5 @@
 ## Import modules
 import configparser
-import json
 import os
 import random
 import re
@@ -17,53 +16,51 @@ except ImportError:
 
 
 ## Import other python files
-from util import import_hostnames
+from util import shodan_cache
 
 
 ## Functions
 
-def detect_matrix(line):
+def detect_matrix(record):
     """Determing if Matrix server
 
     Try and determine if a Matrix server is running on this IP.
 
     Args:
-        line: A text string.
+        record: A tuple of (ip, latitude, longitude) from the Shodan cache.
 
     Returns:
-        json response
+        A tuple of (latitude, longitude, ip) if a Synapse or Dendrite server answered, otherwise None.
     """
 
-    data = json.loads(line)
-    if data['transport'] == 'tcp':
-        longitude = data['location']['longitude']
-        latitude = data['location']['latitude']
-        ip = data['ip_str']
-        ip_https = 'https://' + str(ip) + ':8448/_matrix/federation/v1/version'
-
-        if latitude and longitude:
-            latitude = round(latitude, 4)
-            longitude = round(longitude, 4)
-
-            try:
-                # curl
-                # -k, --insecure
-                #       (TLS) By default, every SSL connection curl makes is verified to be secure. This option allows curl to proceed
-                #       and operate even for server connections otherwise considered insecure.
-                # -s, --silent
-                #       Silent  or  quiet mode. Don't show progress meter or error messages.  Makes Curl mute. It will still output the
-                #       data you ask for, potentially even to the terminal/stdout unless you redirect it.
-                # -m, --max-time 3
-                #       Maximum  time  in  seconds that you allow the whole operation to take.  This is useful for preventing your
-                #       batch jobs from hanging for hours due to slow networks or links going down.
-                # --tlsv1.1
-                #       (TLS) Forces curl to use TLS version 1.1 or later when connecting to a remote TLS server.
-                output = subprocess.check_output(['curl', '-k', '-s', '-m', '3', '--tlsv1.1', ip_https])
-            except subprocess.CalledProcessError:
-                pass
-            else:
-                if 'Synapse' in str(output) or 'Dendrite' in str(output):
-                    return (latitude, longitude, ip)
+    ip, latitude, longitude = record
+
+    # Without a location there is nothing to put on the map
+    if latitude is None or longitude is None:
+        return(None)
+    latitude = round(latitude, 4)
+    longitude = round(longitude, 4)
+    ip_https = 'https://' + str(ip) + ':8448/_matrix/federation/v1/version'
+
+    try:
+        # curl
+        # -k, --insecure
+        #       (TLS) By default, every SSL connection curl makes is verified to be secure. This option allows curl to proceed
+        #       and operate even for server connections otherwise considered insecure.
+        # -s, --silent
+        #       Silent  or  quiet mode. Don't show progress meter or error messages.  Makes Curl mute. It will still output the
+        #       data you ask for, potentially even to the terminal/stdout unless you redirect it.
+        # -m, --max-time 3
+        #       Maximum  time  in  seconds that you allow the whole operation to take.  This is useful for preventing your
+        #       batch jobs from hanging for hours due to slow networks or links going down.
+        # --tlsv1.1
+        #       (TLS) Forces curl to use TLS version 1.1 or later when connecting to a remote TLS server.
+        output = subprocess.check_output(['curl', '-k', '-s', '-m', '3', '--tlsv1.1', ip_https])
+    except subprocess.CalledProcessError:
+        pass
+    else:
+        if 'Synapse' in str(output) or 'Dendrite' in str(output):
+            return (latitude, longitude, ip)
 
 
 async def get_data_asynchronous(workers):
@@ -74,9 +71,9 @@ async def get_data_asynchronous(workers):
             loop.run_in_executor(
                 executor,
                 detect_matrix,
-                line, # Allows us to pass in multiple arguments
+                record, # Allows us to pass in multiple arguments
             )
-            for line in lines
+            for record in records
         ]
         for response in await asyncio.gather(*tasks):
             if response:
@@ -96,31 +93,42 @@ if __name__ == "__main__":
     except ValueError:
         print('Config error. Shodan: workers must be an integer')
         exit(1)
+    conf_settings_parse_processes = config.get('Settings', 'parse_processes', fallback='None')
+    if conf_settings_parse_processes == 'None':
+        conf_settings_parse_processes = None
+    else:
+        try:
+            conf_settings_parse_processes = int(conf_settings_parse_processes)
+        except ValueError:
+            print('Config error. Settings: parse_processes must be an integer or None')
+            exit(1)
 
     # Paths
     shodan_export_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_shodan_filename)
 
-    # Split into workers
+    # Split into workers, each checking an equal share of the export. Default one worker for everything
     try:
-        line_index = int(sys.argv[1])
-    except IndexError:  
-        print(f'A worker index must be supplied when running this script. For example "python3 {os.path.basename(__file__)} 1"')
+        worker_index, worker_count = (int(arg) for arg in sys.argv[1:3]) if len(sys.argv) > 1 else (0, 1)
+    except ValueError:
+        print(f'A worker index and worker count must be supplied together. For example "python3 {os.path.basename(__file__)} 1 8"')
+        exit(1)
+    if not 0 <= worker_index < worker_count:
+        print('The worker index must be at least 0 and less than the worker count')
         exit(1)
 
-    # Load Shodan export json
-    lines = import_hostnames.load_shodan_file(shodan_export_file_path)
+    # Load Shodan export, through the compact cache
+    cache = shodan_cache.open_cache(shodan_export_file_path, processes=conf_settings_parse_processes)
 
     # Quit if the file set in shodan_export_file_path could not be found
-    if not lines:
+    if cache is None:
         print('Shodan file does not exist')
         exit(1)
 
-    if line_index > 6:
-        lines = lines[line_index * 3500 :]
-    else:
-        lines = lines[line_index * 3500 : (line_index + 1) * 3500]
+    records = [cache.record(index) for index in range(
+        len(cache) * worker_index // worker_count, len(cache) * (worker_index + 1) // worker_count)]
+    cache.close()
 
-    random.shuffle(lines) # Randomize the list
+    random.shuffle(records) # Randomize the list
 
     # Process
     loop = asyncio.get_event_loop()
@@ -0,0 +1,234 @@
+## Import modules
+import configparser
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+## Import other python files
+from util import discovery
+from util import import_hostnames
+from util import process_data
+from util import resolve_hostname
+from util import tracing
+from util import work_queue
+
+## Functions
+
+def scan_batch(executor, db_file_path, hostnames, rescan_interval, retry_interval):
+    """Probe a batch of hostnames, save the results and reschedule them
+
+    Args:
+        executor: ThreadPoolExecutor to probe with. Kept across batches so connections and caches stay warm.
+        db_file_path: Full path to SQLite3 database file.
+        hostnames: List of hostnames.
+        rescan_interval: Seconds until a live server is scanned again.
+        retry_interval: Seconds added to the wait for every failed attempt in a row.
+
+    Returns:
+        How many hostnames answered.
+    """
+
+    succeeded = []
+    failed = []
+    delegated_details = []
+    futures = [executor.submit(resolve_hostname.check_matrix_server, hostname) for hostname in hostnames]
+    for hostname, future in zip(hostnames, futures):
+        try:
+            result = future.result()
+        except Exception as error:
+            print(f'Probing {hostname} failed: {error!r}')
+            failed.append(hostname)
+            continue
+        if result.ok:
+            succeeded.append(hostname)
+            delegated_details.append(result)
+        else:
+            failed.append(hostname)
+
+    if delegated_details:
+        process_data.write_delegated(db_file_path, import_hostnames.unique_list(delegated_details))
+    work_queue.reschedule(db_file_path, succeeded, failed, rescan_interval, retry_interval)
+    return(len(succeeded))
+
+
+if __name__ == "__main__":
+    print('Setting up')
+    # Load config
+    work_dir = os.path.dirname(os.path.realpath(__file__)) # Get the path for the directory this python file is stored in
+    config = configparser.ConfigParser()
+    config.read(os.path.join(work_dir, 'config.ini'))
+
+    # Global
+    conf_global_data_directory = config.get('Global', 'data_directory')
+
+    # PostgreSQL
+    conf_psql_enabled = config.get('PostgreSQL', 'enabled')
+    if conf_psql_enabled not in ('Yes', 'No'):
+        print('Config error. PostgreSQL: enabled must be either Yes or No')
+        exit(1)
+    psql_settings = None
+    if conf_psql_enabled == 'Yes':
+        try:
+            conf_psql_port = int(config.get('PostgreSQL', 'port'))
+        except ValueError:
+            print('Config error. PostgreSQL: port must be an integer')
+            exit(1)
+        conf_psql_limit = config.get('PostgreSQL', 'limit')
+        if conf_psql_limit == 'None':
+            conf_psql_limit = None
+        else:
+            try:
+                conf_psql_limit = int(conf_psql_limit)
+            except ValueError:
+                print('Config error. PostgreSQL: limit must be an integer or None')
+                exit(1)
+        psql_settings = (config.get('PostgreSQL', 'server'),
+                         conf_psql_port,
+                         config.get('PostgreSQL', 'database'),
+                         config.get('PostgreSQL', 'username'),
+                         config.get('PostgreSQL', 'password'),
+                         conf_psql_limit)
+
+    # Files
+    conf_files_hs_filename = config.get('Files', 'hs_filename')
+    conf_files_shodan_filename = config.get('Files', 'shodan_filename')
+    conf_files_del_hs_data = config.get('Files', 'delegated_hs_data')
+
+    # Settings
+    try:
+        conf_settings_workers = int(config.get('Settings', 'hs_workers'))
+    except ValueError:
+        print('Config error. Settings: hs_workers must be an integer')
+        exit(1)
+    conf_settings_parse_processes = config.get('Settings', 'parse_processes', fallback='None')
+    if conf_settings_parse_processes == 'None':
+        conf_settings_parse_processes = None
+    else:
+        try:
+            conf_settings_parse_processes = int(conf_settings_parse_processes)
+        except ValueError:
+            print('Config error. Settings: parse_processes must be an integer or None')
+            exit(1)
+
+    # Timeouts
+    try:
+        conf_timeouts_percentile = int(config.get('Timeouts', 'percentile', fallback='99'))
+        conf_timeouts_factor = float(config.get('Timeouts', 'factor', fallback='2'))
+        conf_timeouts_minimum = float(config.get('Timeouts', 'minimum', fallback='0.5'))
+        conf_timeouts_maximum = float(config.get('Timeouts', 'maximum', fallback='10'))
+    except ValueError:
+        print('Config error. Timeouts: percentile must be an integer, factor, minimum and maximum must be numbers')
+        exit(1)
+    conf_timeouts_hedge = config.get('Timeouts', 'hedge_percentile', fallback='None')
+    if conf_timeouts_hedge == 'None':
+        conf_timeouts_hedge = None
+    else:
+        try:
+            conf_timeouts_hedge = int(conf_timeouts_hedge)
+        except ValueError:
+            print('Config error. Timeouts: hedge_percentile must be an integer or None')
+            exit(1)
+    resolve_hostname.configure_timeouts(conf_timeouts_percentile,
+                                        conf_timeouts_factor,
+                                        conf_timeouts_minimum,
+                                        conf_timeouts_maximum,
+                                        conf_timeouts_hedge,
+                                        conf_settings_workers)
+
+    # Daemon
+    try:
+        conf_daemon_batch_size = int(config.get('Daemon', 'batch_size', fallback='1000'))
+        conf_daemon_rescan = float(config.get('Daemon', 'rescan_hours', fallback='24')) * 3600
+        conf_daemon_retry = float(config.get('Daemon', 'retry_hours', fallback='6')) * 3600
+        conf_daemon_feed = float(config.get('Daemon', 'feed_minutes', fallback='10')) * 60
+        conf_daemon_idle = float(config.get('Daemon', 'idle_seconds', fallback='30'))
+        conf_daemon_cache = int(config.get('Daemon', 'cache_seconds', fallback='3600'))
+    except ValueError:
+        print('Config error. Daemon: batch_size and cache_seconds must be integers, the rest must be numbers')
+        exit(1)
+    conf_daemon_rooms = config.get('Daemon', 'rooms_hours', fallback='None')
+    if conf_daemon_rooms == 'None':
+        conf_daemon_rooms = None
+    else:
+        try:
+            conf_daemon_rooms = float(conf_daemon_rooms) * 3600
+        except ValueError:
+            print('Config error. Daemon: rooms_hours must be a number or None')
+            exit(1)
+    resolve_hostname.configure_cache(conf_daemon_cache)
+
+    # Tracing
+    conf_tracing_trace_file = config.get('Tracing', 'trace_file', fallback='None')
+    conf_tracing_profile_file = config.get('Tracing', 'profile_file', fallback='None')
+    try:
+        conf_tracing_profile_interval = float(config.get('Tracing', 'profile_interval_ms', fallback='5')) / 1000
+    except ValueError:
+        print('Config error. Tracing: profile_interval_ms must be a number')
+        exit(1)
+
+    # Set paths
+    hostnames_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_hs_filename)
+    shodan_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_shodan_filename)
+    db_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_del_hs_data)
+
+    process_data.initialize_database(db_file_path)
+
+    # Trace probes and profile the run, if enabled
+    if conf_tracing_trace_file != 'None':
+        tracing.enable(os.path.join(work_dir, conf_global_data_directory, conf_tracing_trace_file))
+    profiler = None
+    if conf_tracing_profile_file != 'None':
+        profiler = tracing.SamplingProfiler(os.path.join(work_dir, conf_global_data_directory, conf_tracing_profile_file),
+                                            conf_tracing_profile_interval)
+        profiler.start()
+
+    # Keep one pool of workers for the lifetime of the daemon, so per-thread sessions and caches stay warm
+    seen_mtimes = {}
+    located_mtimes = {}
+    last_located = None
+    last_feed = 0
+    last_rooms = time.time()
+    print('Scanning. Press Ctrl+C to stop')
+    try:
+        with ThreadPoolExecutor(max_workers=conf_settings_workers) as executor:
+            while True:
+                if time.time() - last_feed >= conf_daemon_feed:
+                    work_queue.feed_queue(db_file_path,
+                                          hostnames_file_path,
+                                          shodan_file_path,
+                                          psql_settings,
+                                          conf_settings_parse_processes,
+                                          seen_mtimes)
+                    process_data.purge_db_duplicates(db_file_path)
+
+                    # Locate every server when the export is new, otherwise only those that got new addresses
+                    since = None if work_queue.file_changed(shodan_file_path, located_mtimes) else last_located
+                    last_located = time.time()
+                    process_data.write_locations(db_file_path, shodan_file_path, conf_settings_parse_processes, since)
+                    last_feed = time.time()
+
+                if conf_daemon_rooms and time.time() - last_rooms >= conf_daemon_rooms:
+                    print('Crawling public rooms')
+                    changed, unchanged, failed = process_data.get_public_rooms(db_file_path)
+                    print(f'Room directories: {changed} changed, {unchanged} unchanged, {failed} failed')
+                    last_rooms = time.time()
+
+                    # Probe servers that only turned up in room aliases and IDs
+                    print(f'Queued {discovery.enqueue_discovered(db_file_path)} new hostnames from public rooms')
+
+                hostnames = work_queue.take_due(db_file_path, conf_daemon_batch_size)
+                if not hostnames:
+                    time.sleep(conf_daemon_idle)
+                    continue
+
+                started = time.time()
+                alive = scan_batch(executor, db_file_path, hostnames, conf_daemon_rescan, conf_daemon_retry)
+                total, due = work_queue.queue_length(db_file_path)
+                print(f'Scanned {len(hostnames)} hostnames in {time.time() - started:.1f}s, {alive} alive. '
+                      f'{due} of {total} queued hostnames are due')
+    except KeyboardInterrupt:
+        print('Stopping')
+    finally:
+        if profiler:
+            profiler.stop()
+            print(f'Wrote profile to {profiler.path}')
@@ -0,0 +1,178 @@
+## Import modules
+import configparser
+import os
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+## Import other python files
+from util import process_data
+from util import resolve_hostname
+from util import work_queue
+
+## Functions
+
+def probe_hostnames(executor, hostnames):
+    """Probe hostnames for Matrix servers
+
+    Args:
+        executor: ThreadPoolExecutor to probe with.
+        hostnames: List of hostnames.
+
+    Returns:
+        A tuple of (dict of hostname to ProbeResult.to_json() list, list of hostnames that did not answer).
+    """
+
+    succeeded = {}
+    failed = []
+    futures = [executor.submit(resolve_hostname.check_matrix_server, hostname) for hostname in hostnames]
+    for hostname, future in zip(hostnames, futures):
+        try:
+            result = future.result()
+        except Exception as error:
+            print(f'Probing {hostname} failed: {error!r}')
+            failed.append(hostname)
+            continue
+        if result.ok:
+            succeeded[hostname] = result.to_json()
+        else:
+            failed.append(hostname)
+    return((succeeded, failed))
+
+
+def crawl_hosts(executor, hosts):
+    """Download the public room directories of hosts
+
+    Args:
+        executor: ThreadPoolExecutor to download with.
+        hosts: List of [hostname, delegated_hostname, delegated_port, fingerprint]. Fingerprint is from the last crawl
+            and may be missing.
+
+    Returns:
+        A tuple of (dict of hostname to dict with rooms and fingerprint, list of hostnames whose directory could
+        not be downloaded). Rooms is None if the directory did not change.
+    """
+
+    succeeded = {}
+    failed = []
+    results = executor.map(lambda host: process_data.crawl_public_rooms(host[1], host[2], host[3] if len(host) > 3 else None),
+                           hosts)
+    for host, result in zip(hosts, results):
+        if result is None:
+            failed.append(host[0])
+        else:
+            succeeded[host[0]] = {'rooms': result[0], 'fingerprint': result[1]}
+    return((succeeded, failed))
+
+
+def work_once(session, coordinator_url, node_name, batch_size, executor):
+    """Lease one batch of work from the coordinator, do it and report back
+
+    Probing hostnames comes before crawling rooms.
+
+    Args:
+        session: A requests session with any Authorization header set.
+        coordinator_url: Base URL of the coordinator.
+        node_name: Name of this node.
+        batch_size: How many hostnames to lease at a time.
+        executor: ThreadPoolExecutor to work with.
+
+    Returns:
+        How many hostnames were processed. 0 if there was no work.
+    """
+
+    for queue in work_queue.QUEUES:
+        lease = session.get(f'{coordinator_url}/lease',
+                            params={'queue': queue, 'node': node_name, 'limit': batch_size},
+                            timeout=30)
+        lease.raise_for_status()
+        lease = lease.json()
+        if not lease['lease_id']:
+            continue
+
+        if queue == 'work_queue':
+            succeeded, failed = probe_hostnames(executor, lease['hostnames'])
+        else:
+            succeeded, failed = crawl_hosts(executor, lease['hosts'])
+            # Hostnames that vanished from delegated_data since the lease was made
+            found = {host[0] for host in lease['hosts']}
+            failed.extend(hostname for hostname in lease['hostnames'] if hostname not in found)
+
+        report = session.post(f'{coordinator_url}/results',
+                              json={'queue': queue, 'lease_id': lease['lease_id'], 'succeeded': succeeded, 'failed': failed},
+                              timeout=300)
+        report.raise_for_status()
+        print(f'{queue}: processed {len(lease["hostnames"])} hostnames, {len(succeeded)} answered')
+        return(len(lease['hostnames']))
+
+    return(0)
+
+
+if __name__ == "__main__":
+    print('Setting up')
+    # Load config
+    work_dir = os.path.dirname(os.path.realpath(__file__)) # Get the path for the directory this python file is stored in
+    config = configparser.ConfigParser()
+    config.read(os.path.join(work_dir, 'config.ini'))
+
+    try:
+        conf_settings_workers = int(config.get('Settings', 'hs_workers'))
+    except ValueError:
+        print('Config error. Settings: hs_workers must be an integer')
+        exit(1)
+
+    # Timeouts
+    try:
+        conf_timeouts_percentile = int(config.get('Timeouts', 'percentile', fallback='99'))
+        conf_timeouts_factor = float(config.get('Timeouts', 'factor', fallback='2'))
+        conf_timeouts_minimum = float(config.get('Timeouts', 'minimum', fallback='0.5'))
+        conf_timeouts_maximum = float(config.get('Timeouts', 'maximum', fallback='10'))
+    except ValueError:
+        print('Config error. Timeouts: percentile must be an integer, factor, minimum and maximum must be numbers')
+        exit(1)
+    conf_timeouts_hedge = config.get('Timeouts', 'hedge_percentile', fallback='None')
+    if conf_timeouts_hedge == 'None':
+        conf_timeouts_hedge = None
+    else:
+        try:
+            conf_timeouts_hedge = int(conf_timeouts_hedge)
+        except ValueError:
+            print('Config error. Timeouts: hedge_percentile must be an integer or None')
+            exit(1)
+    resolve_hostname.configure_timeouts(conf_timeouts_percentile,
+                                        conf_timeouts_factor,
+                                        conf_timeouts_minimum,
+                                        conf_timeouts_maximum,
+                                        conf_timeouts_hedge,
+                                        conf_settings_workers)
+
+    conf_node_coordinator = config.get('Node', 'coordinator_url', fallback='http://127.0.0.1:8470').rstrip('/')
+    conf_node_name = config.get('Node', 'name', fallback=os.uname().nodename)
+    conf_coordinator_token = config.get('Coordinator', 'token', fallback='')
+    try:
+        conf_node_batch_size = int(config.get('Node', 'batch_size', fallback='500'))
+        conf_daemon_idle = float(config.get('Daemon', 'idle_seconds', fallback='30'))
+        conf_daemon_cache = int(config.get('Daemon', 'cache_seconds', fallback='3600'))
+    except ValueError:
+        print('Config error. Node: batch_size and Daemon: cache_seconds must be integers, idle_seconds must be a number')
+        exit(1)
+    resolve_hostname.configure_cache(conf_daemon_cache)
+
+    session = requests.Session()
+    if conf_coordinator_token:
+        session.headers['Authorization'] = f'Bearer {conf_coordinator_token}'
+
+    print(f'Working for {conf_node_coordinator} as {conf_node_name}. Press Ctrl+C to stop')
+    try:
+        with ThreadPoolExecutor(max_workers=conf_settings_workers) as executor:
+            while True:
+                try:
+                    done = work_once(session, conf_node_coordinator, conf_node_name, conf_node_batch_size, executor)
+                except (requests.exceptions.RequestException, ValueError) as error:
+                    # Coordinator unreachable. Any lease we held expires and is handed to another node
+                    print('Error talking to coordinator:', error)
+                    done = 0
+                if not done:
+                    time.sleep(conf_daemon_idle)
+    except KeyboardInterrupt:
+        print('Stopping')
@@ -0,0 +1,24 @@
+## Import modules
+import argparse
+import configparser
+import os
+
+## Import other python files
+from util import search
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search crawled public rooms by name, topic and aliases')
+    parser.add_argument('text', nargs='+', help='What to search for')
+    parser.add_argument('--limit', type=int, default=10, help='How many rooms to show. Default 10')
+    args = parser.parse_args()
+
+    # Load config
+    work_dir = os.path.dirname(os.path.realpath(__file__)) # Get the path for the directory this python file is stored in
+    config = configparser.ConfigParser()
+    config.read(os.path.join(work_dir, 'config.ini'))
+    conf_global_data_directory = config.get('Global', 'data_directory')
+    conf_files_del_hs_data = config.get('Files', 'delegated_hs_data')
+    db_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_del_hs_data)
+
+    for room_id, name, canonical_alias, members, topic in search.search_rooms(db_file_path, ' '.join(args.text), args.limit):
+        print(f'{members};{room_id};{canonical_alias or ""};{name or ""};{(topic or "")[:80]}')
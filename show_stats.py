@@ -0,0 +1,92 @@
+## Import modules
+import argparse
+import configparser
+import datetime
+import os
+import time
+
+## Import other python files
+from util import history
+from util import stats
+
+## Functions
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD date given on the command line to a unix timestamp at the end of that day"""
+
+    day = datetime.datetime.strptime(value, '%Y-%m-%d')
+    return((day + datetime.timedelta(days=1)).timestamp())
+
+
+def print_rows(rows):
+    for row in rows:
+        print(';'.join(str(column) for column in row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show statistics from the delegated homeservers database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('counts', help='Hosts per value of a dimension')
+    command.add_argument('dimension', choices=stats.DIMENSIONS)
+    command.add_argument('--limit', type=int, help='Only show the most common values')
+
+    command = commands.add_parser('summary', help='Total hosts, valid SSL share and servers with most rooms')
+    command.add_argument('--limit', type=int, default=10, help='How many servers to show. Default 10')
+
+    command = commands.add_parser('rooms', help='Public rooms per server')
+    command.add_argument('--limit', type=int, help='Only show the servers with most rooms')
+
+    command = commands.add_parser('versions', help='Hosts per version on a date')
+    command.add_argument('--date', type=parse_date, help='YYYY-MM-DD. Default now')
+    command.add_argument('--name', help='Only count this server implementation, like Synapse')
+
+    command = commands.add_parser('upgrades', help='Hosts that upgraded recently')
+    command.add_argument('--days', type=float, default=7, help='How many days back to look. Default 7')
+
+    commands.add_parser('check', help='Compare the summary tables with a full count')
+    commands.add_parser('rebuild', help='Rebuild the summary tables from a full count')
+
+    args = parser.parse_args()
+
+    # Load config
+    work_dir = os.path.dirname(os.path.realpath(__file__)) # Get the path for the directory this python file is stored in
+    config = configparser.ConfigParser()
+    config.read(os.path.join(work_dir, 'config.ini'))
+    conf_global_data_directory = config.get('Global', 'data_directory')
+    conf_files_del_hs_data = config.get('Files', 'delegated_hs_data')
+    db_file_path = os.path.join(work_dir, conf_global_data_directory, conf_files_del_hs_data)
+
+    if args.command == 'counts':
+        print_rows(stats.get_counts(db_file_path, args.dimension, args.limit))
+
+    elif args.command == 'summary':
+        share = stats.get_valid_ssl_share(db_file_path)
+        print(f'Hosts: {stats.get_total_hosts(db_file_path)}')
+        print(f'Valid SSL: {share * 100:.1f}%' if share is not None else 'Valid SSL: -')
+        print('Servers with most public rooms:')
+        print_rows(stats.get_room_counts(db_file_path, args.limit))
+
+    elif args.command == 'rooms':
+        print_rows(stats.get_room_counts(db_file_path, args.limit))
+
+    elif args.command == 'versions':
+        print_rows(history.version_distribution(db_file_path, args.date, name=args.name))
+
+    elif args.command == 'upgrades':
+        since = time.time() - args.days * 24 * 3600
+        for hostname, old, new, observed_at in history.version_changes(db_file_path, since):
+            print(f'{hostname};{old};{new};{datetime.datetime.fromtimestamp(observed_at):%Y-%m-%d %H:%M}')
+
+    elif args.command == 'check':
+        wrong = stats.check_stats(db_file_path)
+        for table, key, stored, actual in wrong:
+            print(f'{table} {key}: stored {stored}, actual {actual}')
+        if wrong:
+            print('Run rebuild to fix')
+            exit(1)
+        print('All counts are correct')
+
+    elif args.command == 'rebuild':
+        stats.rebuild_stats(db_file_path)
+        print('Summary tables rebuilt')
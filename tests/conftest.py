@@ -0,0 +1,22 @@
+## Import modules
+import os
+import sys
+
+import pytest
+
+# The scripts import util from the repository root, so the tests do too
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+## Import other python files
+from util import database
+
+
+## Fixtures
+
+@pytest.fixture
+def db_file_path(tmp_path):
+    """Path of a fresh SQLite database, closed again after the test"""
+
+    path = str(tmp_path / 'test.db')
+    yield(path)
+    database.close(path)
@@ -0,0 +1,157 @@
+## Import modules
+import sqlite3
+
+import pytest
+
+## Import other python files
+from util import database
+
+
+## Helpers
+
+def _connect(path):
+    return(sqlite3.connect(path, isolation_level=None))
+
+
+def _migrate_to(conn, version):
+    """Apply the first version migrations, like an older release of the scanner did"""
+
+    with database.transaction(conn):
+        for number, migration in enumerate(database.MIGRATIONS[:version], 1):
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+
+
+def _names(conn, kind):
+    return({row[0] for row in conn.execute('SELECT name FROM sqlite_master WHERE type = ?', (kind,))})
+
+
+## Tests
+
+def test_fresh_database(tmp_path):
+    conn = _connect(str(tmp_path / 'test.db'))
+
+    assert database.migrate(conn) == len(database.MIGRATIONS) == 12
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 12
+    assert {'delegated_data', 'delegated_history', 'work_queue', 'room_queue', 'stats_counts', 'room_counts', 'rooms',
+            'room_aliases', 'room_servers', 'room_directories', 'removed_hosts', 'delegated_addresses',
+            'discovered_hosts', 'discovery_progress'} <= _names(conn, 'table')
+    assert {'public_rooms', 'aliases'} <= _names(conn, 'view')
+
+    # Migrating again changes nothing
+    schema = conn.execute('SELECT type, name, sql FROM sqlite_master ORDER BY name').fetchall()
+    assert database.migrate(conn) == 12
+    assert conn.execute('SELECT type, name, sql FROM sqlite_master ORDER BY name').fetchall() == schema
+
+
+@pytest.mark.parametrize('version', range(len(database.MIGRATIONS) + 1))
+def test_upgrade_from_every_version(tmp_path, version):
+    path = str(tmp_path / 'test.db')
+    conn = _connect(path)
+    _migrate_to(conn, version)
+    assert database.migrate(conn) == len(database.MIGRATIONS)
+
+    # Same schema as a database made from scratch
+    fresh = _connect(str(tmp_path / 'fresh.db'))
+    database.migrate(fresh)
+    for kind in ('table', 'index', 'trigger', 'view'):
+        assert _names(conn, kind) == _names(fresh, kind)
+
+
+def test_upgrade_keeps_data(tmp_path):
+    conn = _connect(str(tmp_path / 'test.db'))
+    _migrate_to(conn, 1)
+
+    # An old database with duplicate hosts and rooms listed by two servers
+    conn.executemany('''
+        INSERT INTO delegated_data (id, hostname, delegated_ip, delegated_port, name, version, valid_ssl)
+        VALUES (?, ?, ?, 8448, 'Synapse', ?, 'True')
+    ''', [(1, 'a.example', '192.0.2.1', '1.0'), (2, 'a.example', '192.0.2.2', '1.1'), (3, 'b.example', '192.0.2.3', '1.1')])
+    conn.executemany('''
+        INSERT INTO public_rooms (id, host_id, room_id, name, num_joined_members)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(1, 2, '!r:a.example', 'Old name', 5), (2, 3, '!r:a.example', 'New name', 7), (3, 3, '!s:b.example', 'S', 1)])
+    conn.executemany('INSERT INTO aliases (room_id, alias) VALUES (?, ?)', [(1, '#old:a.example'), (2, '#new:a.example')])
+
+    database.migrate(conn)
+
+    # The newest row per hostname is kept, with its history seeded
+    assert conn.execute('SELECT id, delegated_ip FROM delegated_data ORDER BY id').fetchall() == [
+        (2, '192.0.2.2'), (3, '192.0.2.3')]
+    assert conn.execute('''
+        SELECT value FROM delegated_history
+        WHERE hostname = 'a.example' AND attribute = 'version'
+    ''').fetchall() == [('1.1',)]
+    assert conn.execute('''
+        SELECT hosts FROM stats_counts
+        WHERE dimension = 'version' AND value = '1.1'
+    ''').fetchone() == (2,)
+    assert conn.execute('SELECT host_id, address FROM delegated_addresses ORDER BY host_id').fetchall() == [
+        (2, '192.0.2.2'), (3, '192.0.2.3')]
+
+    # Rooms are stored once, the newest row wins, and both servers still list it
+    assert conn.execute('SELECT room_id, name, num_joined_members FROM rooms ORDER BY room_id').fetchall() == [
+        ('!r:a.example', 'New name', 7), ('!s:b.example', 'S', 1)]
+    assert conn.execute('''
+        SELECT alias FROM room_aliases
+        JOIN rooms ON rooms.id = room_aliases.room_id
+    ''').fetchall() == [('#new:a.example',)]
+    assert conn.execute('SELECT host_id, rooms FROM room_counts ORDER BY host_id').fetchall() == [(2, 1), (3, 2)]
+    assert conn.execute('SELECT count(*) FROM public_rooms').fetchone() == (3,)
+
+
+def test_triggers(tmp_path):
+    conn = _connect(str(tmp_path / 'test.db'))
+    database.migrate(conn)
+
+    conn.execute('''
+        INSERT INTO delegated_data (id, hostname, delegated_ip, name)
+        VALUES (1, 'a.example', '192.0.2.1', 'Synapse')
+    ''')
+    conn.execute("INSERT INTO delegated_addresses (host_id, address) VALUES (1, '192.0.2.1')")
+    conn.execute("INSERT INTO rooms (id, room_id) VALUES (1, '!r:a.example')")
+    conn.execute('INSERT INTO room_servers (host_id, room_id) VALUES (1, 1)')
+    assert conn.execute("SELECT hosts FROM stats_counts WHERE dimension = 'name' AND value = 'Synapse'").fetchone() == (1,)
+    assert conn.execute('SELECT rooms FROM room_counts WHERE host_id = 1').fetchone() == (1,)
+
+    conn.execute('DELETE FROM room_servers')
+    conn.execute('DELETE FROM delegated_data')
+    assert conn.execute("SELECT hosts FROM stats_counts WHERE dimension = 'name' AND value = 'Synapse'").fetchone() == (0,)
+    assert conn.execute('SELECT rooms FROM room_counts WHERE host_id = 1').fetchone() == (0,)
+    assert conn.execute('SELECT hostname FROM removed_hosts').fetchall() == [('a.example',)]
+    assert conn.execute('SELECT count(*) FROM delegated_addresses').fetchone() == (0,)
+
+    # Coming back takes it off the removed list
+    conn.execute("INSERT INTO delegated_data (hostname) VALUES ('a.example')")
+    assert conn.execute('SELECT count(*) FROM removed_hosts').fetchone() == (0,)
+
+
+def test_transaction(db_file_path):
+    conn = database.connect(db_file_path)
+
+    with database.transaction(conn):
+        conn.execute("INSERT INTO removed_hosts (hostname) VALUES ('a.example')")
+        with database.transaction(conn):
+            conn.execute("INSERT INTO removed_hosts (hostname) VALUES ('b.example')")
+
+    with pytest.raises(ValueError):
+        with database.transaction(conn):
+            conn.execute("INSERT INTO removed_hosts (hostname) VALUES ('c.example')")
+            raise ValueError
+
+    assert not conn.in_transaction
+    assert conn.execute('SELECT hostname FROM removed_hosts ORDER BY hostname').fetchall() == [
+        ('a.example',), ('b.example',)]
+
+
+def test_connect_readonly_needs_migrated_database(db_file_path, tmp_path):
+    old = str(tmp_path / 'old.db')
+    _migrate_to(_connect(old), 3)
+    with pytest.raises(sqlite3.OperationalError):
+        database.connect_readonly(old)
+
+    database.connect(db_file_path)
+    conn = database.connect_readonly(db_file_path)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("INSERT INTO removed_hosts (hostname) VALUES ('a.example')")
+    database.close()
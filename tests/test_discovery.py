@@ -0,0 +1,119 @@
+## Import modules
+import pytest
+
+## Import other python files
+from util import database
+from util import discovery
+from util import process_data
+from util import work_queue
+from util.probe_result import ProbeResult
+
+
+## Helpers
+
+def _add_rooms(db_file_path, rooms):
+    conn = database.connect(db_file_path)
+    with database.transaction(conn):
+        process_data.write_public_rooms(conn, 1, [{'room_id': room_id, 'aliases': aliases} for room_id, aliases in rooms])
+
+
+def _probed(db_file_path, hostname):
+    process_data.write_delegated(db_file_path, [ProbeResult.found(hostname, hostname, '192.0.2.1', 8448, 'a',
+                                                                  'Synapse', '1.99.0', True)])
+
+
+def _discover(db_file_path, chunk_size=discovery.CHUNK_SIZE):
+    return(sorted(sum(discovery.discover_hostnames(db_file_path, chunk_size), [])))
+
+
+def _progress(db_file_path):
+    conn = database.connect(db_file_path)
+    return(conn.execute('SELECT rooms_read_until FROM discovery_progress WHERE id = 1').fetchone())
+
+
+## Tests
+
+@pytest.mark.parametrize('identifier, expected', [
+    ('!abc:example.org', 'example.org'),
+    ('#room:Example.org:8448', 'example.org'),
+    ('@user:example.org:8443', 'example.org:8443'),
+    ('!abc:[2001:db8::1]:8448', '[2001:db8::1]'),
+    ('!abc:localhost', None),
+    ('!abc', None),
+    ('', None),
+    (None, None),
+])
+def test_server_name(identifier, expected):
+    assert discovery.server_name(identifier) == expected
+
+
+@pytest.mark.parametrize('hostname, expected', [
+    ('example.org', 'example.org'),
+    ('example.org:8443', 'example.org'),
+    ('[2001:db8::1]', '[2001:db8::1]'),
+    ('[2001:db8::1]:8443', '[2001:db8::1]'),
+    ('[2001:db8::1', None),
+])
+def test_stored_hostname(hostname, expected):
+    assert discovery.stored_hostname(hostname) == expected
+
+
+def test_finds_unknown_names(db_file_path):
+    _probed(db_file_path, 'known.example')
+    work_queue.enqueue(db_file_path, ['queued.example'], 'file')
+    _add_rooms(db_file_path, [
+        ('!a:new.example', ['#a:known.example', '#b:queued.example:8448']),
+        ('!b:known.example:8443', ['#c:other.example:8443', '#d:localhost']),
+    ])
+
+    assert _discover(db_file_path) == ['new.example', 'other.example:8443']
+    assert _progress(db_file_path) is not None
+
+
+def test_names_kept_until_probed_or_queued(db_file_path):
+    _add_rooms(db_file_path, [('!a:a.example', []), ('!b:b.example', []), ('!c:c.example', [])])
+    assert _discover(db_file_path) == ['a.example', 'b.example', 'c.example']
+
+    # Nothing was probed or queued, so the next pass hands the same names out again
+    assert _discover(db_file_path) == ['a.example', 'b.example', 'c.example']
+
+    _probed(db_file_path, 'a.example')
+    work_queue.enqueue(db_file_path, ['b.example'], 'file')
+    assert _discover(db_file_path) == ['c.example']
+
+    conn = database.connect(db_file_path)
+    assert conn.execute('SELECT hostname FROM discovered_hosts').fetchall() == [('c.example',)]
+
+
+def test_rooms_read_once(db_file_path):
+    _add_rooms(db_file_path, [('!a:a.example', [])])
+    assert _discover(db_file_path) == ['a.example']
+
+    # Rooms read by an earlier pass are not read again, beyond the overlap
+    conn = database.connect(db_file_path)
+    with database.transaction(conn):
+        conn.execute('UPDATE rooms SET updated_at = updated_at - ?', (discovery.OVERLAP_SECONDS * 2,))
+        conn.execute("INSERT INTO rooms (room_id, updated_at) VALUES ('!old:old.example', 1)")
+        conn.execute('DELETE FROM discovered_hosts')
+    assert _discover(db_file_path) == []
+
+    # Rooms updated since are
+    _add_rooms(db_file_path, [('!b:b.example', ['#b:c.example'])])
+    assert _discover(db_file_path) == ['b.example', 'c.example']
+
+
+def test_chunks(db_file_path):
+    _add_rooms(db_file_path, [(f'!room:host{number}.example', []) for number in range(25)])
+    chunks = list(discovery.discover_hostnames(db_file_path, 10))
+
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert sorted(sum(chunks, [])) == sorted(f'host{number}.example' for number in range(25))
+
+
+def test_enqueue_discovered(db_file_path):
+    _add_rooms(db_file_path, [('!a:a.example', ['#b:b.example:8443'])])
+
+    assert discovery.enqueue_discovered(db_file_path) == 2
+    assert discovery.enqueue_discovered(db_file_path) == 0
+    assert _discover(db_file_path) == []
+    assert work_queue.queue_length(db_file_path) == (2, 2)
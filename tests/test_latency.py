@@ -0,0 +1,103 @@
+## Import modules
+import pytest
+
+## Import other python files
+from util.latency import LatencyTracker
+
+
+## Tests
+
+def test_defaults_until_enough_samples():
+    tracker = LatencyTracker(3, 3, min_samples=50)
+    for _ in range(49):
+        tracker.record(0.1, 0.1)
+
+    assert tracker.percentile(99) is None
+    assert tracker.timeout() == (3, 3)
+
+
+def test_percentile():
+    tracker = LatencyTracker(3, 3, min_samples=1)
+    for latency in range(1, 101):
+        tracker.record(None, latency / 100)
+
+    assert tracker.percentile(50, 'read') == 0.5
+    assert tracker.percentile(99, 'read') == 0.99
+    assert tracker.percentile(100, 'read') == 1.0
+    assert tracker.percentile(0, 'read') == 0.01
+
+    # No connect samples without a new connection
+    assert tracker.percentile(50, 'connect') is None
+
+
+def test_total_adds_connect_and_read():
+    tracker = LatencyTracker(3, 3, min_samples=1)
+    tracker.record(0.25, 0.5)
+    tracker.record(None, 0.5)
+
+    assert tracker.percentile(100, 'total') == 0.75
+    assert tracker.percentile(0, 'total') == 0.5
+
+
+@pytest.mark.parametrize('latency, expected', [
+    (0.1, 3),       # Fast servers never get less than the default
+    (2, 4),         # Percentile times factor
+    (4, 8),
+    (20, 10),       # Capped at the maximum
+])
+def test_timeout_clamped(latency, expected):
+    tracker = LatencyTracker(3, 3, factor=2, minimum=0.5, maximum=10, window=100, min_samples=10)
+    for _ in range(100):
+        tracker.record(latency, latency)
+
+    assert tracker.timeout() == (expected, expected)
+
+
+def test_minimum_above_default():
+    tracker = LatencyTracker(1, 1, factor=2, minimum=5, maximum=10, window=100, min_samples=10)
+    for _ in range(100):
+        tracker.record(0.1, 0.1)
+
+    assert tracker.timeout() == (5, 5)
+
+
+def test_timed_out_requests_keep_timeouts_up():
+    tracker = LatencyTracker(3, 3, percentile=90, factor=2, maximum=10, window=100, min_samples=10)
+    for _ in range(80):
+        tracker.record(0.1, 0.1)
+
+    # Connect timeouts only count for the connect timeout, read timeouts for the read timeout
+    for _ in range(20):
+        tracker.record(3, None)
+    assert tracker.timeout() == (6, 3)
+
+    for _ in range(20):
+        tracker.record(0.1, 4)
+    assert tracker.timeout()[1] == 8
+
+
+def test_timeout_refreshed_after_enough_samples():
+    tracker = LatencyTracker(3, 3, factor=2, maximum=100, window=100, min_samples=10)
+    for _ in range(100):
+        tracker.record(2, 2)
+    assert tracker.timeout() == (4, 4)
+
+    # window // 20 samples are needed before the timeouts are worked out again
+    for _ in range(4):
+        tracker.record(20, 20)
+    assert tracker.timeout() == (4, 4)
+    tracker.record(20, 20)
+    assert tracker.timeout() == (40, 40)
+
+
+def test_configure():
+    tracker = LatencyTracker(3, 3, factor=2, maximum=10, window=100, min_samples=10)
+    for _ in range(100):
+        tracker.record(4, 4)
+    assert tracker.timeout() == (8, 8)
+
+    tracker.configure(factor=3, maximum=9)
+    assert tracker.timeout() == (9, 9)
+
+    tracker.configure(percentile=50, factor=1, minimum=0, maximum=60)
+    assert tracker.timeout() == (4, 4)
@@ -0,0 +1,74 @@
+## Import modules
+import json
+
+import pytest
+
+## Import other python files
+from util.probe_result import ProbeError, ProbeResult
+
+
+## Tests
+
+def _found():
+    return(ProbeResult.found('example.org', 'matrix.example.org', '192.0.2.1', 8448, 'wellknown', 'Synapse', '1.99.0',
+                             True, ('192.0.2.1', '2001:db8::1')))
+
+
+def test_found():
+    result = _found()
+
+    assert result.ok
+    assert result.error is None
+    assert result.hostname == 'example.org'
+    assert result.delegated_hostname == 'matrix.example.org'
+    assert result.delegated_port == 8448
+    assert result.addresses == ('192.0.2.1', '2001:db8::1')
+
+
+def test_found_shares_common_values():
+    first = _found()
+    second = ProbeResult.found('example.com', 'example.com', '192.0.2.2', int('8448'), ''.join(['well', 'known']),
+                               ''.join(['Syn', 'apse']), '1.99.0', True)
+
+    assert second.name is first.name
+    assert second.server_lookup_type is first.server_lookup_type
+    assert second.delegated_port is first.delegated_port
+    assert second.delegated_hostname is second.hostname
+
+
+def test_failure():
+    result = ProbeResult.failure('example.org', ProbeError.CONNECTION)
+
+    assert not result.ok
+    assert result.error is ProbeError.CONNECTION
+    assert result[1:-1] == (None,) * (len(ProbeResult._fields) - 2)
+
+
+@pytest.mark.parametrize('result', [
+    _found(),
+    ProbeResult.found('example.org', 'example.org', '192.0.2.1', 443, 'srv', 'Dendrite', '0.13', False),
+    ProbeResult.failure('example.org', ProbeError.HTTP_STATUS),
+    ProbeResult.failure('[2001:db8::1]', ProbeError.INVALID_HOSTNAME),
+])
+def test_json_round_trip(result):
+    data = json.loads(json.dumps(result.to_json()))
+    assert ProbeResult.from_json(data) == result
+
+
+def test_from_json_before_addresses():
+    data = _found().to_json()
+    del data[8]
+
+    assert ProbeResult.from_json(data) == _found()._replace(addresses=None)
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    {},
+    ['example.org'],
+    _found().to_json() + [None],
+    _found().to_json()[:-1] + ['no such error'],
+])
+def test_from_json_rejects(data):
+    with pytest.raises(ValueError):
+        ProbeResult.from_json(data)
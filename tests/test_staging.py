@@ -0,0 +1,62 @@
+## Import modules
+import os
+
+import pytest
+
+## Import other python files
+from util import staging
+from util.staging import HostnameStaging
+
+
+## Tests
+
+def test_deduplicates_spellings(tmp_path):
+    with HostnameStaging(tmp_path) as hostnames:
+        added = hostnames.add(['example.org', 'Example.org.', 'https://example.org:8448/', '@user:example.org',
+                               'example.org:8443', 'localhost', '', '  ', 'bücher.example', 'xn--bcher-kva.example'])
+
+        assert added == 3
+        assert len(hostnames) == 3
+        # Eight distinct inputs, blanks not counted, made three hostnames
+        assert hostnames.probes_saved() == 8 - 3
+        assert sorted(sum(hostnames.batches(10), [])) == ['example.org', 'example.org:8443', 'xn--bcher-kva.example']
+
+
+def test_add_counts_only_new_hostnames(tmp_path):
+    with HostnameStaging(tmp_path) as hostnames:
+        assert hostnames.add(iter(['a.example', 'b.example'])) == 2
+        assert hostnames.add(['b.example', 'c.example']) == 1
+        assert len(hostnames) == 3
+
+
+def test_batches(tmp_path, monkeypatch):
+    # Small insert batches so the generator is read over several transactions
+    monkeypatch.setattr(staging, 'INSERT_BATCH', 7)
+    expected = [f'host{number}.example' for number in range(100)]
+
+    with HostnameStaging(tmp_path) as hostnames:
+        assert hostnames.add(hostname for hostname in expected + expected) == 100
+        batches = list(hostnames.batches(30))
+
+    assert [len(batch) for batch in batches] == [30, 30, 30, 10]
+    returned = sum(batches, [])
+    assert sorted(returned) == sorted(expected)
+    assert returned != sorted(expected)
+
+
+def test_no_adding_after_reading(tmp_path):
+    with HostnameStaging(tmp_path) as hostnames:
+        hostnames.add(['a.example'])
+        next(hostnames.batches(10))
+        with pytest.raises(RuntimeError):
+            hostnames.add(['b.example'])
+
+
+def test_close_removes_file(tmp_path):
+    hostnames = HostnameStaging(tmp_path)
+    assert os.path.exists(hostnames.path)
+    assert os.path.dirname(hostnames.path) == str(tmp_path)
+
+    hostnames.close()
+    assert not os.path.exists(hostnames.path)
+    assert os.listdir(tmp_path) == []
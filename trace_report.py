@@ -0,0 +1,68 @@
+## Import modules
+import argparse
+import configparser
+import os
+
+## Import other python files
+from util import tracing
+
+## Functions
+
+def slowest_span(data):
+    """Get the span a trace spent most time in, as name and seconds"""
+
+    if not data['spans']:
+        return('-')
+    name, _, seconds, detail = max(data['spans'], key=lambda span: span[2])
+    return(f'{name} {seconds:.3f}s {detail or ""}'.strip())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show where probes and room crawls spent their time, from the trace log')
+    parser.add_argument('--file', help='Trace log to read. Default trace_file from the [Tracing] section of config.ini')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('hosts', help='Slowest hosts')
+    command.add_argument('--limit', type=int, default=20, help='How many hosts to show. Default 20')
+    command.add_argument('--kind', choices=('probe', 'rooms'), help='Only show probes or room crawls')
+
+    command = commands.add_parser('phases', help='Time spent per phase over all traces')
+    command.add_argument('--kind', choices=('probe', 'rooms'), help='Only count probes or room crawls')
+
+    command = commands.add_parser('host', help='Every span of the traces of one host')
+    command.add_argument('hostname')
+
+    args = parser.parse_args()
+
+    # Load config
+    trace_file_path = args.file
+    if not trace_file_path:
+        work_dir = os.path.dirname(os.path.realpath(__file__)) # Get the path for the directory this python file is stored in
+        config = configparser.ConfigParser()
+        config.read(os.path.join(work_dir, 'config.ini'))
+        conf_global_data_directory = config.get('Global', 'data_directory')
+        conf_tracing_trace_file = config.get('Tracing', 'trace_file', fallback='None')
+        if conf_tracing_trace_file == 'None':
+            print('Tracing is not enabled. Set trace_file in the [Tracing] section of config.ini, or pass --file')
+            exit(1)
+        trace_file_path = os.path.join(work_dir, conf_global_data_directory, conf_tracing_trace_file)
+    if not os.path.isfile(trace_file_path):
+        print(f'{trace_file_path} does not exist')
+        exit(1)
+
+    if args.command == 'hosts':
+        for data in tracing.slowest(trace_file_path, args.limit, args.kind):
+            print(f'{data["host"]};{data["kind"]};{data["seconds"]:.3f};{data["outcome"]};{slowest_span(data)}')
+
+    elif args.command == 'phases':
+        print('Phase;Spans;Total seconds;Mean seconds;Slowest seconds')
+        for name, count, total, longest in tracing.phase_totals(trace_file_path, args.kind):
+            print(f'{name};{count};{total:.3f};{total / count:.3f};{longest:.3f}')
+
+    elif args.command == 'host':
+        for data in tracing.read_traces(trace_file_path):
+            if data['host'] != args.hostname:
+                continue
+            print(f'{data["kind"]} {data["seconds"]:.3f}s {data["outcome"]}')
+            for name, offset, seconds, detail in data['spans']:
+                print(f'  +{offset:.3f}s {name:8} {seconds:.3f}s {detail or ""}')
@@ -1,3 +1,15 @@
+from . import database
+from . import discovery
+from . import history
 from . import import_hostnames
+from . import latency
+from . import map_data
+from . import probe_result
 from . import process_data
 from . import resolve_hostname
+from . import search
+from . import shodan_cache
+from . import staging
+from . import stats
+from . import tracing
+from . import work_queue
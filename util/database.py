@@ -0,0 +1,608 @@
+## Import modules
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+import urllib.request
+
+
+## Settings
+
+# Applied to every connection. WAL lets readers (map exports, ad-hoc queries) run while the scanner writes
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 30000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -32000',
+    'PRAGMA mmap_size = 268435456',
+)
+
+# How many prepared statements each connection keeps around for reuse
+CACHED_STATEMENTS = 256
+
+_connections = threading.local()
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+## Migrations
+# Each migration runs once per database, in order, inside a transaction. PRAGMA user_version records
+# how many have been applied. Never edit a migration that has shipped, add a new one instead.
+
+def _migration_base_schema(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS delegated_data (
+            id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+            hostname            TEXT,
+            delegated_hostname  TEXT,
+            delegated_ip        TEXT,
+            delegated_port      INTEGER,
+            server_lookup_type  TEXT,
+            name                TEXT,
+            version             TEXT,
+            valid_ssl           TEXT,
+            latitude            TEXT,
+            longitude           TEXT
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS public_rooms (
+            id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+            host_id             INTEGER,
+            canonical_alias     TEXT,
+            name                TEXT,
+            num_joined_members  INTEGER,
+            room_id             TEXT,
+            topic               TEXT,
+            world_readable      TEXT,
+            guest_can_join      TEXT,
+            avatar_url          TEXT,
+            m_federate          TEXT,
+            FOREIGN KEY(host_id) REFERENCES delegated_data(id)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS aliases (
+            id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id             INTEGER,
+            alias               TEXT,
+            FOREIGN KEY(room_id) REFERENCES public_rooms(id)
+        )
+    ''')
+
+
+def _migration_work_queues(cur):
+    for queue in ('work_queue', 'room_queue'):
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {queue} (
+                hostname            TEXT PRIMARY KEY,
+                source              TEXT,
+                added_at            REAL,
+                next_scan_at        REAL,
+                last_scanned_at     REAL,
+                attempts            INTEGER DEFAULT 0,
+                lease_id            TEXT,
+                lease_expires       REAL
+            )
+        ''')
+
+        # Queues made before leases existed lack the lease columns
+        columns = [row[1] for row in cur.execute(f'PRAGMA table_info({queue})')]
+        if 'lease_id' not in columns:
+            cur.execute(f'ALTER TABLE {queue} ADD COLUMN lease_id TEXT')
+            cur.execute(f'ALTER TABLE {queue} ADD COLUMN lease_expires REAL')
+
+        cur.execute(f'CREATE INDEX IF NOT EXISTS {queue}_next_scan_at ON {queue} (next_scan_at)')
+        cur.execute(f'CREATE INDEX IF NOT EXISTS {queue}_lease_id ON {queue} (lease_id)')
+
+
+def _migration_indexes(cur):
+    cur.execute('CREATE INDEX IF NOT EXISTS delegated_data_hostname ON delegated_data (hostname)')
+    cur.execute('CREATE INDEX IF NOT EXISTS delegated_data_delegated_ip ON delegated_data (delegated_ip, server_lookup_type)')
+    cur.execute('CREATE INDEX IF NOT EXISTS public_rooms_room_id ON public_rooms (room_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS public_rooms_host_id ON public_rooms (host_id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS aliases_room_id ON aliases (room_id)')
+
+
+def _migration_history(cur):
+    # Keep only the newest row per hostname, so hostname can be unique
+    cur.execute('''
+        DELETE FROM delegated_data
+        WHERE id NOT IN (
+            SELECT max(id) FROM delegated_data
+            GROUP BY hostname
+        )
+    ''')
+    cur.execute('DROP INDEX IF EXISTS delegated_data_hostname')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS delegated_data_hostname_unique ON delegated_data (hostname)')
+
+    cur.execute('ALTER TABLE delegated_data ADD COLUMN first_seen REAL')
+    cur.execute('ALTER TABLE delegated_data ADD COLUMN last_seen REAL')
+    cur.execute('ALTER TABLE delegated_data ADD COLUMN changed_at REAL')
+    now = time.time()
+    cur.execute('''
+        UPDATE delegated_data
+        SET first_seen = ?, last_seen = ?, changed_at = ?
+    ''', (now, now, now))
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS delegated_history (
+            id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+            hostname            TEXT,
+            observed_at         REAL,
+            attribute           TEXT,
+            value               TEXT
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS delegated_history_hostname ON delegated_history (hostname, attribute, observed_at)')
+    cur.execute('CREATE INDEX IF NOT EXISTS delegated_history_attribute ON delegated_history (attribute, observed_at)')
+
+    # Seed the history with what is known now
+    for attribute in ('delegated_ip', 'delegated_port', 'name', 'version', 'valid_ssl'):
+        cur.execute(f'''
+            INSERT INTO delegated_history (hostname, observed_at, attribute, value)
+            SELECT hostname, first_seen, '{attribute}', {attribute} FROM delegated_data
+        ''')
+
+
+def _migration_stats(cur):
+    # Host counts per value of a few delegated_data columns, and room counts per host, kept up to date by triggers
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counts (
+            dimension           TEXT,
+            value               TEXT,
+            hosts               INTEGER,
+            PRIMARY KEY (dimension, value)
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS room_counts (
+            host_id             INTEGER PRIMARY KEY,
+            rooms               INTEGER
+        )
+    ''')
+
+    for dimension in ('name', 'version', 'server_lookup_type', 'valid_ssl'):
+        increment = f'''
+            INSERT INTO stats_counts (dimension, value, hosts) VALUES ('{dimension}', coalesce(NEW.{dimension}, ''), 1)
+            ON CONFLICT (dimension, value) DO UPDATE SET hosts = hosts + 1;
+        '''
+        decrement = f'''
+            UPDATE stats_counts SET hosts = hosts - 1
+            WHERE dimension = '{dimension}' AND value = coalesce(OLD.{dimension}, '');
+        '''
+        cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{dimension}_insert AFTER INSERT ON delegated_data
+            BEGIN {increment} END
+        ''')
+        cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{dimension}_delete AFTER DELETE ON delegated_data
+            BEGIN {decrement} END
+        ''')
+        cur.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS stats_{dimension}_update AFTER UPDATE OF {dimension} ON delegated_data
+            WHEN OLD.{dimension} IS NOT NEW.{dimension}
+            BEGIN {decrement} {increment} END
+        ''')
+
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_counts_insert AFTER INSERT ON public_rooms
+        BEGIN
+            INSERT INTO room_counts (host_id, rooms) VALUES (NEW.host_id, 1)
+            ON CONFLICT (host_id) DO UPDATE SET rooms = rooms + 1;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_counts_delete AFTER DELETE ON public_rooms
+        BEGIN
+            UPDATE room_counts SET rooms = rooms - 1 WHERE host_id = OLD.host_id;
+        END
+    ''')
+
+    # Fill the tables from the rows already there
+    for dimension in ('name', 'version', 'server_lookup_type', 'valid_ssl'):
+        cur.execute(f'''
+            INSERT INTO stats_counts (dimension, value, hosts)
+            SELECT '{dimension}', coalesce({dimension}, ''), count(*) FROM delegated_data
+            GROUP BY coalesce({dimension}, '')
+        ''')
+    cur.execute('''
+        INSERT INTO room_counts (host_id, rooms)
+        SELECT host_id, count(*) FROM public_rooms
+        GROUP BY host_id
+    ''')
+
+
+def _migration_room_search(cur):
+    # Full-text index over room name, topic and aliases. rowid is the public_rooms id.
+    # Skipped if this SQLite has no FTS5, in which case search falls back to LIKE
+    try:
+        cur.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS rooms_fts USING fts5 (
+                name, topic, aliases,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        return
+
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS rooms_fts_delete AFTER DELETE ON public_rooms
+        BEGIN
+            DELETE FROM rooms_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    cur.execute('''
+        INSERT INTO rooms_fts (rowid, name, topic, aliases)
+        SELECT id, name, topic, trim(coalesce(canonical_alias, '') || ' ' || coalesce((
+            SELECT group_concat(alias, ' ') FROM aliases
+            WHERE aliases.room_id = public_rooms.id
+        ), ''))
+        FROM public_rooms
+    ''')
+
+
+def _migration_room_dedup(cur):
+    # Store every room once, keyed by room_id, with a membership table saying which servers list it
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS rooms (
+            id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id             TEXT UNIQUE,
+            canonical_alias     TEXT,
+            name                TEXT,
+            num_joined_members  INTEGER,
+            topic               TEXT,
+            world_readable      TEXT,
+            guest_can_join      TEXT,
+            avatar_url          TEXT,
+            m_federate          TEXT,
+            updated_at          REAL
+        )
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS room_aliases (
+            room_id             INTEGER,
+            alias               TEXT,
+            PRIMARY KEY (room_id, alias),
+            FOREIGN KEY(room_id) REFERENCES rooms(id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS room_servers (
+            host_id             INTEGER,
+            room_id             INTEGER,
+            PRIMARY KEY (host_id, room_id),
+            FOREIGN KEY(host_id) REFERENCES delegated_data(id),
+            FOREIGN KEY(room_id) REFERENCES rooms(id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS room_servers_room_id ON room_servers (room_id)')
+
+    # Move the old per-server rows over. The newest row of a room wins
+    latest = 'SELECT max(id) FROM public_rooms WHERE room_id IS NOT NULL GROUP BY room_id'
+    cur.execute(f'''
+        INSERT INTO rooms
+        (room_id, canonical_alias, name, num_joined_members, topic, world_readable, guest_can_join, avatar_url, m_federate, updated_at)
+        SELECT room_id, canonical_alias, name, num_joined_members, topic, world_readable, guest_can_join, avatar_url, m_federate, ?
+        FROM public_rooms
+        WHERE id IN ({latest})
+    ''', (time.time(),))
+    cur.execute(f'''
+        INSERT OR IGNORE INTO room_aliases (room_id, alias)
+        SELECT rooms.id, aliases.alias FROM aliases
+        JOIN public_rooms ON public_rooms.id = aliases.room_id
+        JOIN rooms ON rooms.room_id = public_rooms.room_id
+        WHERE public_rooms.id IN ({latest})
+    ''')
+    cur.execute('''
+        INSERT OR IGNORE INTO room_servers (host_id, room_id)
+        SELECT public_rooms.host_id, rooms.id FROM public_rooms
+        JOIN rooms ON rooms.room_id = public_rooms.room_id
+    ''')
+
+    # Dropping the tables also drops their triggers. Views with the old names keep ad-hoc queries working
+    cur.execute('DROP TABLE aliases')
+    cur.execute('DROP TABLE public_rooms')
+    cur.execute('''
+        CREATE VIEW public_rooms AS
+        SELECT rooms.id, room_servers.host_id, rooms.canonical_alias, rooms.name, rooms.num_joined_members,
+               rooms.room_id, rooms.topic, rooms.world_readable, rooms.guest_can_join, rooms.avatar_url, rooms.m_federate
+        FROM room_servers
+        JOIN rooms ON rooms.id = room_servers.room_id
+    ''')
+    cur.execute('CREATE VIEW aliases AS SELECT room_id, alias FROM room_aliases')
+
+    # Room counts per server now follow the membership table
+    cur.execute('DELETE FROM room_counts')
+    cur.execute('INSERT INTO room_counts (host_id, rooms) SELECT host_id, count(*) FROM room_servers GROUP BY host_id')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_counts_insert AFTER INSERT ON room_servers
+        BEGIN
+            INSERT INTO room_counts (host_id, rooms) VALUES (NEW.host_id, 1)
+            ON CONFLICT (host_id) DO UPDATE SET rooms = rooms + 1;
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS room_counts_delete AFTER DELETE ON room_servers
+        BEGIN
+            UPDATE room_counts SET rooms = rooms - 1 WHERE host_id = OLD.host_id;
+        END
+    ''')
+
+    # The search index is now keyed by rooms.id
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rooms_fts'").fetchone():
+        cur.execute('DELETE FROM rooms_fts')
+        cur.execute('''
+            INSERT INTO rooms_fts (rowid, name, topic, aliases)
+            SELECT id, name, topic, trim(coalesce(canonical_alias, '') || ' ' || coalesce((
+                SELECT group_concat(alias, ' ') FROM room_aliases
+                WHERE room_aliases.room_id = rooms.id
+            ), ''))
+            FROM rooms
+        ''')
+        cur.execute('''
+            CREATE TRIGGER IF NOT EXISTS rooms_fts_delete AFTER DELETE ON rooms
+            BEGIN
+                DELETE FROM rooms_fts WHERE rowid = OLD.id;
+            END
+        ''')
+
+
+def _migration_discovery(cur):
+    # Lets discovery read only the rooms that changed since its last pass
+    cur.execute('CREATE INDEX IF NOT EXISTS rooms_updated_at ON rooms (updated_at)')
+
+
+def _migration_room_fingerprints(cur):
+    # What each server's room directory looked like when it was last crawled, so unchanged directories can be skipped
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS room_directories (
+            host_id             INTEGER PRIMARY KEY,
+            total_estimate      INTEGER,
+            first_page_hash     TEXT,
+            etag                TEXT,
+            last_modified       TEXT,
+            full_crawl_at       REAL,
+            crawled_at          REAL,
+            changed_at          REAL,
+            FOREIGN KEY(host_id) REFERENCES delegated_data(id)
+        )
+    ''')
+
+
+def _migration_removed_hosts(cur):
+    # Hosts deleted from delegated_data, so map clients loading changes since a time also learn what to drop
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS removed_hosts (
+            hostname            TEXT PRIMARY KEY,
+            removed_at          REAL
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS removed_hosts_removed_at ON removed_hosts (removed_at)')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS delegated_data_removed AFTER DELETE ON delegated_data BEGIN
+            INSERT OR REPLACE INTO removed_hosts (hostname, removed_at) VALUES (old.hostname, (julianday('now') - 2440587.5) * 86400.0);
+        END
+    ''')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS delegated_data_readded AFTER INSERT ON delegated_data BEGIN
+            DELETE FROM removed_hosts WHERE hostname = new.hostname;
+        END
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS delegated_data_changed_at ON delegated_data (changed_at)')
+
+
+def _migration_addresses(cur):
+    # Every IPv4 and IPv6 address of each server, not only the one in delegated_ip
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS delegated_addresses (
+            host_id             INTEGER,
+            address             TEXT,
+            first_seen          REAL,
+            PRIMARY KEY (host_id, address),
+            FOREIGN KEY(host_id) REFERENCES delegated_data(id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS delegated_addresses_address ON delegated_addresses (address)')
+    cur.execute('''
+        CREATE TRIGGER IF NOT EXISTS delegated_data_addresses_removed AFTER DELETE ON delegated_data BEGIN
+            DELETE FROM delegated_addresses WHERE host_id = old.id;
+        END
+    ''')
+
+    # Seed with the one address known so far
+    cur.execute('''
+        INSERT OR IGNORE INTO delegated_addresses (host_id, address, first_seen)
+        SELECT id, delegated_ip, first_seen FROM delegated_data
+        WHERE delegated_ip IS NOT NULL
+    ''')
+
+
+def _migration_discovered_hosts(cur):
+    # Every name discovery handed out and how far it read the rooms, so names are found once, not on every pass
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS discovered_hosts (
+            hostname            TEXT PRIMARY KEY,
+            discovered_at       REAL
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS discovery_progress (
+            id                  INTEGER PRIMARY KEY CHECK (id = 1),
+            rooms_read_until    REAL
+        )
+    ''')
+
+
+MIGRATIONS = (
+    _migration_base_schema,
+    _migration_work_queues,
+    _migration_indexes,
+    _migration_history,
+    _migration_stats,
+    _migration_room_search,
+    _migration_room_dedup,
+    _migration_discovery,
+    _migration_room_fingerprints,
+    _migration_removed_hosts,
+    _migration_addresses,
+    _migration_discovered_hosts,
+)
+
+
+## Functions
+
+@contextlib.contextmanager
+def transaction(conn):
+    """Run a block of statements in a write transaction
+
+    Takes the write lock up front, so the block never fails half way with database is locked.
+    Commits if the block finishes and rolls back if it raises. Nested use joins the outer transaction.
+
+    Args:
+        conn: A connection from connect().
+    """
+
+    if conn.in_transaction:
+        yield(conn)
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield(conn)
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+def has_table(conn, table):
+    """Check if a table exists
+
+    Args:
+        conn: A connection from connect().
+        table: Table name.
+
+    Returns:
+        True if the table exists.
+    """
+
+    row = conn.execute('''
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'table' AND name = ?
+    ''', (table,)).fetchone()
+    return(row is not None)
+
+
+def migrate(conn):
+    """Apply any migrations the database has not had yet
+
+    Args:
+        conn: A connection from connect().
+
+    Returns:
+        The schema version after migrating.
+    """
+
+    with transaction(conn):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS, 1):
+            if number <= version:
+                continue
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {number}')
+            version = number
+    return(version)
+
+
+def connect(db_file_path):
+    """Get the connection to a database for the current thread
+
+    Connections are opened once per thread and database, tuned with PRAGMAS, and migrated to the latest
+    schema the first time a database is opened in this process. They run in autocommit mode, so writes
+    must be wrapped in transaction().
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+
+    Returns:
+        An sqlite3 connection.
+    """
+
+    connections = getattr(_connections, 'by_path', None)
+    if connections is None:
+        connections = _connections.by_path = {}
+
+    conn = connections.get(db_file_path)
+    if conn is not None:
+        return(conn)
+
+    conn = sqlite3.connect(db_file_path, timeout=30, isolation_level=None, cached_statements=CACHED_STATEMENTS)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    with _migrate_lock:
+        if db_file_path not in _migrated:
+            migrate(conn)
+            _migrated.add(db_file_path)
+
+    connections[db_file_path] = conn
+    return(conn)
+
+
+def connect_readonly(db_file_path):
+    """Get a read only connection to a database for the current thread
+
+    For readers that must never change the database, like the map API. Nothing is migrated, so the schema has
+    to be up to date already.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+
+    Returns:
+        An sqlite3 connection that cannot write.
+
+    Raises:
+        sqlite3.OperationalError: If the database does not exist or its schema is older than this code.
+    """
+
+    uri = f'file:{urllib.request.pathname2url(os.path.abspath(db_file_path))}?mode=ro'
+    connections = getattr(_connections, 'by_path', None)
+    if connections is None:
+        connections = _connections.by_path = {}
+
+    conn = connections.get(uri)
+    if conn is not None:
+        return(conn)
+
+    conn = sqlite3.connect(uri, uri=True, timeout=30, isolation_level=None, cached_statements=CACHED_STATEMENTS)
+    try:
+        conn.execute('PRAGMA busy_timeout = 30000')
+        conn.execute('PRAGMA query_only = ON')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+    except sqlite3.Error:
+        conn.close()
+        raise
+    if version < len(MIGRATIONS):
+        conn.close()
+        raise sqlite3.OperationalError(f'schema version is {version}, {len(MIGRATIONS)} is needed. '
+                                       'Run the scanner once to upgrade it')
+
+    connections[uri] = conn
+    return(conn)
+
+
+def close(db_file_path=None):
+    """Close the current thread's connections
+
+    Args:
+        db_file_path: Only close the connection to this database. Default all of them
+    """
+
+    connections = getattr(_connections, 'by_path', {})
+    for path in list(connections):
+        if db_file_path is None or path == db_file_path:
+            connections.pop(path).close()
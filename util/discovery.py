@@ -0,0 +1,185 @@
+## Import modules
+import time
+
+## Import other python files
+from . import database
+from . import import_hostnames
+from . import work_queue
+
+
+## Settings
+
+# How many rooms or discovered names to read per step. Bounds memory however many rooms or known hosts there are
+CHUNK_SIZE = 5000
+
+# Each pass re-reads rooms updated this many seconds before where the last pass stopped. Room writes take their
+# timestamp before they commit, so a room can turn up with a time an earlier pass already read past
+OVERLAP_SECONDS = 300
+
+
+## Functions
+
+def server_name(identifier):
+    """Get the hostname from a Matrix identifier
+
+    Args:
+        identifier: A room ID, room alias or user ID, like #room:example.org or !abc:example.org:8448.
+
+    Returns:
+        The server part as a canonical hostname from import_hostnames.normalize_hostname. None if the identifier
+        has no usable server part.
+    """
+
+    if not identifier or ':' not in identifier:
+        return(None)
+    return(import_hostnames.normalize_hostname(identifier))
+
+
+def stored_hostname(hostname):
+    """Get a canonical hostname the way write_delegated stores it, without the port
+
+    Args:
+        hostname: A hostname from import_hostnames.normalize_hostname, like example.org:8443 or [2001:db8::1].
+
+    Returns:
+        The host part, with IPv6 addresses in brackets. None if the hostname can not be split.
+    """
+
+    split = import_hostnames.split_host_port(hostname)
+    if split is None:
+        return(None)
+    host = split[0].lower()
+    return(f'[{host}]' if ':' in host else host)
+
+
+def _is_known(conn, hostname):
+    """Check if a canonical hostname has been probed successfully or is waiting in the work queue"""
+
+    row = conn.execute('''
+        SELECT EXISTS (SELECT 1 FROM delegated_data WHERE hostname = ?)
+        OR EXISTS (SELECT 1 FROM work_queue WHERE hostname = ?)
+    ''', (stored_hostname(hostname), hostname)).fetchone()
+    return(bool(row[0]))
+
+
+def _rooms_after(conn, since, after, limit):
+    """Get the next chunk of rooms updated since a timestamp, with their aliases
+
+    Rooms are read in (updated_at, id) order, so a chunk can start where the last one stopped without
+    keeping a cursor open while the caller writes.
+
+    Returns:
+        List of (updated_at, id, [identifiers]).
+    """
+
+    rooms = conn.execute('''
+        SELECT updated_at, id, room_id, canonical_alias FROM rooms
+        WHERE updated_at >= ?
+        AND (updated_at, id) > (?, ?)
+        ORDER BY updated_at, id
+        LIMIT ?
+    ''', (since, after[0], after[1], limit)).fetchall()
+    if not rooms:
+        return([])
+
+    aliases = {}
+    for room_id, alias in conn.execute(f'''
+        SELECT room_id, alias FROM room_aliases
+        WHERE room_id IN ({', '.join('?' * len(rooms))})
+    ''', [room[1] for room in rooms]):
+        aliases.setdefault(room_id, []).append(alias)
+
+    return([(updated_at, id, [room_id, canonical_alias] + aliases.get(id, []))
+            for updated_at, id, room_id, canonical_alias in rooms])
+
+
+def _read_rooms(conn, chunk_size):
+    """Add the unknown server names of rooms updated since the last pass to discovered_hosts
+
+    Each chunk of names is written in one transaction together with how far the rooms have been read, so a pass
+    that stops half way loses nothing.
+    """
+
+    row = conn.execute('SELECT rooms_read_until FROM discovery_progress WHERE id = 1').fetchone()
+    since = max(row[0] - OVERLAP_SECONDS, 0) if row else 0
+    after = (since, 0)
+    while True:
+        rooms = _rooms_after(conn, since, after, chunk_size)
+        if not rooms:
+            return
+        after = rooms[-1][:2]
+
+        candidates = {server_name(identifier) for room in rooms for identifier in room[2]}
+        candidates.discard(None)
+        hostnames = [hostname for hostname in candidates if not _is_known(conn, hostname)]
+
+        with database.transaction(conn):
+            now = time.time()
+            conn.executemany('''
+                INSERT OR IGNORE INTO discovered_hosts (hostname, discovered_at)
+                VALUES (?, ?)
+            ''', ((hostname, now) for hostname in hostnames))
+            conn.execute('''
+                INSERT INTO discovery_progress (id, rooms_read_until) VALUES (1, ?)
+                ON CONFLICT (id) DO UPDATE SET rooms_read_until = max(rooms_read_until, excluded.rooms_read_until)
+            ''', (after[0],))
+
+
+def discover_hostnames(db_file_path, chunk_size=CHUNK_SIZE):
+    """Find hostnames in crawled room data that have never been probed
+
+    Server names are taken from room IDs, canonical aliases and aliases of rooms updated since the last pass, and
+    kept in discovered_hosts. A name stays there, and is handed out again on every pass, until it has been probed
+    successfully or is in the work queue. A probe that failed or a run that stopped half way therefore does not
+    lose it. Names are checked with index lookups, so neither delegated_data nor the work queue is loaded into
+    memory. Hostnames are compared the way write_delegated stores them, so example.org:8443 is known once
+    example.org has been probed.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        chunk_size: How many rooms or names to read per step. Default CHUNK_SIZE
+
+    Yields:
+        Lists of hostnames to probe, at most chunk_size per list.
+    """
+
+    conn = database.connect(db_file_path)
+    _read_rooms(conn, chunk_size)
+
+    after = ''
+    while True:
+        pending = [row[0] for row in conn.execute('''
+            SELECT hostname FROM discovered_hosts
+            WHERE hostname > ?
+            ORDER BY hostname
+            LIMIT ?
+        ''', (after, chunk_size))]
+        if not pending:
+            return
+        after = pending[-1]
+
+        hostnames = []
+        known = []
+        for hostname in pending:
+            (known if _is_known(conn, hostname) else hostnames).append(hostname)
+        if known:
+            with database.transaction(conn):
+                conn.executemany('DELETE FROM discovered_hosts WHERE hostname = ?', ((hostname,) for hostname in known))
+        if hostnames:
+            yield(hostnames)
+
+
+def enqueue_discovered(db_file_path):
+    """Add hostnames found in crawled rooms that have never been probed to the work queue
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+
+    Returns:
+        How many hostnames were new.
+    """
+
+    added = 0
+    for hostnames in discover_hostnames(db_file_path):
+        added += work_queue.enqueue(db_file_path, hostnames, 'discovery')
+    return(added)
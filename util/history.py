@@ -0,0 +1,125 @@
+## Import modules
+import re
+import time
+
+## Import other python files
+from . import database
+
+
+## Functions
+
+def version_key(version):
+    """Turn a version string into something that sorts by release
+
+    Args:
+        version: A version string like 1.45.0 or 1.45.0rc1 (b=master,abc123).
+
+    Returns:
+        A tuple of the leading numbers in the version.
+    """
+
+    match = re.match(r'\s*v?(\d+(?:\.\d+)*)', str(version))
+    if not match:
+        return(())
+    return(tuple(int(part) for part in match.group(1).split('.')))
+
+
+def version_distribution(db_file_path, at=None, max_age=7 * 24 * 3600, name=None):
+    """Count hosts per version at a point in time
+
+    Uses the version each host had at that time, counting hosts that were seen again no longer than max_age before it.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        at: Unix timestamp. Default now
+        max_age: Seconds. Hosts last seen longer than this before at are left out. Default a week
+        name: Only count hosts running this server implementation, like Synapse. Default all
+
+    Returns:
+        List of (version, number of hosts), most common first.
+    """
+
+    if at is None:
+        at = time.time()
+
+    conn = database.connect(db_file_path)
+    query = '''
+        SELECT history.value, count(*) AS hosts
+        FROM delegated_history AS history
+        JOIN (
+            SELECT hostname, max(observed_at) AS observed_at
+            FROM delegated_history
+            WHERE attribute = 'version' AND observed_at <= ?
+            GROUP BY hostname
+        ) AS latest
+        ON history.hostname = latest.hostname AND history.observed_at = latest.observed_at
+        JOIN delegated_data AS data
+        ON data.hostname = history.hostname
+        WHERE history.attribute = 'version'
+        AND data.last_seen >= ?
+    '''
+    parameters = [at, at - max_age]
+    if name:
+        query += ' AND data.name = ?'
+        parameters.append(name)
+    query += ' GROUP BY history.value ORDER BY hosts DESC'
+
+    return(conn.execute(query, parameters).fetchall())
+
+
+def version_changes(db_file_path, since, until=None, upgrades_only=True):
+    """Get hosts whose version changed in a time window
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        since: Unix timestamp where the window starts.
+        until: Unix timestamp where the window ends. Default now
+        upgrades_only: Only return changes to a higher version. Default True
+
+    Returns:
+        List of (hostname, old version, new version, unix timestamp of the change), oldest first.
+    """
+
+    if until is None:
+        until = time.time()
+
+    conn = database.connect(db_file_path)
+    changes = conn.execute('''
+        SELECT hostname, previous, value, observed_at FROM (
+            SELECT hostname, value, observed_at,
+                   LAG(value) OVER (PARTITION BY hostname ORDER BY observed_at) AS previous
+            FROM delegated_history
+            WHERE attribute = 'version'
+            AND hostname IN (
+                SELECT hostname FROM delegated_history
+                WHERE attribute = 'version' AND observed_at BETWEEN ? AND ?
+            )
+        )
+        WHERE observed_at BETWEEN ? AND ?
+        AND previous IS NOT NULL
+        AND previous != value
+        ORDER BY observed_at
+    ''', (since, until, since, until)).fetchall()
+
+    if upgrades_only:
+        changes = [change for change in changes if version_key(change[2]) > version_key(change[1])]
+    return(changes)
+
+
+def host_history(db_file_path, hostname):
+    """Get every recorded change for a host
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        hostname: A hostname as stored in delegated_data.
+
+    Returns:
+        List of (unix timestamp, attribute, value), oldest first.
+    """
+
+    conn = database.connect(db_file_path)
+    return(conn.execute('''
+        SELECT observed_at, attribute, value FROM delegated_history
+        WHERE hostname = ?
+        ORDER BY observed_at, id
+    ''', (hostname.lower(),)).fetchall())
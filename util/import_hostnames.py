@@ -1,12 +1,174 @@
 ## Import modules
-import json
+import ipaddress
 import os
-import psycopg2
+import re
+
+## Import other python files
+from . import shodan_cache
+
+
+## Settings
+
+# The federation port servers listen on when nothing else is delegated. Left out of canonical hostnames
+DEFAULT_PORT = 8448
+
+# One DNS label after IDNA encoding
+LABEL_PATTERN = re.compile(r'^[a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?$')
 
 
 ## Functions
 
-def get_hostnames_from_postgres(server, port, database, username, password, limit=None, ):
+def split_host_port(hostname):
+    """Split a hostname into host and port
+
+    Handles bracketed IPv6 addresses with and without a port, and bare IPv6 addresses without one.
+
+    Args:
+        hostname: Like example.org, example.org:8448, [2001:db8::1]:8448 or 2001:db8::1.
+
+    Returns:
+        A tuple of (host, port). Port is None if there was none. IPv6 hosts are returned without brackets.
+        None if the hostname can not be split.
+    """
+
+    if hostname.startswith('['):
+        host, bracket, rest = hostname[1:].partition(']')
+        if not bracket or (rest and not rest.startswith(':')):
+            return(None)
+        port = rest[1:] or None
+    elif hostname.count(':') > 1:
+        host, port = hostname, None
+    else:
+        host, _, port = hostname.partition(':')
+        port = port or None
+
+    if port is not None:
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            return(None)
+        port = int(port)
+    return((host, port))
+
+
+def normalize_hostname(hostname):
+    """Turn anything that names a Matrix server into one canonical hostname
+
+    Strips whitespace, URL schemes, paths, queries and fragments, and takes the server part of Matrix IDs like
+    !room:server, #alias:server and @user:server. Hostnames are lower cased and IDNA encoded, trailing dots
+    and the default port 8448 are dropped, and IPv6 addresses are compressed and put in brackets.
+    Names with one label, like localhost, can not be federated with and are dropped.
+
+    Args:
+        hostname: A hostname, URL or Matrix ID from any source.
+
+    Returns:
+        The canonical hostname, like example.org, example.org:8443 or [2001:db8::1]. None if it is not valid.
+    """
+
+    hostname = str(hostname).strip()
+
+    # Matrix IDs. The server part is everything after the first colon
+    if hostname[:1] in ('!', '#', '@', '+', '$'):
+        _, colon, hostname = hostname.partition(':')
+        if not colon:
+            return(None)
+
+    # URLs
+    if '://' in hostname:
+        hostname = hostname.split('://', 1)[1]
+    for separator in ('/', '?', '#'):
+        hostname = hostname.split(separator, 1)[0]
+    if '@' in hostname:
+        hostname = hostname.rsplit('@', 1)[1]
+
+    parts = split_host_port(hostname)
+    if not parts:
+        return(None)
+    host, port = parts
+    host = host.rstrip('.').lower()
+
+    # IP addresses
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        address = None
+    if address:
+        host = f'[{address.compressed}]' if address.version == 6 else address.compressed
+
+    # DNS names
+    else:
+        if not host.isascii():
+            try:
+                host = host.encode('idna').decode('ascii')
+            except UnicodeError:
+                return(None)
+        labels = host.split('.')
+        if len(labels) < 2 or len(host) > 253 or not all(LABEL_PATTERN.match(label) for label in labels):
+            return(None)
+
+    if port and port != DEFAULT_PORT:
+        return(f'{host}:{port}')
+    return(host)
+
+
+def iter_hostnames_from_postgres(server, port, database, username, password, limit=None, batch_size=10000):
+    """Stream hostnames from PostgreSQL
+
+    Reads table destinations through a server side cursor, so only one batch is held in memory.
+
+    Args:
+        server: IP or fqdn for PostgreSQL server
+        port: Port to talk to server on
+        database: Which database to look in
+        username: Username to authenticate with
+        password: Password to authenticate with
+        limit: Limit number of results for testing or debugging purposes. Default None
+        batch_size: How many rows to fetch at a time. Default 10000
+
+    Yields:
+        Lists of hostnames stripped of whitespace.
+
+    Raises:
+        psycopg2.Error: If connecting or querying fails.
+    """
+
+    # Only needed when PostgreSQL is enabled, and slow to import
+    import psycopg2
+
+    connection = psycopg2.connect(user=username, password=password, host=server, port=port, database=database, connect_timeout=3)
+    try:
+        cursor = connection.cursor(name='destinations')
+        if limit:
+            cursor.execute('SELECT destination FROM destinations LIMIT %s', (limit,))
+        else:
+            cursor.execute('SELECT destination FROM destinations')
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield([row[0].strip() for row in rows])
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def postgres_error(error, interactive=True):
+    """Report an error from PostgreSQL
+
+    Args:
+        error: The exception.
+        interactive: Ask whether to continue, and exit if the answer is not yes. Default True
+    """
+
+    print ('Error while fetching data from PostgreSQL', error)
+    if not interactive:
+        return
+    cont = input('\nType yes if you would like to continue, or no to exit: ')
+    if cont.lower() != 'yes':
+        exit(0)
+
+
+def get_hostnames_from_postgres(server, port, database, username, password, limit=None, interactive=True):
     """Get hostnames from PostgreSQL
 
     Try and connect to PostgreSQL database, then get hostnames from table destinations.
@@ -19,57 +181,63 @@ def get_hostnames_from_postgres(server, port, database, username, password, limi
         username: Username to authenticate with
         password: Password to authenticate with
         limit: Limit number of results for testing or debugging purposes. Default None
+        interactive: Ask whether to continue if an error occurred. If False, just return None. Default True
 
     Returns:
         List of hostnames. None if any error occurred or destinations table is empty
     """
 
-    temp = []
-
     # Try and get stuff from the datbase
+    hostnames = []
     try:
-        connection = psycopg2.connect(user=username, password=password, host=server, port=port, database=database, connect_timeout=3)
-        cursor = connection.cursor()
+        for batch in iter_hostnames_from_postgres(server, port, database, username, password, limit):
+            hostnames.extend(batch)
 
-        if limit:
-            postgre_select_query = f'SELECT destination FROM destinations LIMIT {limit}'
-        else:
-            postgre_select_query = 'SELECT destination FROM destinations'
+    # If any error, print the error and return None
+    except Exception as error:
+        postgres_error(error, interactive)
+        return(None)
 
-        cursor.execute(postgre_select_query)
-        mobile_records = cursor.fetchall() 
-        
-        for row in mobile_records:
-            temp.append(row[0])
+    if len(hostnames) < 1:
+        print("Destinations table is empty")
+        return(None)
+    return(hostnames)
 
-    # If any error, print the error and return None
-    except (Exception, psycopg2.Error) as error :
-        print ('Error while fetching data from PostgreSQL', error)
-        cont = input('\nType yes if you would like to continue, or no to exit: ')
-        if cont.lower() == 'yes':
-            return(None)
-        exit(0)
-    
-    # If no errors, return stuff
-    else:
-        if len(temp) < 1:
-            print("Destinations table is empty")
-            return(None)
-        else:
-            hostnames = []
-            for x in temp:
-                hostnames.append(x.strip())
-            return(hostnames)
 
-    # Close database connection
-    finally:
-        try:
-            if(connection):
-                cursor.close()
-                connection.close()
-        except UnboundLocalError:
-            pass
+def iter_hostnames_file(file_path):
+    """Stream hostnames from a file, one line at a time
 
+    Args:
+        file_path: Full path to a text file. LF style new line separated.
+
+    Yields:
+        Every line stripped of whitespace. Nothing if the file does not exist.
+    """
+
+    if not os.path.isfile(file_path):
+        return
+    with open(file_path, 'r') as f:
+        for line in f:
+            yield(line.strip())
+
+
+def iter_shodan_file(file_path, processes=None):
+    """Stream IP addresses from a Shodan export, through its cache
+
+    Args:
+        file_path: Full path to a Shodan data export json file.
+        processes: How many processes to parse the export with if the cache must be built. Default one per CPU core
+
+    Yields:
+        IP addresses as strings. Nothing if the file does not exist.
+    """
+
+    cache = shodan_cache.open_cache(file_path, processes=processes)
+    if cache is None:
+        return
+    with cache:
+        for index in range(len(cache)):
+            yield(cache.ip(index))
 
 
 def load_hostnames_file(file_path):
@@ -100,35 +268,28 @@ def load_hostnames_file(file_path):
     return(lines)
 
 
-def load_shodan_file(file_path):
+def load_shodan_file(file_path, processes=None):
     """Load Shodan export file
 
     If supplied Shodan export file file exist, load IP addresses from it to a list.
+    The export is converted to a compact cache on first use, and the cache is used until the export changes.
 
     Args:
         file_path: Full path to a Shodan data export json file.
+        processes: How many processes to parse the export with if the cache must be built. Default one per CPU core
     
     Returns:
         All IP addresses from said file. Or None if file does not exist.
     """
 
     # Check if the file exist
-    if not os.path.isfile(file_path):
+    cache = shodan_cache.open_cache(file_path, processes=processes)
+    if cache is None:
         return(None)
-    
-    # Else load the file
-    f = open(file_path, 'r')
-    temp = [line for line in f]
-    f.close()
 
     # Extract IPs
-    lines = []
-    for line in temp:
-        data = json.loads(line)
-        if data['transport'] == 'tcp':
-            lines.append(str(data['ip_str']).strip())
-    
-    return(lines)
+    with cache:
+        return(cache.ips())
 
 
 def file_len(f_name):
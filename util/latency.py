@@ -0,0 +1,143 @@
+## Import modules
+import collections
+import math
+import threading
+
+
+## Classes
+
+class LatencyTracker:
+    """Track observed latencies for one probe phase and derive timeouts from them
+
+    Keeps a sliding window of connect and read latencies. Requests that timed out are kept at the timeout they
+    hit, as a lower bound of their latency, so the percentile does not drift down to the servers fast enough to
+    answer. Until enough samples have been seen the default timeouts are used. After that the timeouts are a
+    latency percentile multiplied by a factor, clamped between the defaults or minimum, whichever is longer, and
+    a maximum.
+
+    Args:
+        default_connect: Connect timeout in seconds to use until enough samples are collected, and the shortest
+            connect timeout ever used.
+        default_read: Read timeout in seconds to use until enough samples are collected, and the shortest read
+            timeout ever used.
+        percentile: Which percentile of the observed latencies to base the timeouts on. Default 99
+        factor: Multiply the percentile latency by this to get the timeout. Default 2
+        minimum: Never return a timeout shorter than this many seconds. Default 0.5
+        maximum: Never return a timeout longer than this many seconds. Default 10
+        window: How many of the most recent samples to keep. Default 1000
+        min_samples: How many samples are needed before timeouts adapt. Default 50
+    """
+
+    def __init__(self, default_connect, default_read, percentile=99, factor=2, minimum=0.5, maximum=10,
+                 window=1000, min_samples=50):
+        self.default_connect = default_connect
+        self.default_read = default_read
+        self.percentile_value = percentile
+        self.factor = factor
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_samples = min_samples
+
+        self._samples = {
+            'connect': collections.deque(maxlen=window),
+            'read': collections.deque(maxlen=window),
+            'total': collections.deque(maxlen=window),
+        }
+        self._lock = threading.Lock()
+
+        # Sorting the window on every request is wasteful, so the timeouts are only recalculated
+        # after every refresh_every new samples
+        self._refresh_every = max(window // 20, 1)
+        self._since_refresh = 0
+        self._cached_timeout = None
+
+
+    def configure(self, percentile=None, factor=None, minimum=None, maximum=None):
+        """Change how timeouts are derived
+
+        Args:
+            percentile: Which percentile of the observed latencies to base the timeouts on.
+            factor: Multiply the percentile latency by this to get the timeout.
+            minimum: Never return a timeout shorter than this many seconds.
+            maximum: Never return a timeout longer than this many seconds.
+        """
+
+        with self._lock:
+            if percentile is not None:
+                self.percentile_value = percentile
+            if factor is not None:
+                self.factor = factor
+            if minimum is not None:
+                self.minimum = minimum
+            if maximum is not None:
+                self.maximum = maximum
+            self._cached_timeout = None
+
+
+    def record(self, connect, read):
+        """Record the latency of a request
+
+        For a request that timed out, pass the timeout it hit.
+
+        Args:
+            connect: Seconds spent setting up the connection, including TLS. None if a pooled connection was reused.
+            read: Seconds spent waiting for the response after the connection was set up. None if the connection
+                timed out.
+        """
+
+        with self._lock:
+            if connect is not None:
+                self._samples['connect'].append(connect)
+            if read is not None:
+                self._samples['read'].append(read)
+                self._samples['total'].append((connect or 0) + read)
+            self._since_refresh += 1
+            if self._since_refresh >= self._refresh_every:
+                self._cached_timeout = None
+
+
+    def percentile(self, percentile, phase='total'):
+        """Get a percentile of the observed latencies
+
+        Args:
+            percentile: Which percentile to return, between 0 and 100.
+            phase: connect, read or total. Default total
+
+        Returns:
+            Latency in seconds. Or None if not enough samples have been collected yet.
+        """
+
+        with self._lock:
+            samples = sorted(self._samples[phase])
+
+        if len(samples) < self.min_samples:
+            return(None)
+
+        index = min(math.ceil(len(samples) * percentile / 100) - 1, len(samples) - 1)
+        return(samples[max(index, 0)])
+
+
+    def _clamp(self, latency, default):
+        if latency is None:
+            return(default)
+        return(min(max(latency * self.factor, self.minimum, default), self.maximum))
+
+
+    def timeout(self):
+        """Get the current connect and read timeouts
+
+        Returns:
+            A tuple of (connect timeout, read timeout) in seconds, suitable for the requests timeout argument.
+        """
+
+        cached = self._cached_timeout
+        if cached:
+            return(cached)
+
+        connect = self._clamp(self.percentile(self.percentile_value, 'connect'), self.default_connect)
+        read = self._clamp(self.percentile(self.percentile_value, 'read'), self.default_read)
+
+        with self._lock:
+            self._cached_timeout = (connect, read)
+            self._since_refresh = 0
+        return((connect, read))
@@ -0,0 +1,126 @@
+## Import other python files
+from . import database
+from . import stats
+
+
+## Settings
+
+# Deltas reach this many seconds back past the time asked for. write_delegated takes its timestamp before it
+# gets the write lock, so a commit can land after a later timestamp was already handed out
+DELTA_OVERLAP_SECONDS = 300
+
+# Columns of a map point, in the order points are sent
+POINT_COLUMNS = ('hostname', 'latitude', 'longitude', 'name', 'version')
+
+# Columns of the server details
+SERVER_COLUMNS = ('hostname', 'delegated_hostname', 'delegated_ip', 'delegated_port', 'server_lookup_type', 'name',
+                  'version', 'valid_ssl', 'latitude', 'longitude', 'first_seen', 'last_seen', 'changed_at')
+
+
+## Functions
+
+def _as_of(conn):
+    """Get the time of the newest change to the map, for clients to ask for changes since"""
+
+    row = conn.execute('''
+        SELECT max(coalesce((SELECT max(changed_at) FROM delegated_data), 0),
+                   coalesce((SELECT max(removed_at) FROM removed_hosts), 0))
+    ''').fetchone()
+    return(row[0])
+
+
+def _coordinate(value):
+    return(float(value) if value not in (None, '') else None)
+
+
+def get_points(db_file_path, since=None):
+    """Get the servers to put on the map
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        since: Only get servers added or changed after this unix time, and the hostnames removed after it.
+            Default all servers
+
+    Returns:
+        A dict with as_of, the time to pass as since next time, points, a list of POINT_COLUMNS lists, and for
+        deltas removed, a list of hostnames. Latitude and longitude are None for servers without a location.
+    """
+
+    conn = database.connect_readonly(db_file_path)
+
+    # Read everything from one snapshot, so as_of matches the points
+    conn.execute('BEGIN')
+    try:
+        as_of = _as_of(conn)
+        query = f'SELECT {", ".join(POINT_COLUMNS)} FROM delegated_data'
+        parameters = []
+        if since is not None:
+            query += ' WHERE changed_at > ?'
+            parameters.append(since - DELTA_OVERLAP_SECONDS)
+        query += ' ORDER BY hostname'
+        points = [[hostname, _coordinate(latitude), _coordinate(longitude), name, version]
+                  for hostname, latitude, longitude, name, version in conn.execute(query, parameters)]
+
+        data = {'as_of': as_of, 'points': points}
+        if since is not None:
+            data['removed'] = [row[0] for row in conn.execute('''
+                SELECT hostname FROM removed_hosts
+                WHERE removed_at > ?
+                ORDER BY hostname
+            ''', (since - DELTA_OVERLAP_SECONDS,))]
+    finally:
+        conn.execute('COMMIT')
+    return(data)
+
+
+def get_server(db_file_path, hostname):
+    """Get everything known about one server
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        hostname: Hostname as stored in delegated_data.
+
+    Returns:
+        A dict of SERVER_COLUMNS plus rooms, the number of public rooms on the server, and addresses, every IPv4
+        and IPv6 address it had when last probed. None if it is not known.
+    """
+
+    conn = database.connect_readonly(db_file_path)
+    row = conn.execute(f'''
+        SELECT {", ".join(SERVER_COLUMNS)}, coalesce(room_counts.rooms, 0), delegated_data.id FROM delegated_data
+        LEFT JOIN room_counts ON room_counts.host_id = delegated_data.id
+        WHERE hostname = ?
+    ''', (hostname.lower(),)).fetchone()
+    if row is None:
+        return(None)
+    server = dict(zip(SERVER_COLUMNS + ('rooms',), row))
+    server['addresses'] = [address for (address,) in conn.execute('''
+        SELECT address FROM delegated_addresses
+        WHERE host_id = ?
+        ORDER BY address
+    ''', (row[-1],))]
+    server['latitude'] = _coordinate(server['latitude'])
+    server['longitude'] = _coordinate(server['longitude'])
+    return(server)
+
+
+def get_summary(db_file_path, limit=10):
+    """Get aggregate statistics from the summary tables
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        limit: How many of the servers with most rooms to include. Default 10
+
+    Returns:
+        A dict with hosts, valid_ssl_share, counts, a dict of dimension to [value, hosts] lists, and rooms,
+        a list of [hostname, rooms] lists.
+    """
+
+    conn = database.connect_readonly(db_file_path)
+    return({
+        'hosts': stats.query_total_hosts(conn),
+        'valid_ssl_share': stats.query_valid_ssl_share(conn),
+        'counts': {dimension: [list(row) for row in stats.query_counts(conn, dimension)]
+                   for dimension in stats.DIMENSIONS},
+        'rooms': [list(row) for row in stats.query_room_counts(conn, limit)],
+    })
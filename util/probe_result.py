@@ -0,0 +1,116 @@
+## Import modules
+import enum
+import sys
+import typing
+
+
+## Settings
+
+# One int object per valid port seen, shared by every result with that port. At most 65535 entries
+_ports = {}
+
+
+## Classes
+
+class ProbeError(enum.Enum):
+    """Why a probe did not find a Matrix server"""
+
+    CONNECTION = 'connection'                   # Could not connect, or the connection failed
+    HTTP_STATUS = 'http_status'                 # The version endpoint did not answer 200
+    INVALID_RESPONSE = 'invalid_response'       # The version endpoint did not answer with server name and version
+    INVALID_DELEGATION = 'invalid_delegation'   # Delegation pointed somewhere that can not be probed
+    INVALID_HOSTNAME = 'invalid_hostname'       # The hostname is not a valid server name
+    UNEXPECTED = 'unexpected'                   # The probe raised an error nobody planned for. It is logged
+
+
+class ProbeResult(typing.NamedTuple):
+    """The result of probing one hostname
+
+    A tuple with no per-instance dict, so millions of results stay small and can be compared, hashed and
+    deduplicated without building strings. Results with an error only have hostname and error set.
+    """
+
+    hostname: str
+    delegated_hostname: typing.Optional[str] = None
+    delegated_ip: typing.Optional[str] = None
+    delegated_port: typing.Optional[int] = None
+    server_lookup_type: typing.Optional[str] = None
+    name: typing.Optional[str] = None
+    version: typing.Optional[str] = None
+    valid_ssl: typing.Optional[bool] = None
+    addresses: typing.Optional[typing.Tuple[str, ...]] = None
+    error: typing.Optional[ProbeError] = None
+
+    @property
+    def ok(self):
+        """True if the probe found a Matrix server"""
+
+        return(self.error is None)
+
+
+    @classmethod
+    def found(cls, hostname, delegated_hostname, delegated_ip, delegated_port, server_lookup_type, name, version, valid_ssl,
+              addresses=None):
+        """Make a result for a probe that found a Matrix server
+
+        Values that many hosts have in common, like name, version and port, are interned, and the delegated
+        hostname shares the hostname string when they are the same. Each result then only holds its own
+        hostnames and IP addresses. Interned strings are freed again once no result uses them, so names and
+        versions made up by remote servers do not pile up.
+
+        Args:
+            addresses: Tuple of every IPv4 and IPv6 address of the delegated hostname. Default None, unknown
+        """
+
+        if delegated_hostname == hostname:
+            delegated_hostname = hostname
+        if 0 < delegated_port < 65536:
+            delegated_port = _ports.setdefault(delegated_port, delegated_port)
+        return(tuple.__new__(cls, (hostname,
+                                   delegated_hostname,
+                                   delegated_ip,
+                                   delegated_port,
+                                   sys.intern(server_lookup_type),
+                                   sys.intern(name),
+                                   sys.intern(version),
+                                   valid_ssl,
+                                   addresses,
+                                   None)))
+
+
+    @classmethod
+    def failure(cls, hostname, error):
+        """Make a result for a probe that failed
+
+        Args:
+            hostname: The probed hostname.
+            error: A ProbeError.
+        """
+
+        return(cls(hostname, error=error))
+
+
+    def to_json(self):
+        """Turn the result into a list that json can encode"""
+
+        return(list(self[:-1]) + [self.error.value if self.error else None])
+
+
+    @classmethod
+    def from_json(cls, data):
+        """Make a result from a list made by to_json
+
+        Lists from before addresses were added, one value shorter, are accepted too.
+
+        Raises:
+            ValueError: If data is not a list made by to_json.
+        """
+
+        if not isinstance(data, list) or len(data) not in (len(cls._fields), len(cls._fields) - 1):
+            raise ValueError(f'Expected a list of {len(cls._fields)} values')
+        if len(data) < len(cls._fields):
+            data = data[:-1] + [None] + data[-1:]
+        error = ProbeError(data[-1]) if data[-1] is not None else None
+        delegated_port = int(data[3]) if data[3] is not None else None
+        addresses = tuple(str(address) for address in data[8]) if data[8] is not None else None
+        return(cls(*data[:3], delegated_port, *data[4:8], addresses, error))
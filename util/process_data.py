@@ -1,9 +1,41 @@
 ## Import modules
+import hashlib
+import json
 import os
 import sqlite3
+import time
 
 ## Import other python files
+from . import database
 from . import resolve_hostname
+from . import shodan_cache
+from . import tracing
+
+
+## Settings
+
+# Columns of delegated_data that come from a probe result, in result order
+DELEGATED_COLUMNS = ('delegated_hostname', 'delegated_ip', 'delegated_port', 'server_lookup_type', 'name', 'version', 'valid_ssl')
+
+# Columns of rooms, and the publicRooms keys they come from
+ROOM_COLUMNS = ('canonical_alias', 'name', 'num_joined_members', 'topic', 'world_readable', 'guest_can_join', 'avatar_url', 'm_federate')
+ROOM_KEYS = ('canonical_alias', 'name', 'num_joined_members', 'topic', 'world_readable', 'guest_can_join', 'avatar_url', 'm.federate')
+
+# Where servers list their public rooms
+PUBLIC_ROOMS_PATH = '/_matrix/client/r0/publicRooms'
+# Rooms per page when crawling a room directory
+ROOM_PAGE_SIZE = 500
+# Stop paginating a room directory after this many pages
+MAX_ROOM_PAGES = 1000
+# Crawl every page of a directory at least this often, even if its first page looks unchanged
+FULL_CRAWL_SECONDS = 7 * 24 * 3600
+
+# Attributes whose changes are kept in delegated_history
+HISTORY_ATTRIBUTES = ('delegated_ip', 'delegated_port', 'name', 'version', 'valid_ssl')
+
+# write_locations looks this many seconds further back for new addresses. write_delegated takes its timestamp before
+# it gets the write lock, so addresses can be committed after a later write_locations started
+LOCATION_OVERLAP_SECONDS = 300
 
 
 ## Functions
@@ -29,139 +61,127 @@ def write_matrix_servers(db_file_path, line):
 def initialize_database(db_file_path):
     """Initialize SQLite database
 
-    Initialize SQLite3 database if needed
+    Initialize SQLite3 database if needed, by applying any schema migrations it has not had yet
 
     Args:
         db_file_path: Full path to SQLite3 database file.
     """
 
     try:
-        conn = sqlite3.connect(db_file_path)
-        cur = conn.cursor()
+        database.connect(db_file_path)
     except sqlite3.OperationalError as error:
         print('Error initializing database:', error)
         exit(1)
-    else:
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS delegated_data (
-                id                  INTEGER PRIMARY KEY AUTOINCREMENT,
-                hostname            TEXT,
-                delegated_hostname  TEXT,
-                delegated_ip        TEXT,
-                delegated_port      INTEGER,
-                server_lookup_type  TEXT,
-                name                TEXT,
-                version             TEXT,
-                valid_ssl           TEXT,
-                latitude            TEXT,
-                longitude           TEXT
-            )
-        ''')
-        cur.execute(''' 
-            CREATE TABLE IF NOT EXISTS public_rooms (
-                id                  INTEGER PRIMARY KEY AUTOINCREMENT,
-                host_id             INTEGER,
-                canonical_alias     TEXT,
-                name                TEXT,
-                num_joined_members  INTEGER,
-                room_id             TEXT,
-                topic               TEXT,
-                world_readable      TEXT,
-                guest_can_join      TEXT,
-                avatar_url          TEXT,
-                m_federate          TEXT,
-                FOREIGN KEY(host_id) REFERENCES delegated_data(id)
-            )
-        ''')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS aliases (
-                id                  INTEGER PRIMARY KEY AUTOINCREMENT,
-                room_id             INTEGER,
-                alias               TEXT,
-                FOREIGN KEY(room_id) REFERENCES public_rooms(id)
-            )
-        ''')
-    finally:
-        # Save and close database
-        conn.commit()
-        conn.close()
-
-
 
 
 def write_delegated(db_file_path, data):
     """Write delegated info to sqllite
 
-    Write delegated Matrix hostnames to a SQLite3 database
+    Write delegated Matrix hostnames to a SQLite3 database. Hosts that did not change only get last_seen bumped.
+    For hosts that did change, the changed attributes in HISTORY_ATTRIBUTES are appended to delegated_history.
 
     Args:
         db_file_path: Full path to SQLite3 database file.
-        data: Data to add to database
+        data: Iterable of ProbeResult. Results with an error are skipped.
     """
 
-    initialize_database(db_file_path)
-
     try:
-        conn = sqlite3.connect(db_file_path)
-        cur = conn.cursor()
+        conn = database.connect(db_file_path)
     except sqlite3.OperationalError as error:
         print('Error initializing database:', error)
         exit(1)
-    
-    # Loop over data list
-    for hostname in data:
-        # host_list
-        #   0 hostname
-        #   1 delegated_hostname
-        #   2 delegated_ip
-        #   3 delegated port
-        #   4 serer_lookup_type
-        #   5 name
-        #   6 version
-        #   7 valid_ssl
-        host_list = hostname.split(';')
-        host_list[0] = str(host_list[0]).lower()
-
-        # Check if hostname already exist. If yes; delete old record
-        for row in cur.execute(f'''
-            SELECT count(hostname)
-            FROM delegated_data
-            WHERE hostname = "{host_list[0]}"
-        '''):
-            count = row[0]
-        
-        if count > 0:
-            cur.execute(f'''
-                DELETE FROM delegated_data
-                WHERE hostname = "{host_list[0]}"
-            ''')
-        
-        # Insert datapoint into database
-        cur.execute(f'''
-            INSERT INTO delegated_data 
-            (hostname, delegated_hostname, delegated_ip, delegated_port, server_lookup_type, name, version, valid_ssl)
-            VALUES (
-                "{host_list[0]}",
-                "{host_list[1]}",
-                "{host_list[2]}",
-                "{host_list[3]}",
-                "{host_list[4]}",
-                "{host_list[5]}",
-                "{host_list[6]}",
-                "{host_list[7]}"
-            )
-        ''')
 
-    # Save and close database
-    conn.commit()
-    conn.close()
+    now = time.time()
+    unchanged = []
+
+    with database.transaction(conn):
+        # Loop over the results. Failed probes have nothing to write
+        for result in data:
+            if not result.ok:
+                continue
+            hostname = result.hostname.lower()
+            new = {column: getattr(result, column) for column in DELEGATED_COLUMNS}
+            new['valid_ssl'] = 'yes' if result.valid_ssl else 'no'
+
+            row = conn.execute(f'''
+                SELECT {', '.join(DELEGATED_COLUMNS)} FROM delegated_data
+                WHERE hostname = ?
+            ''', (hostname,)).fetchone()
+
+            # New host. Insert it and record all of its attributes
+            if row is None:
+                conn.execute(f'''
+                    INSERT INTO delegated_data
+                    (hostname, {', '.join(DELEGATED_COLUMNS)}, first_seen, last_seen, changed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [hostname] + list(new.values()) + [now, now, now])
+                changed = HISTORY_ATTRIBUTES
+
+            else:
+                old = dict(zip(DELEGATED_COLUMNS, row))
+                changed_columns = [column for column in DELEGATED_COLUMNS if old[column] != new[column]]
+
+                # Nothing changed, only bump last_seen
+                if not changed_columns:
+                    unchanged.append((now, hostname))
+                    if result.addresses is not None:
+                        write_addresses(conn, hostname, result.addresses, now)
+                    continue
+
+                assignments = ', '.join(f'{column} = ?' for column in changed_columns)
+                conn.execute(f'''
+                    UPDATE delegated_data
+                    SET {assignments}, last_seen = ?, changed_at = ?
+                    WHERE hostname = ?
+                ''', [new[column] for column in changed_columns] + [now, now, hostname])
+                changed = [attribute for attribute in HISTORY_ATTRIBUTES if attribute in changed_columns]
+
+            conn.executemany('''
+                INSERT INTO delegated_history
+                (hostname, observed_at, attribute, value)
+                VALUES (?, ?, ?, ?)
+            ''', ((hostname, now, attribute, new[attribute]) for attribute in changed))
+
+            if result.addresses is not None:
+                write_addresses(conn, hostname, result.addresses, now)
+
+        conn.executemany('''
+            UPDATE delegated_data
+            SET last_seen = ?
+            WHERE hostname = ?
+        ''', unchanged)
+
+
+def write_addresses(conn, hostname, addresses, now):
+    """Replace the addresses stored for a host, if they changed
+
+    Args:
+        conn: A connection from database.connect, in a transaction.
+        hostname: Hostname as stored in delegated_data.
+        addresses: Every IPv4 and IPv6 address the host has now.
+        now: Unix time to record new addresses as first seen at.
+    """
+
+    host_id = conn.execute('SELECT id FROM delegated_data WHERE hostname = ?', (hostname,)).fetchone()[0]
+    stored = {row[0] for row in conn.execute('SELECT address FROM delegated_addresses WHERE host_id = ?', (host_id,))}
+    addresses = set(addresses)
+    if stored == addresses:
+        return
+
+    conn.executemany('''
+        DELETE FROM delegated_addresses
+        WHERE host_id = ? AND address = ?
+    ''', ((host_id, address) for address in stored - addresses))
+    conn.executemany('''
+        INSERT INTO delegated_addresses (host_id, address, first_seen) VALUES (?, ?, ?)
+    ''', ((host_id, address, now) for address in addresses - stored))
 
 
 def purge_db_duplicates(db_file_path):
     """Remove duplicated from database
     
     - Get all IP addresses from database where server_lookup_type = ip
-    - If the IP exist again for a host with server_lookup_type not = ip then
+    - If the IP is any address of a host with server_lookup_type not = ip then
         - delete the address with server_lookup_type = ip
     
     Args:
@@ -170,149 +190,470 @@ def purge_db_duplicates(db_file_path):
 
     # Connect to database
     try:
-        conn = sqlite3.connect(db_file_path)
-        cur = conn.cursor()
+        conn = database.connect(db_file_path)
     except sqlite3.OperationalError as error:
         print('Error initializing database:', error)
         exit(1)
-    
-    # Get all where server_lookup_type = ip
-    ip_only = []
-    for row in cur.execute('''
-        SELECT delegated_ip FROM delegated_data
-        WHERE server_lookup_type = "ip"
-    '''):
-        ip_only.append(row[0])
-
-    for ip in ip_only:
-        cur.execute(f'''
+
+    with database.transaction(conn):
+        # IPv6 hostnames are stored in brackets, addresses without
+        conn.execute('''
             DELETE FROM delegated_data
-            where server_lookup_type = "ip"
-            AND hostname in (
-                SELECT delegated_ip FROM delegated_data
-                WHERE delegated_ip = "{ip}"
-                AND server_lookup_type != "ip"
+            WHERE server_lookup_type = 'ip'
+            AND trim(hostname, '[]') IN (
+                SELECT delegated_addresses.address FROM delegated_addresses
+                JOIN delegated_data AS named ON named.id = delegated_addresses.host_id
+                WHERE named.server_lookup_type != 'ip'
             )
         ''')
-    
-    # Save and close database
-    conn.commit()
-    conn.close()
+
+
+def write_locations(db_file_path, shodan_file_path, processes=None, since=None):
+    """Fill in where servers are from the locations in a Shodan export
+
+    A server gets the location of the address it was reached on, or else of any of its other addresses.
+    Servers with none of their addresses in the export keep the location they had. Looking addresses up reads the
+    whole export, so it is skipped when no server needs locating.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        shodan_file_path: Full path to a Shodan data export json file.
+        processes: How many processes to parse the export with if its cache must be built. Default one per CPU core
+        since: Only locate servers that got a new address after this unix time. Default all servers
+
+    Returns:
+        How many servers got a new location.
+    """
+
+    conn = database.connect(db_file_path)
+    query = '''
+        SELECT delegated_data.id, delegated_ip, latitude, longitude, address FROM delegated_data
+        JOIN delegated_addresses ON delegated_addresses.host_id = delegated_data.id
+    '''
+    parameters = []
+    if since is not None:
+        query += '''
+        WHERE delegated_data.id IN (SELECT host_id FROM delegated_addresses WHERE first_seen > ?)
+        '''
+        parameters.append(since - LOCATION_OVERLAP_SECONDS)
+    hosts = {}
+    for host_id, delegated_ip, latitude, longitude, address in conn.execute(query, parameters):
+        host = hosts.setdefault(host_id, [delegated_ip, (latitude, longitude), []])
+        host[2].append(address)
+    if not hosts:
+        return(0)
+
+    cache = shodan_cache.open_cache(shodan_file_path, processes=processes)
+    if cache is None:
+        return(0)
+
+    with cache:
+        locations = cache.locate({address for host in hosts.values() for address in host[2]})
+
+    now = time.time()
+    updates = []
+    for host_id, (delegated_ip, stored, addresses) in hosts.items():
+        # Prefer the address the server answered on, then the lowest one so the choice is stable
+        for address in [delegated_ip] + sorted(addresses):
+            if address in locations:
+                location = tuple(str(round(coordinate, 4)) for coordinate in locations[address])
+                if location != stored:
+                    updates.append(location + (now, host_id))
+                break
+
+    # changed_at is bumped so map clients asking for changes pick up the new location
+    with database.transaction(conn):
+        conn.executemany('''
+            UPDATE delegated_data
+            SET latitude = ?, longitude = ?, changed_at = ?
+            WHERE id = ?
+        ''', updates)
+    return(len(updates))
+
+
+def _public_rooms_page(hostname, port, since=None, headers=None):
+    """Download one page of a room directory
+
+    Returns:
+        A tuple of (response, page). Page is the decoded JSON, or None if the download failed or is not a
+        publicRooms page. Response is None if the server could not be reached.
+    """
+
+    params = {'limit': ROOM_PAGE_SIZE}
+    if since:
+        params['since'] = since
+    response = resolve_hostname.https_get(hostname, PUBLIC_ROOMS_PATH, port, params, headers)
+    if response is None or response.status_code != 200:
+        return((response, None))
+    try:
+        with tracing.span('parse', 'publicRooms'):
+            page = response.json()
+    except ValueError:
+        return((response, None))
+    if not isinstance(page, dict) or not isinstance(page.get('chunk'), list):
+        return((response, None))
+    return((response, page))
+
+
+def crawl_public_rooms(hostname, port, fingerprint=None):
+    """Download the public room directory of a server, unless it did not change
+
+    Traced as rooms when tracing is enabled. See _crawl_public_rooms.
+    """
+
+    with tracing.trace('rooms', hostname):
+        result = _crawl_public_rooms(hostname, port, fingerprint)
+        if result is None:
+            tracing.set_outcome('failed')
+        else:
+            tracing.set_outcome('unchanged' if result[0] is None else f'changed rooms={len(result[0])}')
+    return(result)
+
+
+def _crawl_public_rooms(hostname, port, fingerprint=None):
+    """Download the public room directory of a server, unless it did not change
+
+    The first page is fetched with If-None-Match and If-Modified-Since when the server sent ETag or
+    Last-Modified before. If the server answers 304, or the first page and total_room_count_estimate are
+    the same as in fingerprint, the crawl stops there. Otherwise every page is downloaded. Every
+    FULL_CRAWL_SECONDS all pages are downloaded anyway, to catch changes past the first page.
+
+    Args:
+        hostname: Delegated hostname of the server.
+        port: Delegated port of the server.
+        fingerprint: Fingerprint dict from the last crawl, as returned by this function. Default None
+
+    Returns:
+        A tuple of (rooms, fingerprint). Rooms is a list of room dicts, or None if the directory did not change.
+        None if the download failed.
+    """
+
+    full_crawl = not fingerprint or time.time() - (fingerprint.get('full_crawl_at') or 0) >= FULL_CRAWL_SECONDS
+
+    # Ask the server to only answer if something changed
+    headers = {}
+    if not full_crawl:
+        if fingerprint.get('etag'):
+            headers['If-None-Match'] = fingerprint['etag']
+        if fingerprint.get('last_modified'):
+            headers['If-Modified-Since'] = fingerprint['last_modified']
+
+    response, page = _public_rooms_page(hostname, port, headers=headers)
+    if response is not None and response.status_code == 304 and headers:
+        return((None, fingerprint))
+    if page is None:
+        return(None)
+
+    new_fingerprint = {
+        'total_estimate': page.get('total_room_count_estimate'),
+        'first_page_hash': hashlib.sha256(json.dumps(page['chunk'], sort_keys=True).encode('utf-8')).hexdigest(),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'full_crawl_at': fingerprint.get('full_crawl_at') if fingerprint else None,
+    }
+    if (not full_crawl
+            and new_fingerprint['total_estimate'] == fingerprint.get('total_estimate')
+            and new_fingerprint['first_page_hash'] == fingerprint.get('first_page_hash')):
+        return((None, new_fingerprint))
+
+    # Something changed. Get the rest of the pages
+    rooms = list(page['chunk'])
+    tokens = set()
+    since = page.get('next_batch')
+    for _ in range(MAX_ROOM_PAGES - 1):
+        if not since or since in tokens:
+            break
+        tokens.add(since)
+        _, page = _public_rooms_page(hostname, port, since)
+
+        # A partial directory would look like rooms were removed, so give up on the whole crawl
+        if page is None:
+            return(None)
+        rooms.extend(page['chunk'])
+        since = page.get('next_batch')
+
+    new_fingerprint['full_crawl_at'] = time.time()
+    return((rooms, new_fingerprint))
+
+
+def get_room_fingerprint(conn, host_id):
+    """Get the fingerprint of a host's room directory from its last crawl
+
+    Args:
+        conn: A connection from database.connect.
+        host_id: The id of the host in delegated_data.
+
+    Returns:
+        A fingerprint dict as used by crawl_public_rooms. None if the directory was never crawled.
+    """
+
+    row = conn.execute('''
+        SELECT total_estimate, first_page_hash, etag, last_modified, full_crawl_at FROM room_directories
+        WHERE host_id = ?
+    ''', (host_id,)).fetchone()
+    if row is None:
+        return(None)
+    return(dict(zip(('total_estimate', 'first_page_hash', 'etag', 'last_modified', 'full_crawl_at'), row)))
+
+
+def save_room_fingerprint(conn, host_id, fingerprint, changed):
+    """Save the fingerprint of a host's room directory after a crawl
+
+    Args:
+        conn: A connection from database.connect.
+        host_id: The id of the host in delegated_data.
+        fingerprint: Fingerprint dict from crawl_public_rooms.
+        changed: Whether the crawl found changes.
+    """
+
+    now = time.time()
+    conn.execute('''
+        INSERT INTO room_directories
+        (host_id, total_estimate, first_page_hash, etag, last_modified, full_crawl_at, crawled_at, changed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (host_id) DO UPDATE SET
+            total_estimate = excluded.total_estimate,
+            first_page_hash = excluded.first_page_hash,
+            etag = excluded.etag,
+            last_modified = excluded.last_modified,
+            full_crawl_at = excluded.full_crawl_at,
+            crawled_at = excluded.crawled_at,
+            changed_at = coalesce(excluded.changed_at, changed_at)
+    ''', (host_id,
+          fingerprint.get('total_estimate'),
+          fingerprint.get('first_page_hash'),
+          fingerprint.get('etag'),
+          fingerprint.get('last_modified'),
+          fingerprint.get('full_crawl_at'),
+          now,
+          now if changed else None))
+
+
+def update_public_rooms(conn, host_id, result):
+    """Write the result of crawling a host's room directory
+
+    Args:
+        conn: A connection from database.connect.
+        host_id: The id of the host in delegated_data.
+        result: A (rooms, fingerprint) tuple from crawl_public_rooms. Rooms is None if the directory did not change.
+            Fingerprint may be None, then the stored one is left alone.
+
+    Returns:
+        How many rooms were added or changed.
+    """
+
+    rooms, fingerprint = result
+    changed = 0
+    with database.transaction(conn):
+        if rooms is not None:
+            changed = write_public_rooms(conn, host_id, rooms)
+        if fingerprint:
+            save_room_fingerprint(conn, host_id, fingerprint, rooms is not None)
+    return(changed)
+
+
+def write_public_rooms(conn, host_id, rooms):
+    """Write public rooms for a host
+
+    Rooms are stored once in the rooms table, no matter how many servers list them, and the newest metadata wins.
+    Only rooms whose metadata or aliases changed are written. room_servers records which rooms the host lists,
+    and only gains or loses rows when the host's directory did. Changed rooms are also updated in the rooms_fts
+    search index, if the database has one.
+
+    Args:
+        conn: A connection from database.connect, inside a transaction.
+        host_id: The id of the host in delegated_data.
+        rooms: List of room dicts as returned by crawl_public_rooms.
+
+    Returns:
+        How many rooms were added or changed.
+    """
+
+    search_index = database.has_table(conn, 'rooms_fts')
+    now = time.time()
+    changed = 0
+    listed = set()
+
+    # Loop over the rooms and save to db
+    for room in rooms:
+        if not isinstance(room, dict) or not room.get('room_id'):
+            continue
+
+        # Set variables if they exists, otherwise leave as None
+        values = [room.get(key) for key in ROOM_KEYS]
+        for index, value in enumerate(values):
+            if value is None:
+                continue
+            if ROOM_COLUMNS[index] != 'num_joined_members':
+                values[index] = str(value)
+                continue
+
+            # A malformed member count should not stop the rest of the directory from being saved
+            try:
+                values[index] = int(value)
+            except (TypeError, ValueError, OverflowError):
+                values[index] = 0
+        aliases = sorted({str(alias) for alias in room.get('aliases', [])})
+        room_id = str(room['room_id'])
+
+        row = conn.execute(f'''
+            SELECT id, {', '.join(ROOM_COLUMNS)} FROM rooms
+            WHERE room_id = ?
+        ''', (room_id,)).fetchone()
+
+        # New room
+        if row is None:
+            room_key_id = conn.execute(f'''
+                INSERT INTO rooms
+                (room_id, {', '.join(ROOM_COLUMNS)}, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [room_id] + values + [now]).lastrowid
+            old_aliases = []
+
+        else:
+            room_key_id = row[0]
+            old_aliases = [alias for (alias,) in conn.execute('''
+                SELECT alias FROM room_aliases
+                WHERE room_id = ?
+                ORDER BY alias
+            ''', (room_key_id,))]
+
+            # Unchanged room, nothing to write
+            if list(row[1:]) == values and old_aliases == aliases:
+                listed.add(room_key_id)
+                continue
+
+            assignments = ', '.join(f'{column} = ?' for column in ROOM_COLUMNS)
+            conn.execute(f'''
+                UPDATE rooms
+                SET {assignments}, updated_at = ?
+                WHERE id = ?
+            ''', values + [now, room_key_id])
+
+        # Replace the aliases if they changed
+        if old_aliases != aliases:
+            conn.execute('DELETE FROM room_aliases WHERE room_id = ?', (room_key_id,))
+            conn.executemany('''
+                INSERT INTO room_aliases
+                (room_id, alias)
+                VALUES (?, ?)
+            ''', ((room_key_id, alias) for alias in aliases))
+
+        # Keep the search index in sync
+        if search_index:
+            conn.execute('DELETE FROM rooms_fts WHERE rowid = ?', (room_key_id,))
+            conn.execute('''
+                INSERT INTO rooms_fts
+                (rowid, name, topic, aliases)
+                VALUES (?, ?, ?, ?)
+            ''', (room_key_id, values[1], values[3], ' '.join(filter(None, [values[0]] + aliases))))
+
+        listed.add(room_key_id)
+        changed += 1
+
+    # Update which rooms this host lists
+    before = {room_key_id for (room_key_id,) in conn.execute('''
+        SELECT room_id FROM room_servers
+        WHERE host_id = ?
+    ''', (host_id,))}
+    conn.executemany('''
+        INSERT INTO room_servers
+        (host_id, room_id)
+        VALUES (?, ?)
+    ''', ((host_id, room_key_id) for room_key_id in listed - before))
+    conn.executemany('''
+        DELETE FROM room_servers
+        WHERE host_id = ? AND room_id = ?
+    ''', ((host_id, room_key_id) for room_key_id in before - listed))
+
+    return(changed)
 
 
 def get_public_rooms(db_file_path):
     """Get public rooms
 
-    Get public rooms for all hosts in database
+    Get public rooms for all hosts in database. Directories that did not change since the last crawl are
+    skipped after their first page, see crawl_public_rooms.
 
     Args:
         db_file_path: Full path to SQLite3 database file.
+
+    Returns:
+        A tuple of (directories that changed, directories that did not change, directories that failed).
     """
 
     # Connect to database
     try:
-        conn = sqlite3.connect(db_file_path)
-        cur = conn.cursor()
-        cur2 = conn.cursor()
+        conn = database.connect(db_file_path)
     except sqlite3.OperationalError as error:
         print('Error initializing database:', error)
         exit(1)
-    
-    # Loop over hostnames
-    for host in cur.execute('''
+
+    # Loop over hostnames. Fetch them all first so no read is held open while downloading
+    hosts = conn.execute('''
         SELECT id, delegated_hostname, delegated_port FROM delegated_data
-        /*WHERE id NOT IN (
-            SELECT host_id FROM public_rooms
-        )
-    '''):
-        # Get all rooms from server
-        rooms = resolve_hostname.https_download(host[1], '/_matrix/client/r0/publicRooms', host[2], True)
-
-        # If rooms is not Null
-        if rooms:
-            #If chunk exists
-            if 'chunk' in rooms:
-                # Loop over the rooms and save to db
-                for room in rooms['chunk']:
-                    # Set all variables to empty
-                    canonical_alias = None
-                    name = None
-                    num_joined_members = None
-                    room_id = None
-                    topic = None
-                    world_readable = None
-                    guest_can_join = None
-                    avatar_url = None
-                    m_federate = None
-
-                    # # Set variables if they exists, otherwise leave as None
-                    if 'canonical_alias' in room:
-                        canonical_alias = str(room['canonical_alias'])
-                    if 'name' in room:
-                        name = str(room['name']).replace('"', '')
-                    if 'num_joined_members' in room:
-                        num_joined_members = int(room['num_joined_members'])
-                    if 'room_id' in room:
-                        room_id = str(room['room_id'])
-                    if 'topic' in room:
-                        topic = str(room['topic']).replace('"', '')
-                    if 'world_readable' in room:
-                        world_readable = str(room['world_readable'])
-                    if 'guest_can_join' in room:
-                        guest_can_join = str(room['guest_can_join'])
-                    if 'avatar_url' in room:
-                        avatar_url = str(room['avatar_url'])
-                    if 'm.federate' in room:
-                        m_federate = str(room['m.federate'])
-
-                    # Insert room into public_rooms table
-                    try:
-                        cur2.execute(f'''
-                            INSERT INTO public_rooms
-                            (host_id, canonical_alias, name, num_joined_members, room_id, topic, world_readable, guest_can_join, avatar_url, m_federate)
-                            VALUES (
-                                "{host[0]}",
-                                "{canonical_alias}",
-                                "{name}",
-                                "{num_joined_members}",
-                                "{room_id}",
-                                "{topic}",
-                                "{world_readable}",
-                                "{guest_can_join}",
-                                "{avatar_url}",
-                                "{m_federate}"
-                            )
-                        ''')
-                    except sqlite3.OperationalError as e:
-                        print('a', e)
-
-                    # Get the key id of this room
-                    try:
-                        for row in cur2.execute(f'''
-                            SELECT id from public_rooms
-                            WHERE room_id = "{room_id}"
-                            ORDER BY id DESC
-                            LIMIT 1
-                        '''):
-                            room_key_id = row[0]
-                    except Exception as e:
-                        print(e)
-
-                    # If aliases, loop over them and insert into aliases table
-                    if 'aliases' in room:
-                        for alias in room['aliases']:
-                            try:
-                                cur2.execute(f'''
-                                    INSERT INTO aliases
-                                    (room_id, alias)
-                                    VALUES (
-                                        "{room_key_id}",
-                                        "{alias}"
-                                    )
-                                ''')
-                            except Exception as e:
-                                print('b', e)
-
-    # Save and close database
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    ''').fetchall()
+    counts = [0, 0, 0]
+    for host in hosts:
+        result = crawl_public_rooms(host[1], host[2], get_room_fingerprint(conn, host[0]))
+        if result is None:
+            counts[2] += 1
+            continue
+
+        # One short transaction per host, so readers and other writers are never blocked for long
+        update_public_rooms(conn, host[0], result)
+        counts[0 if result[0] is not None else 1] += 1
+    return(tuple(counts))
+
+
+def write_node_rooms(db_file_path, rooms_by_hostname):
+    """Write public rooms crawled by a scanner node
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        rooms_by_hostname: Dict of delegated_data hostname to a dict with rooms and fingerprint from
+            crawl_public_rooms. Rooms is None if the directory did not change.
+    """
+
+    # Connect to database
+    try:
+        conn = database.connect(db_file_path)
+    except sqlite3.OperationalError as error:
+        print('Error initializing database:', error)
+        exit(1)
+
+    with database.transaction(conn):
+        for hostname, result in rooms_by_hostname.items():
+            # Look up the id now, since write_delegated may have replaced the row since the node got its lease
+            row = conn.execute('SELECT id FROM delegated_data WHERE hostname = ?', (hostname,)).fetchone()
+            if not row:
+                continue
+            # Nodes from before fingerprints send a plain list of rooms
+            if isinstance(result, list):
+                update_public_rooms(conn, row[0], (result, None))
+            else:
+                update_public_rooms(conn, row[0], (result.get('rooms'), result.get('fingerprint')))
+
+
+def get_delegated_hosts(db_file_path, hostnames):
+    """Get the delegated hostname and port for hosts
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        hostnames: List of delegated_data hostnames.
+
+    Returns:
+        List of [hostname, delegated_hostname, delegated_port, fingerprint] for the hostnames found in the database.
+        Fingerprint is the room directory fingerprint from get_room_fingerprint, or None.
+    """
+
+    conn = database.connect(db_file_path)
+    hosts = []
+    for hostname in hostnames:
+        row = conn.execute('''
+            SELECT id, hostname, delegated_hostname, delegated_port FROM delegated_data
+            WHERE hostname = ?
+        ''', (hostname,)).fetchone()
+        if row:
+            hosts.append(list(row[1:]) + [get_room_fingerprint(conn, row[0])])
+    return(hosts)
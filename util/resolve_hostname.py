@@ -1,61 +1,541 @@
 ## Import modules
-import dns
+import errno
+import ipaddress
 import json
 import logging
-import re
+import os
+import random
 import requests
+import selectors
 import ssl
 import socket
-import srvlookup
+import threading
+import time
 import urllib3
-from fake_useragent import UserAgent
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
+
+## Import other python files
+from . import import_hostnames
+from . import latency
+from . import probe_result
+from . import tracing
+
+
+## Settings
+
+# Observed latencies per probe phase. Timeouts adapt to these once enough requests have succeeded
+latency_trackers = {
+    'well_known': latency.LatencyTracker(3, 3),
+    'version': latency.LatencyTracker(3, 3),
+    'download': latency.LatencyTracker(1, 1),
+}
+
+# Send a second version request to another IP once this percentile of version latency is exceeded. None to disable
+hedge_percentile = None
+
+# Errors that mean we could not talk to a server. Base classes, so errors like a broken chunked body are caught too
+CONNECTION_ERRORS = (
+    NameError,
+    OSError,
+    requests.exceptions.RequestException,
+    UnicodeError,
+    urllib3.exceptions.HTTPError
+)
+
+# Seconds to wait for a connection attempt before racing the next address against it, as in Happy Eyeballs (RFC 8305)
+connection_attempt_delay = 0.25
+
+# Delegation and DNS lookups are cached for this many seconds, so a long running scanner does not repeat them
+cache_ttl = 3600
+# Maximum number of entries in each lookup cache
+cache_max_entries = 100000
+
+# Browser user agents to pick from at random. Bundled, so nothing is downloaded or loaded per request
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:124.0) Gecko/20100101 Firefox/124.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4.1 Safari/605.1.15',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14.4; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_4_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.4.1 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Mobile Safari/537.36',
+)
+
+_delegation_cache = {}
+_address_cache = {}
+_cache_lock = threading.Lock()
+_timing = threading.local()
+_sessions = threading.local()
+_hedge_executor = None
+
+# Certificates are checked separately and recorded as valid_ssl, so unverified requests are expected
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Turn off annoying logging to terminal from srv lookup
+logging.getLogger('srvlookup').setLevel(logging.CRITICAL)
+
+
+## Classes
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    """HTTPS connection that records how long the TCP and TLS setup took
+
+    Resolves the hostname itself and races connections to all of its addresses, see race_connect. Name resolution,
+    each connection attempt and the TLS handshake are separate trace spans.
+    """
+
+    def _new_conn(self):
+        host = self._dns_host.strip('[]')
+        with tracing.span('dns', host):
+            try:
+                if is_ip_literal(host):
+                    addresses = (host,)
+                else:
+                    addresses = _cached_lookup(_address_cache, host, resolve_addresses)
+            except socket.gaierror as error:
+                raise urllib3.exceptions.NameResolutionError(self.host, self, error) from error
+
+        try:
+            sock, address = race_connect(addresses, self.port, self.timeout, self.source_address, self.socket_options)
+        except socket.timeout:
+            raise urllib3.exceptions.ConnectTimeoutError(self, f'Connection to {self.host} timed out') from None
+        except OSError as error:
+            raise urllib3.exceptions.NewConnectionError(self, f'Failed to establish a new connection: {error}') from error
+        self._socket_ready = time.perf_counter()
+        _timing.address = address
+        if address != addresses[0]:
+            _prefer_address(host, address)
+        return(sock)
+
+
+    def connect(self):
+        started = time.monotonic()
+        super().connect()
+        _timing.connect = time.monotonic() - started
+        tracing.add_span('tls', self._socket_ready, time.perf_counter() - self._socket_ready, self.host)
+
+
+class _Uncached(Exception):
+    """Raised by a lookup to hand a value to _cached_lookup that must not be cached
+
+    Args:
+        value: The value to return this time.
+    """
+
+    def __init__(self, value):
+        super().__init__(value)
+        self.value = value
+
+
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter using connections that record their setup time"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': urllib3.HTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+class _PinnedAdapter(_TimedAdapter):
+    """Transport adapter for talking to one IP address while using a hostname for SNI and certificate checks
+
+    Args:
+        server_hostname: The hostname to send in SNI and to check the certificate against.
+    """
+
+    def __init__(self, server_hostname, **kwargs):
+        self.server_hostname = server_hostname
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.server_hostname
+        kwargs['assert_hostname'] = self.server_hostname
+        super().init_poolmanager(*args, **kwargs)
 
 
 ## Functions
 
+def random_headers():
+    """Get request headers with a random browser user agent from USER_AGENTS"""
+
+    return({'User-Agent': random.choice(USER_AGENTS)})
+
+
+def is_ip_literal(hostname):
+    """Check if a hostname is an IPv4 or IPv6 address
+
+    Args:
+        hostname: A hostname. IPv6 addresses may be in brackets.
+
+    Returns:
+        True if hostname is an IP address.
+    """
+
+    try:
+        ipaddress.ip_address(hostname.strip('[]'))
+    except ValueError:
+        return(False)
+    return(True)
+
+
+def resolve_addresses(hostname):
+    """Get every IPv4 and IPv6 address of a hostname
+
+    Args:
+        hostname: A hostname.
+
+    Returns:
+        Tuple of IP addresses, in the order the system prefers them.
+
+    Raises:
+        socket.gaierror: If the hostname has no addresses.
+    """
+
+    addresses = []
+    for family, _, _, _, sockaddr in socket.getaddrinfo(hostname, None, type=socket.SOCK_STREAM):
+        if family in (socket.AF_INET, socket.AF_INET6) and sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    if not addresses:
+        raise socket.gaierror(socket.EAI_NONAME, f'{hostname} has no IPv4 or IPv6 addresses')
+    return(tuple(addresses))
+
+
+def _prefer_address(hostname, address):
+    """Move an address that answered to the front of the cached addresses of a hostname, so it is tried first next time"""
+
+    with _cache_lock:
+        entry = _address_cache.get(hostname)
+        if entry and address in entry[1]:
+            _address_cache[hostname] = (entry[0], (address,) + tuple(other for other in entry[1] if other != address))
+
+
+def _interleave_families(addresses):
+    """Order addresses so the address families take turns, starting with the family of the first one"""
+
+    first = [address for address in addresses if (':' in address) == (':' in addresses[0])]
+    other = [address for address in addresses if (':' in address) != (':' in addresses[0])]
+    ordered = []
+    for index in range(max(len(first), len(other))):
+        ordered.extend(family[index] for family in (first, other) if index < len(family))
+    return(ordered)
+
+
+def _open_socket(address, port, source_address, socket_options):
+    """Start a non-blocking connection to one address
+
+    Returns:
+        A tuple of (socket, True if already connected).
+    """
+
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        for option in socket_options or ():
+            sock.setsockopt(*option)
+        if source_address:
+            sock.bind(source_address)
+        sock.setblocking(False)
+        result = sock.connect_ex((address, port))
+    except OSError:
+        sock.close()
+        raise
+    if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+        sock.close()
+        raise OSError(result, os.strerror(result))
+    return((sock, result == 0))
+
+
+def race_connect(addresses, port, timeout=None, source_address=None, socket_options=None):
+    """Connect to whichever address of a server answers first, Happy Eyeballs style (RFC 8305)
+
+    Address families take turns. The first attempt starts at once, and every connection_attempt_delay seconds,
+    or as soon as an attempt fails, the next address is tried alongside the ones still pending. The first
+    connection to succeed wins and the others are closed. Without IPv6 on this machine, IPv6 addresses are skipped.
+
+    Args:
+        addresses: IP addresses to try, as strings.
+        port: The port to connect to.
+        timeout: Seconds each attempt may take, and the timeout of the returned socket. Default no timeout
+        source_address: A (host, port) tuple to bind to. Default none
+        socket_options: List of setsockopt arguments to apply before connecting. Default none
+
+    Returns:
+        A tuple of (connected socket, the IP address it is connected to).
+
+    Raises:
+        socket.timeout: If every attempt timed out.
+        OSError: If every attempt failed, with the error of the last one to fail.
+    """
+
+    if not isinstance(timeout, (int, float)):
+        timeout = socket.getdefaulttimeout()
+    waiting = _interleave_families([address for address in addresses
+                                    if ':' not in address or urllib3.util.connection.HAS_IPV6])
+    pending = {}
+    selector = selectors.DefaultSelector()
+    error = OSError(errno.EHOSTUNREACH, 'No address to connect to')
+    next_start = time.monotonic()
+    try:
+        while waiting or pending:
+            now = time.monotonic()
+
+            # Start the next attempt when it is due, or right away when nothing is pending
+            if waiting and (now >= next_start or not pending):
+                address = waiting.pop(0)
+                started = time.perf_counter()
+                try:
+                    sock, connected = _open_socket(address, port, source_address, socket_options)
+                except OSError as attempt_error:
+                    tracing.add_span('connect', started, time.perf_counter() - started,
+                                     f'{address} {errno.errorcode.get(attempt_error.errno, type(attempt_error).__name__)}')
+                    error = attempt_error
+                    continue
+                if connected:
+                    tracing.add_span('connect', started, time.perf_counter() - started, address)
+                    sock.settimeout(timeout)
+                    return((sock, address))
+                selector.register(sock, selectors.EVENT_WRITE)
+                pending[sock] = (address, started, now + timeout if timeout is not None else None)
+                next_start = now + connection_attempt_delay
+                continue
+
+            # Wait for an attempt to finish, the next attempt to be due or the earliest deadline
+            wake = [deadline for _, _, deadline in pending.values() if deadline is not None]
+            if waiting:
+                wake.append(next_start)
+            events = selector.select(max(min(wake) - now, 0) if wake else None)
+
+            for key, _ in events:
+                sock = key.fileobj
+                address, started, _ = pending.pop(sock)
+                selector.unregister(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    tracing.add_span('connect', started, time.perf_counter() - started, address)
+                    sock.settimeout(timeout)
+                    return((sock, address))
+                tracing.add_span('connect', started, time.perf_counter() - started,
+                                 f'{address} {errno.errorcode.get(result, result)}')
+                sock.close()
+
+                # Failed, so the next address does not have to wait its turn
+                error = OSError(result, os.strerror(result))
+                next_start = time.monotonic()
+
+            # Give up on attempts past their deadline
+            now = time.monotonic()
+            for sock, (address, started, deadline) in list(pending.items()):
+                if deadline is not None and now >= deadline:
+                    tracing.add_span('connect', started, time.perf_counter() - started, f'{address} timeout')
+                    del pending[sock]
+                    selector.unregister(sock)
+                    sock.close()
+                    error = socket.timeout(f'Connection to {address} timed out')
+        raise error
+    finally:
+        for sock, (address, started, _) in pending.items():
+            tracing.add_span('connect', started, time.perf_counter() - started, f'{address} cancelled')
+            sock.close()
+        selector.close()
+
+
+def configure_timeouts(percentile=None, factor=None, minimum=None, maximum=None, hedge=None, hedge_workers=None):
+    """Change how adaptive timeouts and hedged version requests behave
+
+    Args:
+        percentile: Which percentile of observed latencies to base timeouts on.
+        factor: Multiply the percentile latency by this to get the timeout.
+        minimum: Never use a connect or read timeout shorter than this many seconds.
+        maximum: Never use a connect or read timeout longer than this many seconds.
+        hedge: Latency percentile after which a hedged version request is sent. None to disable hedging.
+        hedge_workers: How many threads probe at once. When hedging is enabled, version requests run in a pool
+            with two threads per probing thread, one for the first request and one for its hedge.
+    """
+
+    global hedge_percentile, _hedge_executor
+
+    for tracker in latency_trackers.values():
+        tracker.configure(percentile, factor, minimum, maximum)
+
+    hedge_percentile = hedge
+    if _hedge_executor:
+        _hedge_executor.shutdown(wait=False)
+        _hedge_executor = None
+    if hedge and hedge_workers:
+        _hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers * 2)
+
+
+def configure_cache(ttl=None, max_entries=None):
+    """Change how long delegation and DNS lookups are cached
+
+    Args:
+        ttl: Seconds to keep lookups. 0 disables caching.
+        max_entries: Maximum number of entries in each lookup cache.
+    """
+
+    global cache_ttl, cache_max_entries
+
+    if ttl is not None:
+        cache_ttl = ttl
+    if max_entries is not None:
+        cache_max_entries = max_entries
+
+
+def _cached_lookup(cache, key, lookup):
+    """Look something up through a TTL cache
+
+    Args:
+        cache: The cache dict to use.
+        key: What to look up.
+        lookup: Function that takes key and returns the value. Exceptions are not cached, and a value
+            raised in _Uncached is returned without caching it.
+
+    Returns:
+        The cached or freshly looked up value.
+    """
+
+    if not cache_ttl:
+        try:
+            return(lookup(key))
+        except _Uncached as uncached:
+            return(uncached.value)
+
+    now = time.monotonic()
+    with _cache_lock:
+        entry = cache.get(key)
+    if entry and entry[0] > now:
+        return(entry[1])
+
+    try:
+        value = lookup(key)
+    except _Uncached as uncached:
+        return(uncached.value)
+
+    with _cache_lock:
+        if len(cache) >= cache_max_entries:
+            # Drop expired entries, then the oldest half if that was not enough
+            for old_key in [k for k, v in cache.items() if v[0] <= now]:
+                del cache[old_key]
+            if len(cache) >= cache_max_entries:
+                for old_key in list(cache)[:len(cache) // 2]:
+                    del cache[old_key]
+        cache[key] = (now + cache_ttl, value)
+    return(value)
+
+
+def _get_session():
+    """Get a requests session for the current thread"""
+
+    if not hasattr(_sessions, 'session'):
+        session = requests.Session()
+        session.mount('https://', _TimedAdapter())
+        _sessions.session = session
+    return(_sessions.session)
+
+
+def _timed_get(phase, url, session=None, **kwargs):
+    """GET an URL with timeouts adapted to the phase, and record how long it took
+
+    If connecting or waiting for the answer times out, the timeout is recorded as a sample and the request is
+    retried once with the longest timeout allowed for the part that timed out, so slow but alive servers are not
+    lost.
+
+    Args:
+        phase: Which latency tracker to use. well_known, version or download.
+        url: The URL to get.
+        session: A requests session. Default a session for the current thread
+        **kwargs: Passed on to session.get.
+
+    Returns:
+        A requests response, with connected_address set to the IP address it came from when known.
+    """
+
+    tracker = latency_trackers[phase]
+    connect_timeout, read_timeout = tracker.timeout()
+    if not session:
+        session = _get_session()
+
+    _timing.connect = None
+    _timing.address = None
+    started = time.perf_counter()
+    try:
+        response = session.get(url, timeout=(connect_timeout, read_timeout), **kwargs)
+    except requests.exceptions.Timeout as error:
+        tracing.add_span('request', started, time.perf_counter() - started, f'{phase} {type(error).__name__}')
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            tracker.record(connect_timeout, None)
+            expired, retry_timeouts = connect_timeout, (tracker.maximum, read_timeout)
+        else:
+            tracker.record(_timing.connect, read_timeout)
+            expired, retry_timeouts = read_timeout, (connect_timeout, tracker.maximum)
+        if tracker.maximum <= expired:
+            raise
+        _timing.connect = None
+        started = time.perf_counter()
+        try:
+            response = session.get(url, timeout=retry_timeouts, **kwargs)
+        except Exception as error:
+            tracing.add_span('request', started, time.perf_counter() - started, f'{phase} {type(error).__name__}')
+            raise
+    # A failed request's span also covers whatever connection setup happened before it failed
+    except Exception as error:
+        tracing.add_span('request', started, time.perf_counter() - started, f'{phase} {type(error).__name__}')
+        raise
+
+    connect = _timing.connect
+
+    # The request span is what is left after setting up the connection, so spans do not overlap
+    setup = connect or 0
+    tracing.add_span('request', started + setup, time.perf_counter() - started - setup,
+                     f'{phase} {response.status_code} redirects={len(response.history)}')
+    tracker.record(connect, max(response.elapsed.total_seconds() - (connect or 0), 0))
+
+    # The address the last new connection went to. None if a pooled connection was reused
+    response.connected_address = _timing.address
+    return(response)
+
+
 def resolve_well_known(hostname):
     """Get delegated hostname and port from hostname
 
     Try and look up the well-know server file for a hostname, then if this file exists return
-    the delegated hostname and port, or return an empty string if no well known server file exists.
+    the delegated hostname and port, or return None if no well known server file exists.
 
     Args:
         hostname: A hostname as found in the Matrix ID.
     
     Returns:
         Delegated hostname and port in the format sub.domain.tld:port:wellknown
-        Or an empty string if no luck.
+        Or None if there is no usable well-known file, or False if the server could not be asked
+        (connection error, timeout, rate limit or server error), so the answer may differ next time.
     """
 
     # Set a random valid user-agent
-    ua = UserAgent()
-    headers = {'User-Agent': ua.random}
+    headers = random_headers()
 
     # Set well-known URL
     well_known_url = f'https://{hostname}/.well-known/matrix/server'
 
     # Try to downlad well-known server file
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     try:
-        well_known_request = requests.get(well_known_url, headers=headers, allow_redirects=True, verify=False, timeout=3)
-    except (
-        dns.name.LabelTooLong,
-        NameError,
-        requests.exceptions.ConnectionError,
-        requests.exceptions.ConnectTimeout,
-        requests.exceptions.InvalidURL,
-        requests.exceptions.ReadTimeout,
-        requests.exceptions.SSLError,
-        requests.exceptions.TooManyRedirects,
-        socket.timeout,
-        ssl.SSLCertVerificationError,
-        ssl.SSLError,
-        UnicodeError,
-        urllib3.exceptions.ConnectTimeoutError,
-        urllib3.exceptions.MaxRetryError,
-        urllib3.exceptions.NewConnectionError
-    ):
-        return(None)
+        well_known_request = _timed_get('well_known', well_known_url, headers=headers, allow_redirects=True, verify=False)
+    except CONNECTION_ERRORS:
+        return(False)
+
+    # Rate limited or server error, may well work next time
+    if well_known_request.status_code == 429 or well_known_request.status_code >= 500:
+        return(False)
 
     # If not 200
     if not well_known_request.status_code == 200:
@@ -69,7 +549,7 @@ def resolve_well_known(hostname):
     except json.decoder.JSONDecodeError:
         return(None)
     
-    except (ValueError, KeyError):
+    except (ValueError, KeyError, TypeError, AttributeError):
         delegated_port = 443
     
     else: 
@@ -80,27 +560,37 @@ def resolve_srv(hostname):
     """Get delegated hostname and port from DNS SRV record
 
     Try and look up the DNS SRV record for a hostname, then if this exists return
-    the delegated hostname, port and srv, or return an empty string if no well known server file exists.
+    the delegated hostname, port and srv, or return None if no SRV record exists.
 
     Args:
         hostname: A hostname as found in the Matrix ID.
     
     Returns:
         Delegated hostname and port in the format sub.domain.tld:port:srv
-        Or an empty string if no luck.
+        Or None if there is no SRV record, or False if no nameserver answered in time.
     """
 
-    # Turn off annoying logging to terminal from srv lookup
-    logger = logging.getLogger('srvlookup').setLevel(logging.CRITICAL)
-    logger = logger
-    
+    # Only needed when there is no well-known file, and slow to import
+    import dns.exception
+    import srvlookup
+
     # Try and look up SRV record
     try:
-        srv = srvlookup.lookup('matrix', 'TCP', hostname)
+        with tracing.span('dns', f'_matrix._tcp.{hostname}'):
+            srv = srvlookup.lookup('matrix', 'TCP', hostname)
 
-    # SRV lookup fail (except no record found)
-    except (srvlookup.SRVQueryFailure, UnicodeError, dns.name.LabelTooLong):
+    # No record, unless no nameserver gave an answer
+    except srvlookup.SRVQueryFailure as error:
+        if error.args and error.args[0] == 'NoNameservers':
+            return(False)
         return(None)
+
+    except UnicodeError:
+        return(None)
+
+    # Timeout and other resolver failures
+    except dns.exception.DNSException:
+        return(False)
     
     # SRV lookup returns something
     else:
@@ -129,24 +619,50 @@ def resolve_delegated_homeserver(hostname):
         sub.domain.tld:port:server-resolve-type
     """
 
+    return(_resolve_delegation(hostname)[0])
+
+
+def _resolve_delegation(hostname):
+    """Return delegated hostname and port from a hostname, and if that answer is definite
+
+    Args:
+        hostname: A hostname (the domain part of a Matrix ID).
+
+    Returns:
+        Tuple of the resolve_delegated_homeserver string and False if it is the port 8448 fallback
+        used because well-known or SRV could not be asked, True otherwise.
+    """
+
     # If hostname is an ip
-    re_ipv4 = re.compile(r'((([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5]))')
-    re_ipv6 = re.compile(r'((([0-9a-fA-F]{1,4}:){7,7}[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,7}:|([0-9a-fA-F]{1,4}:){1,6}:[0-9a-fA-F]{1,4}|([0-9a-fA-F]{1,4}:){1,5}(:[0-9a-fA-F]{1,4}){1,2}|([0-9a-fA-F]{1,4}:){1,4}(:[0-9a-fA-F]{1,4}){1,3}|([0-9a-fA-F]{1,4}:){1,3}(:[0-9a-fA-F]{1,4}){1,4}|([0-9a-fA-F]{1,4}:){1,2}(:[0-9a-fA-F]{1,4}){1,5}|[0-9a-fA-F]{1,4}:((:[0-9a-fA-F]{1,4}){1,6})|:((:[0-9a-fA-F]{1,4}){1,7}|:)|fe80:(:[0-9a-fA-F]{0,4}){0,4}%[0-9a-zA-Z]{1,}|::(ffff(:0{1,4}){0,1}:){0,1}((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])|([0-9a-fA-F]{1,4}:){1,4}:((25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])\.){3,3}(25[0-5]|(2[0-4]|1{0,1}[0-9]){0,1}[0-9])))')
-    if re_ipv4.match(hostname) or re_ipv6.match(hostname):
-        return(f'{hostname}:8448:ip')
+    if is_ip_literal(hostname):
+        return((f'{hostname}:8448:ip', True))
 
     # If a well-known
-    temp = resolve_well_known(hostname)
-    if temp:
-        return temp
+    well_known = resolve_well_known(hostname)
+    if well_known:
+        return((well_known, True))
     
     # If a srv
-    temp = resolve_srv(hostname)
-    if temp:
-        return temp
+    srv = resolve_srv(hostname)
+    if srv:
+        return((srv, True))
     
     # Else, assume A or AAAA and assume port 8448
-    return(f'{hostname}:8448:a')
+    return((f'{hostname}:8448:a', well_known is None and srv is None))
+
+
+def _lookup_delegation(hostname):
+    """resolve_delegated_homeserver for _delegation_cache
+
+    Raises:
+        _Uncached: With the port 8448 fallback if well-known or SRV could not be asked, so a server
+            that was briefly unreachable is not stuck with the fallback until the cache expires.
+    """
+
+    delegated, definite = _resolve_delegation(hostname)
+    if not definite:
+        raise _Uncached(delegated)
+    return(delegated)
 
 
 def https_download(hostname, path, port=443, raw=False):
@@ -165,33 +681,15 @@ def https_download(hostname, path, port=443, raw=False):
     """
 
     # Set a random valid user-agent
-    ua = UserAgent()
-    headers = {'User-Agent': ua.random}
+    headers = random_headers()
 
     # Set  URL
     url = f'https://{hostname}:{port}{path}'
 
     # Try and download
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     try:
-        http_request = requests.get(url, headers=headers, allow_redirects=True, verify=False, timeout=1)
-    except (
-        dns.name.LabelTooLong,
-        NameError,
-        requests.exceptions.ConnectionError,
-        requests.exceptions.ConnectTimeout,
-        requests.exceptions.InvalidURL,
-        requests.exceptions.ReadTimeout,
-        requests.exceptions.SSLError,
-        requests.exceptions.TooManyRedirects,
-        socket.timeout,
-        ssl.SSLCertVerificationError,
-        ssl.SSLError,
-        UnicodeError,
-        urllib3.exceptions.ConnectTimeoutError,
-        urllib3.exceptions.MaxRetryError,
-        urllib3.exceptions.NewConnectionError
-    ):
+        http_request = _timed_get('download', url, headers=headers, allow_redirects=True, verify=False)
+    except CONNECTION_ERRORS:
         return(None)
 
     # If not 200
@@ -199,7 +697,10 @@ def https_download(hostname, path, port=443, raw=False):
         return(None)
 
     if raw:
-        return(http_request.json())
+        try:
+            return(http_request.json())
+        except json.decoder.JSONDecodeError:
+            return(None)
 
     # Try and decode json, then split domain.tld:port
     try:
@@ -217,125 +718,271 @@ def https_download(hostname, path, port=443, raw=False):
         return(f'{delegated_hostname}:{delegated_port}')
 
 
+def https_get(hostname, path, port=443, params=None, headers=None):
+    """Try and GET something over https
+
+    Args:
+        hostname: A hostname or an IP address.
+        path: What do download. For example /_matrix/client/r0/publicRooms.
+        port: A port. Default 443.
+        params: Query parameters. Default none
+        headers: Extra request headers, like If-None-Match. Default none
+
+    Returns:
+        The requests response, whatever its status code. None if the server could not be reached.
+    """
+
+    request_headers = random_headers()
+    if headers:
+        request_headers.update(headers)
+
+    try:
+        return(_timed_get('download', f'https://{hostname}:{port}{path}', params=params, headers=request_headers,
+                          allow_redirects=True, verify=False))
+    except CONNECTION_ERRORS:
+        return(None)
+
+
+def _version_attempt(url, headers, session=None):
+    """Try and download a version file, first with and then without certificate validation
+
+    Args:
+        url: The version URL.
+        headers: Request headers.
+        session: A requests session. Default a session for the current thread
+
+    Returns:
+        A tuple of (response, valid_ssl). Response is None if the server could not be reached.
+    """
+
+    try:
+        return((_timed_get('version', url, session=session, headers=headers, allow_redirects=True), True))
+
+    # If ssl error
+    except (requests.exceptions.SSLError, ssl.SSLCertVerificationError, ssl.SSLError):
+        try:
+            return((_timed_get('version', url, session=session, headers=headers, allow_redirects=True, verify=False), False))
+        except CONNECTION_ERRORS:
+            return((None, False))
+
+    # If connection error
+    except CONNECTION_ERRORS:
+        return((None, True))
+
+
+def _hedged_attempt(url, headers, server_hostname):
+    """Try and download a version file from an IP address, with a session of its own that is closed afterwards
+
+    Args:
+        url: The version URL, with the IP address as host.
+        headers: Request headers, with Host set to the server.
+        server_hostname: The hostname to send in SNI and to check the certificate against.
+
+    Returns:
+        A tuple of (response, valid_ssl), like _version_attempt.
+    """
+
+    with requests.Session() as session:
+        session.mount('https://', _PinnedAdapter(server_hostname))
+        return(_version_attempt(url, headers, session))
+
+
+def _alternative_address(hostname):
+    """Pick another address to send a hedged request to
+
+    Prefer an address in the other address family than the one the system would try first, then the next address.
+
+    Args:
+        hostname: A hostname.
+
+    Returns:
+        An IP address. Or None if the hostname only has one address.
+    """
+
+    if is_ip_literal(hostname):
+        return(None)
+    try:
+        addresses = _cached_lookup(_address_cache, hostname, resolve_addresses)
+    except (socket.gaierror, UnicodeError):
+        return(None)
+
+    if len(addresses) < 2:
+        return(None)
+
+    for address in addresses[1:]:
+        if (':' in address) != (':' in addresses[0]):
+            return(address)
+    return(addresses[1])
+
+
+def fetch_version(delegated_hostname, delegated_port, headers):
+    """Download the federation version file from a server
+
+    Connections already race all addresses of the server, see race_connect. If hedging is enabled and the request
+    still takes longer than the configured latency percentile, because the server accepted the connection but is
+    slow to answer, a second request is sent to another IP for the same hostname, and whichever succeeds first is used.
+
+    Args:
+        delegated_hostname: The delegated hostname.
+        delegated_port: The delegated port.
+        headers: Request headers.
+
+    Returns:
+        A tuple of (response, valid_ssl). Response is None if the server could not be reached.
+    """
+
+    version_url = f'https://{delegated_hostname}:{delegated_port}/_matrix/federation/v1/version'
+
+    hedge_after = None
+    if hedge_percentile and _hedge_executor:
+        hedge_after = latency_trackers['version'].percentile(hedge_percentile)
+    if hedge_after is None:
+        return(_version_attempt(version_url, headers))
+
+    started = threading.Event()
+
+    def primary_attempt():
+        started.set()
+        return(_version_attempt(version_url, headers))
+
+    # Requests that lost a race run until they time out. If they keep every thread busy, do without a hedge
+    # rather than wait. Otherwise the clock starts with the request, as waiting for a thread does not make
+    # the server slow
+    primary = _hedge_executor.submit(tracing.bind(primary_attempt))
+    if not started.wait(hedge_after) and primary.cancel():
+        return(_version_attempt(version_url, headers))
+    started.wait()
+    try:
+        return(primary.result(timeout=hedge_after))
+    except TimeoutError:
+        pass
+
+    # Primary is slow. Send the hedged request to another address
+    address = _alternative_address(delegated_hostname)
+    if not address:
+        return(primary.result())
+
+    if ':' in address:
+        address = f'[{address}]'
+    hedged_headers = dict(headers)
+    hedged_headers['Host'] = f'{delegated_hostname}:{delegated_port}'
+    hedged = _hedge_executor.submit(
+        tracing.bind(_hedged_attempt),
+        f'https://{address}:{delegated_port}/_matrix/federation/v1/version',
+        hedged_headers,
+        delegated_hostname
+    )
+
+    # Use whichever attempt reaches the server first
+    pending = {primary, hedged}
+    result = (None, True)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            if result[0] is not None:
+                return(result)
+    return(result)
+
+
 def check_matrix_server(hostname):
     """Check if and save there is a Synapse or Dendrite server on a url
 
+    Traced as a probe when tracing is enabled. See _check_matrix_server. Never raises, so one odd server can not
+    stop a scan. Anything _check_matrix_server did not expect is logged and the probe counts as failed.
+    """
+
+    with tracing.trace('probe', hostname):
+        try:
+            result = _check_matrix_server(hostname)
+        except Exception:
+            logging.getLogger(__name__).exception(f'Probing {hostname} failed unexpectedly')
+            result = probe_result.ProbeResult.failure(hostname.strip(), probe_result.ProbeError.UNEXPECTED)
+        tracing.set_outcome(result.error.value if result.error else 'ok')
+    return(result)
+
+
+def _check_matrix_server(hostname):
+    """Check if and save there is a Synapse or Dendrite server on a url
+
     Check if there is a Synapse or Dendrite server on a url:port. If there is a Synapse/Dendrite there,
     look up IP and version.
 
     Args:
-        hostname: Some URL from Matrix IDs in format sub.domain.com
+        hostname: A hostname, URL or Matrix ID. It is normalized with import_hostnames.normalize_hostname.
     
     Return:
-        A string with delegated hostname, IP, port and resolve type if the hostname is active.
-        Return None if not a Matrix server or server is dead.
+        A ProbeResult with delegated hostname, IP, port, resolve type, name, version and SSL validity if the
+        hostname is active. If not a Matrix server or server is dead, a ProbeResult with only the error set.
     """
     
     # Clean up hostname to exclude errors
-    hostname = hostname.strip()
-    hostname = hostname.replace('http://', '')
-    hostname = hostname.replace('https://', '')
-    if '!' in hostname:
-        hostname = hostname.replace('!', '')
-        _, hostname = hostname.split(':', 1)
-    if '?' in hostname:
-        hostname, _ = hostname.split('?', 1)
-    if '#' in hostname:
-        hostname = hostname.replace('#', '')
+    canonical = import_hostnames.normalize_hostname(hostname)
+    if not canonical:
+        return(probe_result.ProbeResult.failure(hostname.strip(), probe_result.ProbeError.INVALID_HOSTNAME))
 
     # If port is already known
-    port = None
+    hostname, port = import_hostnames.split_host_port(canonical)
     if ':' in hostname:
-        hostname, port = hostname.split(':')
+        hostname = f'[{hostname}]'
 
     # Get delegated stuff
-    delegated_hostname, delegated_port, server_lookup_type = str(resolve_delegated_homeserver(hostname)).split(':')
+    delegated = _cached_lookup(_delegation_cache, hostname, _lookup_delegation)
+    try:
+        delegated_hostname, delegated_port, server_lookup_type = str(delegated).rsplit(':', 2)
+    except ValueError:
+        return(probe_result.ProbeResult.failure(hostname, probe_result.ProbeError.INVALID_DELEGATION))
 
     if port:
         delegated_port = port
+    try:
+        delegated_port = int(delegated_port)
+    except ValueError:
+        return(probe_result.ProbeResult.failure(hostname, probe_result.ProbeError.INVALID_DELEGATION))
 
     # Set a random valid user-agent
-    ua = UserAgent()
-    headers = {'User-Agent': ua.random}
+    headers = random_headers()
 
-    # Set version URL
-    version_url = f'https://{delegated_hostname}:{delegated_port}/_matrix/federation/v1/version'
-    
     # Try to downlad version
-    valid_ssl = True
-    try:
-        version_request = requests.get(version_url, headers=headers, allow_redirects=True, timeout=3)
-    
-    # If ssl error
-    except (requests.exceptions.SSLError, ssl.SSLCertVerificationError, ssl.SSLError):
-        try:
-            version_request = requests.get(version_url, headers=headers, allow_redirects=True, verify=False, timeout=3)
-        except (
-            dns.name.LabelTooLong,
-            NameError,
-            requests.exceptions.ConnectionError,
-            requests.exceptions.ConnectTimeout,
-            requests.exceptions.InvalidURL,
-            requests.exceptions.ReadTimeout,
-            requests.exceptions.TooManyRedirects,
-            socket.timeout,
-            UnicodeError,
-            urllib3.exceptions.ConnectTimeoutError,
-            urllib3.exceptions.MaxRetryError,
-            urllib3.exceptions.NewConnectionError
-        ):
-            pass
-        valid_ssl = False
-    
-    # If connection error
-    except (
-        dns.name.LabelTooLong,
-        NameError,
-        requests.exceptions.ConnectionError,
-        requests.exceptions.ConnectTimeout,
-        requests.exceptions.InvalidURL,
-        requests.exceptions.ReadTimeout,
-        requests.exceptions.SSLError,
-        requests.exceptions.TooManyRedirects,
-        socket.timeout,
-        ssl.SSLCertVerificationError,
-        ssl.SSLError,
-        UnicodeError,
-        urllib3.exceptions.ConnectTimeoutError,
-        urllib3.exceptions.MaxRetryError,
-        urllib3.exceptions.NewConnectionError
-
-    ):
-        return(None)
+    version_request, valid_ssl = fetch_version(delegated_hostname, delegated_port, headers)
+    if version_request is None:
+        return(probe_result.ProbeResult.failure(hostname, probe_result.ProbeError.CONNECTION))
 
     # If not response code 200
-    try:
-        if not version_request.status_code == 200:
-            return(None)
-    except:
-        return(None)
+    if not version_request.status_code == 200:
+        return(probe_result.ProbeResult.failure(hostname, probe_result.ProbeError.HTTP_STATUS))
 
-    
     # Try and decode json
     try:
-        version_json = version_request.json()
+        with tracing.span('parse', 'version'):
+            version_json = version_request.json()
+            name = version_json['server']['name']
+            version = version_json['server']['version']
 
     # If converting to json fails it's probably a bitstream or something
-    except json.decoder.JSONDecodeError:
-        return(None)
-    
-    # Get version data
-    else:
-        name = version_json['server']['name']
-        version = version_json['server']['version']
-    
-    # Get the IP for the Matrix server
-    delegated_ip = socket.gethostbyname(delegated_hostname)
+    except (json.decoder.JSONDecodeError, KeyError, TypeError, AttributeError):
+        return(probe_result.ProbeResult.failure(hostname, probe_result.ProbeError.INVALID_RESPONSE))
     
-    # Create ; separated string and return it
-    out_string = f'{hostname};{delegated_hostname};{delegated_ip};{delegated_port};{server_lookup_type};{name};{version};'
-    if valid_ssl:
-        out_string += 'yes'
-    else:
-        out_string += 'no'
-    return(out_string)
+    # Get every IPv4 and IPv6 address of the Matrix server. The version request usually looked them up already
+    try:
+        if is_ip_literal(delegated_hostname):
+            addresses = (delegated_hostname.strip('[]'),)
+        else:
+            with tracing.span('dns', delegated_hostname):
+                addresses = _cached_lookup(_address_cache, delegated_hostname, resolve_addresses)
+    except (socket.gaierror, UnicodeError):
+        return(probe_result.ProbeResult.failure(hostname, probe_result.ProbeError.CONNECTION))
+
+    # The IP is the address that answered first, then the rest
+    delegated_ip = getattr(version_request, 'connected_address', None) or addresses[0]
+    addresses = (delegated_ip,) + tuple(address for address in addresses if address != delegated_ip)
+
+    return(probe_result.ProbeResult.found(hostname,
+                                          delegated_hostname,
+                                          delegated_ip,
+                                          delegated_port,
+                                          server_lookup_type,
+                                          str(name),
+                                          str(version),
+                                          valid_ssl,
+                                          addresses))
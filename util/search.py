@@ -0,0 +1,67 @@
+## Import other python files
+from . import database
+
+
+## Functions
+
+def fts_query(text):
+    """Turn free text into an FTS5 query
+
+    Every word must match. The last word also matches as a prefix, so partial input finds rooms.
+    Words are quoted, so characters with a meaning in FTS5 syntax are searched for literally.
+
+    Args:
+        text: What the user searched for.
+
+    Returns:
+        An FTS5 MATCH expression. None if text has no words.
+    """
+
+    words = text.split()
+    if not words:
+        return(None)
+    terms = ['"' + word.replace('"', '""') + '"' for word in words]
+    terms[-1] += '*'
+    return(' '.join(terms))
+
+
+def search_rooms(db_file_path, text, limit=10):
+    """Search public rooms by name, topic and aliases
+
+    Uses the rooms_fts full-text index when the database has one, and a LIKE scan otherwise.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        text: What to search for.
+        limit: How many rooms to return. Default 10
+
+    Returns:
+        List of (room_id, name, canonical_alias, num_joined_members, topic), most joined members first.
+    """
+
+    conn = database.connect(db_file_path)
+
+    if database.has_table(conn, 'rooms_fts'):
+        query = fts_query(text)
+        if not query:
+            return([])
+        return(conn.execute('''
+            SELECT rooms.room_id, rooms.name, rooms.canonical_alias, rooms.num_joined_members, rooms.topic
+            FROM rooms_fts
+            JOIN rooms ON rooms.id = rooms_fts.rowid
+            WHERE rooms_fts MATCH ?
+            ORDER BY rooms.num_joined_members DESC
+            LIMIT ?
+        ''', (query, limit)).fetchall())
+
+    pattern = f'%{text.strip()}%'
+    return(conn.execute('''
+        SELECT rooms.room_id, rooms.name, rooms.canonical_alias, rooms.num_joined_members, rooms.topic
+        FROM rooms
+        WHERE rooms.name LIKE ?
+        OR rooms.topic LIKE ?
+        OR rooms.canonical_alias LIKE ?
+        OR rooms.id IN (SELECT room_id FROM room_aliases WHERE alias LIKE ?)
+        ORDER BY rooms.num_joined_members DESC
+        LIMIT ?
+    ''', (pattern, pattern, pattern, pattern, limit)).fetchall())
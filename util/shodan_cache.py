@@ -0,0 +1,392 @@
+## Import modules
+import array
+import json
+import math
+import mmap
+import os
+import socket
+import struct
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+
+## Settings
+
+# Cache file layout, all in native byte order:
+#   header      magic, format version, source size, source mtime in ns, record count
+#   ips         count * 16 bytes. IPv4 addresses are stored IPv4-mapped (::ffff:a.b.c.d)
+#   latitudes   count * float32. NaN if Shodan had no location
+#   longitudes  count * float32. NaN if Shodan had no location
+CACHE_MAGIC = b'MXSC'
+CACHE_VERSION = 1
+HEADER = struct.Struct('=4sIQqQ')
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+# Every TCP banner contains one of these. Lines without them are skipped without being decoded
+TCP_MARKERS = (b'"transport": "tcp"', b'"transport":"tcp"')
+
+# Split the export into this many byte ranges per process, so fast workers pick up the slack of slow ones
+RANGES_PER_PROCESS = 4
+
+
+## Classes
+
+class ShodanCache:
+    """Memory-mapped compact cache of the TCP records in a Shodan export
+
+    Args:
+        cache_path: Full path to a cache file made by build_cache.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self._file = open(cache_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.source_size, self.source_mtime_ns, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            self.close()
+            raise ValueError(f'{cache_path} is not a Shodan cache file')
+
+        self._view = view = memoryview(self._map)
+        ips_start = HEADER.size
+        latitudes_start = ips_start + self.count * 16
+        longitudes_start = latitudes_start + self.count * 4
+        self._ips = view[ips_start:latitudes_start]
+        self._latitudes = view[latitudes_start:longitudes_start].cast('f')
+        self._longitudes = view[longitudes_start:longitudes_start + self.count * 4].cast('f')
+
+
+    def __len__(self):
+        return(self.count)
+
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.record(index)
+
+
+    def __enter__(self):
+        return(self)
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def ip(self, index):
+        """Get the IP address of a record as a string"""
+
+        return(unpack_ip(self._ips[index * 16:(index + 1) * 16]))
+
+
+    def record(self, index):
+        """Get a record
+
+        Args:
+            index: Record number.
+
+        Returns:
+            A tuple of (ip, latitude, longitude). Latitude and longitude are None if Shodan had no location.
+        """
+
+        latitude = self._latitudes[index]
+        longitude = self._longitudes[index]
+        if math.isnan(latitude) or math.isnan(longitude):
+            latitude = longitude = None
+        return((self.ip(index), latitude, longitude))
+
+
+    def ips(self):
+        """Get all IP addresses as a list of strings"""
+
+        return([self.ip(index) for index in range(self.count)])
+
+
+    def locate(self, ips):
+        """Find where IP addresses are, in one pass over the records
+
+        Args:
+            ips: Iterable of IP address strings. IPv6 addresses may be in brackets.
+
+        Returns:
+            A dict of IP address, as given, to (latitude, longitude). Addresses Shodan has no location for are left out.
+        """
+
+        wanted = {}
+        for ip in ips:
+            packed = pack_ip(ip.strip('[]'))
+            if packed:
+                wanted.setdefault(packed, []).append(ip)
+
+        locations = {}
+        for index in range(self.count if wanted else 0):
+            found = wanted.get(self._ips[index * 16:(index + 1) * 16].tobytes())
+            if found is None:
+                continue
+            latitude = self._latitudes[index]
+            longitude = self._longitudes[index]
+            if math.isnan(latitude) or math.isnan(longitude):
+                continue
+            for ip in found:
+                locations[ip] = (latitude, longitude)
+        return(locations)
+
+
+    def close(self):
+        """Release the memory map and close the file"""
+
+        for view in ('_ips', '_latitudes', '_longitudes', '_view'):
+            if hasattr(self, view):
+                getattr(self, view).release()
+        self._map.close()
+        self._file.close()
+
+
+## Functions
+
+def pack_ip(ip):
+    """Pack an IPv4 or IPv6 address into 16 bytes
+
+    Args:
+        ip: An IP address string.
+
+    Returns:
+        16 bytes. Or None if ip is not a valid address.
+    """
+
+    try:
+        return(IPV4_MAPPED_PREFIX + socket.inet_pton(socket.AF_INET, ip))
+    except OSError:
+        pass
+    try:
+        return(socket.inet_pton(socket.AF_INET6, ip))
+    except OSError:
+        return(None)
+
+
+def unpack_ip(packed):
+    """Turn 16 bytes made by pack_ip back into an IP address string"""
+
+    packed = bytes(packed)
+    if packed[:12] == IPV4_MAPPED_PREFIX:
+        return(socket.inet_ntop(socket.AF_INET, packed[12:]))
+    return(socket.inet_ntop(socket.AF_INET6, packed))
+
+
+def split_ranges(file_path, count):
+    """Split a file into byte ranges that start and end on line boundaries
+
+    Args:
+        file_path: Full path to a file.
+        count: How many ranges to aim for.
+
+    Returns:
+        A list of (start, end) byte offsets. Fewer than count if the file has few lines.
+    """
+
+    size = os.path.getsize(file_path)
+    boundaries = [0]
+    with open(file_path, 'rb') as f:
+        for i in range(1, count):
+            offset = size * i // count
+            if offset <= boundaries[-1]:
+                continue
+            f.seek(offset - 1)
+            f.readline()
+            boundary = f.tell()
+            if boundary >= size:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(size)
+
+    return([(boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1) if boundaries[i] < boundaries[i + 1]])
+
+
+def parse_range(file_path, start, end):
+    """Parse the TCP records in a byte range of a Shodan export
+
+    Runs in a worker process, so results are returned packed rather than as Python objects.
+
+    Args:
+        file_path: Full path to a Shodan data export json file.
+        start: Byte offset of the first line. Must be at the start of a line.
+        end: Byte offset where the range ends. Must be at the start of a line or the end of the file.
+
+    Returns:
+        A tuple of (ips, latitudes, longitudes) bytes. ips is 16 bytes per record,
+        latitudes and longitudes are float32 arrays with NaN where Shodan had no location.
+    """
+
+    ips = bytearray()
+    latitudes = array.array('f')
+    longitudes = array.array('f')
+
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+
+            # Cheap check before paying for a full decode
+            if not (TCP_MARKERS[0] in line or TCP_MARKERS[1] in line):
+                continue
+
+            try:
+                data = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            if data.get('transport') != 'tcp':
+                continue
+
+            packed = pack_ip(str(data.get('ip_str', '')).strip())
+            if not packed:
+                continue
+
+            # Skip records with a location that is not a number, like bad json above
+            try:
+                location = data.get('location') or {}
+                latitude = location.get('latitude')
+                longitude = location.get('longitude')
+                latitude = float(latitude) if latitude is not None else math.nan
+                longitude = float(longitude) if longitude is not None else math.nan
+            except (TypeError, ValueError, AttributeError):
+                continue
+
+            ips += packed
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+
+    return((bytes(ips), latitudes.tobytes(), longitudes.tobytes()))
+
+
+def parse_export(file_path, processes=None):
+    """Parse a Shodan export across multiple processes
+
+    Args:
+        file_path: Full path to a Shodan data export json file.
+        processes: How many processes to use. Default one per CPU core
+
+    Yields:
+        Packed (ips, latitudes, longitudes) batches as returned by parse_range, in file order.
+    """
+
+    if not processes:
+        processes = os.cpu_count() or 1
+
+    ranges = split_ranges(file_path, processes * RANGES_PER_PROCESS)
+    if processes == 1 or len(ranges) < 2:
+        for start, end in ranges:
+            yield(parse_range(file_path, start, end))
+        return
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(parse_range, file_path, start, end) for start, end in ranges]
+        for future in futures:
+            yield(future.result())
+
+
+def cache_path_for(file_path):
+    """Get the default cache file path for a Shodan export"""
+
+    return(f'{file_path}.cache')
+
+
+def build_cache(file_path, cache_path=None, processes=None):
+    """Convert a Shodan export to a compact cache file
+
+    The export is parsed in parallel by parse_export. The cache is written to a temporary file of its own first
+    and then moved in place, so readers never see a half written cache and concurrent builders can not collide.
+
+    Args:
+        file_path: Full path to a Shodan data export json file.
+        cache_path: Where to write the cache. Default the export path plus .cache
+        processes: How many processes to parse with. Default one per CPU core
+
+    Returns:
+        Full path to the cache file.
+    """
+
+    if not cache_path:
+        cache_path = cache_path_for(file_path)
+
+    source = os.stat(file_path)
+    ips = bytearray()
+    latitudes = bytearray()
+    longitudes = bytearray()
+
+    for batch_ips, batch_latitudes, batch_longitudes in parse_export(file_path, processes):
+        ips += batch_ips
+        latitudes += batch_latitudes
+        longitudes += batch_longitudes
+
+    # Each builder gets its own temporary file, so processes building the same cache at once do not clobber each other
+    descriptor, temp_path = tempfile.mkstemp(prefix=f'{os.path.basename(cache_path)}.', suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(cache_path)))
+    try:
+        os.fchmod(descriptor, 0o644)
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, source.st_size, source.st_mtime_ns, len(ips) // 16))
+            f.write(ips)
+            f.write(latitudes)
+            f.write(longitudes)
+        os.replace(temp_path, cache_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return(cache_path)
+
+
+def cache_is_fresh(file_path, cache_path):
+    """Check if a cache file was built from the current version of a Shodan export
+
+    Args:
+        file_path: Full path to a Shodan data export json file.
+        cache_path: Full path to the cache file.
+
+    Returns:
+        True if the cache exists and matches the size and mtime of the export.
+    """
+
+    try:
+        source = os.stat(file_path)
+        with open(cache_path, 'rb') as f:
+            header = f.read(HEADER.size)
+        magic, version, size, mtime_ns, _ = HEADER.unpack(header)
+    except (OSError, struct.error):
+        return(False)
+
+    return(
+        magic == CACHE_MAGIC
+        and version == CACHE_VERSION
+        and size == source.st_size
+        and mtime_ns == source.st_mtime_ns
+    )
+
+
+def open_cache(file_path, cache_path=None, processes=None):
+    """Open the cache for a Shodan export, building it first if missing or stale
+
+    Args:
+        file_path: Full path to a Shodan data export json file.
+        cache_path: Full path to the cache file. Default the export path plus .cache
+        processes: How many processes to parse the export with if the cache must be built. Default one per CPU core
+
+    Returns:
+        A ShodanCache. Or None if the export does not exist.
+    """
+
+    if not os.path.isfile(file_path):
+        return(None)
+    if not cache_path:
+        cache_path = cache_path_for(file_path)
+
+    if not cache_is_fresh(file_path, cache_path):
+        build_cache(file_path, cache_path, processes)
+
+    return(ShodanCache(cache_path))
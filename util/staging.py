@@ -0,0 +1,157 @@
+## Import modules
+import os
+import random
+import sqlite3
+import tempfile
+
+## Import other python files
+from . import import_hostnames
+
+
+## Settings
+
+# How many hostnames to insert per transaction while loading
+INSERT_BATCH = 10000
+
+# Page cache of the staging database in KiB. Bounds its memory no matter how many hostnames it holds
+CACHE_KIB = 16000
+
+
+## Classes
+
+class HostnameStaging:
+    """Deduplicate hostnames and put them in random order on disk
+
+    Hostnames are normalized with import_hostnames.normalize_hostname, so spellings of the same server collapse
+    into one, and loaded into a throwaway SQLite database keyed by hostname, each with a random sort key.
+    Reading them back in sort key order gives a shuffled, duplicate free stream, and only one batch is held
+    in memory at a time. The database file is removed on close.
+
+    Args:
+        directory: Where to put the staging database. Default the system temporary directory
+    """
+
+    def __init__(self, directory=None):
+        handle, self.path = tempfile.mkstemp(prefix='.staging-', suffix='.db', dir=directory)
+        os.close(handle)
+
+        # Nothing here needs to survive a crash, so skip the journal and fsyncs
+        self._conn = sqlite3.connect(self.path, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode = OFF')
+        self._conn.execute('PRAGMA synchronous = OFF')
+        self._conn.execute('PRAGMA temp_store = FILE')
+        self._conn.execute(f'PRAGMA cache_size = -{CACHE_KIB}')
+        self._conn.execute('''
+            CREATE TABLE hostnames (
+                hostname    TEXT PRIMARY KEY,
+                sort_key    INTEGER
+            ) WITHOUT ROWID
+        ''')
+        # Every distinct input as given, to count how many probes normalizing saved
+        self._conn.execute('CREATE TABLE inputs (hostname TEXT PRIMARY KEY) WITHOUT ROWID')
+        self._indexed = False
+
+
+    def __len__(self):
+        return(self._conn.execute('SELECT count(*) FROM hostnames').fetchone()[0])
+
+
+    def __enter__(self):
+        return(self)
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def add(self, hostnames):
+        """Add hostnames, skipping invalid ones and ones already added
+
+        Args:
+            hostnames: Any iterable of hostnames, including generators. It is consumed INSERT_BATCH at a time.
+
+        Returns:
+            How many hostnames were new after normalizing.
+        """
+
+        if self._indexed:
+            raise RuntimeError('Can not add hostnames after reading has started')
+
+        added = 0
+        inputs = []
+        batch = []
+        for hostname in hostnames:
+            hostname = str(hostname).strip()
+            if not hostname:
+                continue
+            inputs.append((hostname,))
+            canonical = import_hostnames.normalize_hostname(hostname)
+            if canonical:
+                batch.append((canonical, random.getrandbits(62)))
+            if len(inputs) >= INSERT_BATCH:
+                added += self._insert(inputs, batch)
+                inputs = []
+                batch = []
+        if inputs:
+            added += self._insert(inputs, batch)
+        return(added)
+
+
+    def _insert(self, inputs, batch):
+        self._conn.execute('BEGIN')
+        self._conn.executemany('INSERT OR IGNORE INTO inputs (hostname) VALUES (?)', inputs)
+        before = self._conn.total_changes
+        self._conn.executemany('INSERT OR IGNORE INTO hostnames (hostname, sort_key) VALUES (?, ?)', batch)
+        added = self._conn.total_changes - before
+        self._conn.execute('COMMIT')
+        return(added)
+
+
+    def probes_saved(self):
+        """Count how many probes normalizing saved
+
+        Returns:
+            Distinct inputs, as they would have been probed without normalizing, minus distinct canonical hostnames.
+        """
+
+        inputs = self._conn.execute('SELECT count(*) FROM inputs').fetchone()[0]
+        return(inputs - len(self))
+
+
+    def batches(self, size):
+        """Read the hostnames back in random order
+
+        Args:
+            size: How many hostnames per batch.
+
+        Yields:
+            Lists of up to size hostnames.
+        """
+
+        # Indexing once after loading is much faster than keeping the index up to date while inserting
+        if not self._indexed:
+            self._conn.execute('CREATE INDEX hostnames_sort_key ON hostnames (sort_key, hostname)')
+            self._indexed = True
+
+        after = (-1, '')
+        while True:
+            rows = self._conn.execute('''
+                SELECT sort_key, hostname FROM hostnames
+                WHERE (sort_key, hostname) > (?, ?)
+                ORDER BY sort_key, hostname
+                LIMIT ?
+            ''', (after[0], after[1], size)).fetchall()
+            if not rows:
+                return
+            after = rows[-1]
+            yield([row[1] for row in rows])
+
+
+    def close(self):
+        """Close and remove the staging database"""
+
+        self._conn.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,181 @@
+## Import other python files
+from . import database
+
+
+## Settings
+
+# delegated_data columns with host counts in stats_counts
+DIMENSIONS = ('name', 'version', 'server_lookup_type', 'valid_ssl')
+
+
+## Functions
+
+def _check_dimension(dimension):
+    if dimension not in DIMENSIONS:
+        raise ValueError(f'Unknown dimension {dimension}. Must be one of {", ".join(DIMENSIONS)}')
+
+
+def query_counts(conn, dimension, limit=None):
+    """Get the number of hosts per value of a dimension, like get_counts, on an open connection
+
+    Args:
+        conn: A connection from database.connect() or database.connect_readonly().
+        dimension: One of DIMENSIONS.
+        limit: Only return this many of the most common values. Default all
+    """
+
+    _check_dimension(dimension)
+    query = '''
+        SELECT value, hosts FROM stats_counts
+        WHERE dimension = ? AND hosts > 0
+        ORDER BY hosts DESC, value
+    '''
+    parameters = [dimension]
+    if limit:
+        query += ' LIMIT ?'
+        parameters.append(limit)
+    return(conn.execute(query, parameters).fetchall())
+
+
+def query_total_hosts(conn):
+    """Get the number of hosts, like get_total_hosts, on an open connection"""
+
+    row = conn.execute('''
+        SELECT coalesce(sum(hosts), 0) FROM stats_counts
+        WHERE dimension = 'name'
+    ''').fetchone()
+    return(row[0])
+
+
+def query_valid_ssl_share(conn):
+    """Get the share of hosts with a valid SSL certificate, like get_valid_ssl_share, on an open connection"""
+
+    counts = dict(query_counts(conn, 'valid_ssl'))
+    total = sum(counts.values())
+    if not total:
+        return(None)
+    return(counts.get('yes', 0) / total)
+
+
+def query_room_counts(conn, limit=None):
+    """Get the number of public rooms per host, like get_room_counts, on an open connection"""
+
+    query = '''
+        SELECT delegated_data.hostname, room_counts.rooms FROM room_counts
+        JOIN delegated_data ON delegated_data.id = room_counts.host_id
+        WHERE room_counts.rooms > 0
+        ORDER BY room_counts.rooms DESC
+    '''
+    parameters = []
+    if limit:
+        query += ' LIMIT ?'
+        parameters.append(limit)
+    return(conn.execute(query, parameters).fetchall())
+
+
+def get_counts(db_file_path, dimension, limit=None):
+    """Get the number of hosts per value of a dimension
+
+    Reads the stats_counts summary table, which triggers keep up to date, so this does not scan delegated_data.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        dimension: One of DIMENSIONS.
+        limit: Only return this many of the most common values. Default all
+
+    Returns:
+        List of (value, number of hosts), most common first. Missing values are counted as an empty string.
+    """
+
+    return(query_counts(database.connect(db_file_path), dimension, limit))
+
+
+def get_total_hosts(db_file_path):
+    """Get the number of hosts in delegated_data, from the summary table"""
+
+    return(query_total_hosts(database.connect(db_file_path)))
+
+
+def get_valid_ssl_share(db_file_path):
+    """Get the share of hosts with a valid SSL certificate
+
+    Returns:
+        A number between 0 and 1. None if there are no hosts.
+    """
+
+    return(query_valid_ssl_share(database.connect(db_file_path)))
+
+
+def get_room_counts(db_file_path, limit=None):
+    """Get the number of public rooms per host
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        limit: Only return this many of the hosts with most rooms. Default all
+
+    Returns:
+        List of (hostname, number of rooms), most rooms first.
+    """
+
+    return(query_room_counts(database.connect(db_file_path), limit))
+
+
+def _fresh_counts(conn):
+    """Count everything from scratch, the slow way"""
+
+    counts = {}
+    for dimension in DIMENSIONS:
+        for value, hosts in conn.execute(f'''
+            SELECT coalesce({dimension}, ''), count(*) FROM delegated_data
+            GROUP BY coalesce({dimension}, '')
+        '''):
+            counts[(dimension, value)] = hosts
+    rooms = dict(conn.execute('SELECT host_id, count(*) FROM room_servers GROUP BY host_id').fetchall())
+    return((counts, rooms))
+
+
+def check_stats(db_file_path):
+    """Compare the summary tables with a full count
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+
+    Returns:
+        List of (table, key, stored count, actual count) for every count that is wrong. Empty if all are right.
+    """
+
+    conn = database.connect(db_file_path)
+    counts, rooms = _fresh_counts(conn)
+    stored_counts = {(dimension, value): hosts for dimension, value, hosts in conn.execute(
+        'SELECT dimension, value, hosts FROM stats_counts'
+    )}
+    stored_rooms = dict(conn.execute('SELECT host_id, rooms FROM room_counts').fetchall())
+
+    wrong = []
+    for key in set(counts) | set(stored_counts):
+        if counts.get(key, 0) != stored_counts.get(key, 0):
+            wrong.append(('stats_counts', key, stored_counts.get(key, 0), counts.get(key, 0)))
+    for key in set(rooms) | set(stored_rooms):
+        if rooms.get(key, 0) != stored_rooms.get(key, 0):
+            wrong.append(('room_counts', key, stored_rooms.get(key, 0), rooms.get(key, 0)))
+    return(wrong)
+
+
+def rebuild_stats(db_file_path):
+    """Rebuild the summary tables from a full count
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+    """
+
+    conn = database.connect(db_file_path)
+    with database.transaction(conn):
+        counts, rooms = _fresh_counts(conn)
+        conn.execute('DELETE FROM stats_counts')
+        conn.execute('DELETE FROM room_counts')
+        conn.executemany('''
+            INSERT INTO stats_counts (dimension, value, hosts) VALUES (?, ?, ?)
+        ''', ((dimension, value, hosts) for (dimension, value), hosts in counts.items()))
+        conn.executemany('''
+            INSERT INTO room_counts (host_id, rooms) VALUES (?, ?)
+        ''', rooms.items())
@@ -0,0 +1,285 @@
+## Import modules
+import collections
+import contextlib
+import functools
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+
+
+## Settings
+
+# Open trace log. None while tracing is off, which makes every tracing call return at once
+_log = None
+_log_lock = threading.Lock()
+_current = threading.local()
+
+
+## Classes
+
+class Trace:
+    """Spans recorded while probing or crawling one host
+
+    Args:
+        kind: What was done, probe or rooms.
+        host: The hostname.
+    """
+
+    __slots__ = ('kind', 'host', 'started', 'wall_started', 'outcome', 'spans')
+
+    def __init__(self, kind, host):
+        self.kind = kind
+        self.host = host
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.outcome = None
+        self.spans = []
+
+
+    def add(self, name, started, seconds, detail=None):
+        self.spans.append([name, round(started - self.started, 6), round(seconds, 6), detail])
+
+
+class SamplingProfiler:
+    """Sample the stacks of all threads at an interval and write them as collapsed stacks
+
+    The output has one line per distinct stack, frames separated by semicolons and followed by how often the stack
+    was seen. flamegraph.pl, speedscope and inferno read it as is.
+
+    Args:
+        path: File to write the collapsed stacks to when stopped.
+        interval: Seconds between samples. Default 0.005
+    """
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self._stacks = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+
+    def __enter__(self):
+        self.start()
+        return(self)
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def start(self):
+        self._thread.start()
+
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stopped.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, 'thread').rstrip('0123456789_-'))
+                self._stacks[';'.join(reversed(frames))] += 1
+
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks"""
+
+        self._stopped.set()
+        self._thread.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+## Functions
+
+def enable(path):
+    """Start writing traces to a file. Traces are appended to what it already holds
+
+    Args:
+        path: Full path to the trace log.
+    """
+
+    global _log
+
+    with _log_lock:
+        if _log:
+            _log.close()
+        _log = open(path, 'a', buffering=1)
+
+
+def disable():
+    """Stop writing traces"""
+
+    global _log
+
+    with _log_lock:
+        if _log:
+            _log.close()
+        _log = None
+
+
+@contextlib.contextmanager
+def trace(kind, host):
+    """Trace everything done for one host in this thread, and append it to the log when done
+
+    Does nothing unless enable was called.
+
+    Args:
+        kind: What is done, probe or rooms.
+        host: The hostname.
+    """
+
+    if _log is None:
+        yield
+        return
+
+    outer = getattr(_current, 'trace', None)
+    current = _current.trace = Trace(kind, host)
+    try:
+        yield
+    finally:
+        _current.trace = outer
+        line = json.dumps({
+            'kind': current.kind,
+            'host': current.host,
+            'at': round(current.wall_started, 3),
+            'seconds': round(time.perf_counter() - current.started, 6),
+            'outcome': current.outcome,
+            'spans': current.spans,
+        }, separators=(',', ':'))
+        with _log_lock:
+            if _log:
+                _log.write(line + '\n')
+
+
+@contextlib.contextmanager
+def span(name, detail=None):
+    """Time a block as a span of the current trace
+
+    Args:
+        name: Phase name, like dns, connect, tls, request or parse.
+        detail: Anything that helps telling spans apart, like the address connected to. Default None
+    """
+
+    current = getattr(_current, 'trace', None)
+    if current is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as error:
+        error_name = type(error).__name__
+        current.add(name, started, time.perf_counter() - started, f'{detail} {error_name}' if detail else error_name)
+        raise
+    current.add(name, started, time.perf_counter() - started, detail)
+
+
+def add_span(name, started, seconds, detail=None):
+    """Add a span that was timed elsewhere to the current trace
+
+    Args:
+        name: Phase name.
+        started: When the span started, from time.perf_counter.
+        seconds: How long it took.
+        detail: Default None
+    """
+
+    current = getattr(_current, 'trace', None)
+    if current is not None:
+        current.add(name, started, seconds, detail)
+
+
+def set_outcome(outcome):
+    """Record how the current trace ended, like ok or an error name"""
+
+    current = getattr(_current, 'trace', None)
+    if current is not None:
+        current.outcome = outcome
+
+
+def bind(function):
+    """Make function record its spans in the current trace when it runs in another thread"""
+
+    current = getattr(_current, 'trace', None)
+    if current is None:
+        return(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        outer = getattr(_current, 'trace', None)
+        _current.trace = current
+        try:
+            return(function(*args, **kwargs))
+        finally:
+            _current.trace = outer
+    return(wrapper)
+
+
+def read_traces(path, kind=None):
+    """Read a trace log
+
+    Args:
+        path: Full path to the trace log.
+        kind: Only read traces of this kind. Default all
+
+    Yields:
+        Trace dicts as written by trace. Lines cut off by a crash are skipped.
+    """
+
+    with open(path) as f:
+        for line in f:
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if kind is None or data.get('kind') == kind:
+                yield(data)
+
+
+def slowest(path, limit=20, kind=None):
+    """Find the slowest traces in a log
+
+    Args:
+        path: Full path to the trace log.
+        limit: How many traces to return. Default 20
+        kind: Only look at traces of this kind. Default all
+
+    Returns:
+        List of trace dicts, slowest first.
+    """
+
+    return(heapq.nlargest(limit, read_traces(path, kind), key=lambda data: data['seconds']))
+
+
+def phase_totals(path, kind=None):
+    """Add up the time spent in each phase over a log
+
+    Args:
+        path: Full path to the trace log.
+        kind: Only look at traces of this kind. Default all
+
+    Returns:
+        List of (phase, spans, total seconds, slowest span seconds), most total time first.
+    """
+
+    totals = {}
+    for data in read_traces(path, kind):
+        for name, _, seconds, _ in data['spans']:
+            count, total, longest = totals.get(name, (0, 0, 0))
+            totals[name] = (count + 1, total + seconds, max(longest, seconds))
+    return(sorted(((name,) + values for name, values in totals.items()), key=lambda row: row[2], reverse=True))
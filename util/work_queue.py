@@ -0,0 +1,274 @@
+## Import modules
+import itertools
+import os
+import time
+import uuid
+
+## Import other python files
+from . import database
+from . import import_hostnames
+
+
+## Settings
+
+# work_queue holds hostnames to probe, room_queue holds hostnames from delegated_data whose public rooms to crawl
+QUEUES = ('work_queue', 'room_queue')
+
+# enqueue writes this many hostnames per transaction, so a large source never holds the write lock for long
+ENQUEUE_CHUNK_SIZE = 10000
+
+
+## Functions
+
+def _check_queue(queue):
+    if queue not in QUEUES:
+        raise ValueError(f'Unknown queue {queue}')
+
+
+def enqueue(db_file_path, hostnames, source, queue='work_queue'):
+    """Add hostnames to a work queue
+
+    Hostnames already in the queue are left alone. New hostnames are due right away. Hostnames for work_queue
+    are normalized with import_hostnames.normalize_hostname first, and invalid ones are skipped. room_queue
+    hostnames must match delegated_data, so they are added as given. Hostnames are normalized outside the write
+    lock and written ENQUEUE_CHUNK_SIZE at a time, so other writers get their turn in between.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        hostnames: Iterable of hostnames.
+        source: Where the hostnames came from. For example file, shodan or postgres.
+        queue: Which queue to add to. Default work_queue
+
+    Returns:
+        How many hostnames were new.
+    """
+
+    _check_queue(queue)
+    if queue == 'work_queue':
+        hostnames = (import_hostnames.normalize_hostname(hostname) for hostname in hostnames)
+    hostnames = iter(hostnames)
+    now = time.time()
+    conn = database.connect(db_file_path)
+    added = 0
+    while True:
+        chunk = list(itertools.islice(hostnames, ENQUEUE_CHUNK_SIZE))
+        if not chunk:
+            return(added)
+        with database.transaction(conn):
+            before = conn.total_changes
+            conn.executemany(f'''
+                INSERT OR IGNORE INTO {queue}
+                (hostname, source, added_at, next_scan_at)
+                VALUES (?, ?, ?, 0)
+            ''', ((hostname, source, now) for hostname in chunk if hostname))
+            added += conn.total_changes - before
+
+
+def enqueue_known_hosts(db_file_path):
+    """Add every host in delegated_data to the room crawl queue
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+
+    Returns:
+        How many hostnames were new.
+    """
+
+    conn = database.connect(db_file_path)
+    hostnames = [row[0] for row in conn.execute('SELECT hostname FROM delegated_data')]
+    return(enqueue(db_file_path, hostnames, 'delegated_data', 'room_queue'))
+
+
+def take_due(db_file_path, limit, queue='work_queue'):
+    """Get hostnames that are due to be scanned and not leased to a node
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        limit: Maximum number of hostnames to return.
+        queue: Which queue to take from. Default work_queue
+
+    Returns:
+        List of hostnames, the longest overdue first.
+    """
+
+    _check_queue(queue)
+    now = time.time()
+    conn = database.connect(db_file_path)
+    hostnames = [row[0] for row in conn.execute(f'''
+        SELECT hostname FROM {queue}
+        WHERE next_scan_at <= ?
+        AND (lease_expires IS NULL OR lease_expires < ?)
+        ORDER BY next_scan_at
+        LIMIT ?
+    ''', (now, now, limit))]
+    return(hostnames)
+
+
+def lease(db_file_path, limit, owner, duration, queue='work_queue'):
+    """Lease a batch of due hostnames to a scanner node
+
+    Leased hostnames are not handed out again until the lease expires, so no hostname is probed twice
+    in a cycle unless the node holding it dies.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        limit: Maximum number of hostnames to lease.
+        owner: Name of the node taking the lease. Only used for logging.
+        duration: Seconds until the lease expires and the hostnames can be handed out again.
+        queue: Which queue to lease from. Default work_queue
+
+    Returns:
+        A tuple of (lease id, list of hostnames, expiry timestamp). Lease id is None if nothing is due.
+    """
+
+    _check_queue(queue)
+    now = time.time()
+    lease_id = f'{owner}:{uuid.uuid4().hex}'
+    expires = now + duration
+
+    conn = database.connect(db_file_path)
+
+    # The transaction takes the write lock before selecting, so two coordinators can not lease the same hostnames
+    with database.transaction(conn):
+        hostnames = [row[0] for row in conn.execute(f'''
+            SELECT hostname FROM {queue}
+            WHERE next_scan_at <= ?
+            AND (lease_expires IS NULL OR lease_expires < ?)
+            ORDER BY next_scan_at
+            LIMIT ?
+        ''', (now, now, limit))]
+        conn.executemany(f'''
+            UPDATE {queue}
+            SET lease_id = ?, lease_expires = ?
+            WHERE hostname = ?
+        ''', ((lease_id, expires, hostname) for hostname in hostnames))
+
+    if not hostnames:
+        return((None, [], None))
+    return((lease_id, hostnames, expires))
+
+
+def leased_hostnames(db_file_path, lease_id, queue='work_queue'):
+    """Get the hostnames still held by a lease
+
+    A lease loses a hostname when the lease expires and the hostname is handed to another node.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        lease_id: Lease id from lease().
+        queue: Which queue the lease is from. Default work_queue
+
+    Returns:
+        A set of hostnames.
+    """
+
+    _check_queue(queue)
+    conn = database.connect(db_file_path)
+    hostnames = {row[0] for row in conn.execute(f'''
+        SELECT hostname FROM {queue}
+        WHERE lease_id = ?
+    ''', (lease_id,))}
+    return(hostnames)
+
+
+def reschedule(db_file_path, succeeded, failed, rescan_interval, retry_interval, queue='work_queue'):
+    """Schedule the next scan for hostnames that were just scanned, and release their leases
+
+    Hostnames that answered are scanned again after rescan_interval. Hostnames that did not answer
+    back off by retry_interval for every failed attempt in a row, up to rescan_interval.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        succeeded: Iterable of hostnames that answered.
+        failed: Iterable of hostnames that did not answer.
+        rescan_interval: Seconds until a live server is scanned again.
+        retry_interval: Seconds added to the wait for every failed attempt in a row.
+        queue: Which queue the hostnames are in. Default work_queue
+    """
+
+    _check_queue(queue)
+    now = time.time()
+    conn = database.connect(db_file_path)
+    with database.transaction(conn):
+        conn.executemany(f'''
+            UPDATE {queue}
+            SET last_scanned_at = ?, next_scan_at = ?, attempts = 0, lease_id = NULL, lease_expires = NULL
+            WHERE hostname = ?
+        ''', ((now, now + rescan_interval, hostname) for hostname in succeeded))
+        conn.executemany(f'''
+            UPDATE {queue}
+            SET last_scanned_at = ?, next_scan_at = ? + MIN(?, ? * (attempts + 1)), attempts = attempts + 1,
+                lease_id = NULL, lease_expires = NULL
+            WHERE hostname = ?
+        ''', ((now, now, rescan_interval, retry_interval, hostname) for hostname in failed))
+
+
+def queue_length(db_file_path, queue='work_queue'):
+    """Count hostnames in a work queue
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        queue: Which queue to count. Default work_queue
+
+    Returns:
+        A tuple of (total hostnames, hostnames due now).
+    """
+
+    _check_queue(queue)
+    conn = database.connect(db_file_path)
+    total, due = conn.execute(f'''
+        SELECT count(*), coalesce(sum(next_scan_at <= ?), 0) FROM {queue}
+    ''', (time.time(),)).fetchone()
+    return((total, due))
+
+
+def file_changed(file_path, seen_mtimes):
+    """Check if a file changed since it was last seen
+
+    Args:
+        file_path: Full path to a file.
+        seen_mtimes: Dict of file path to the mtime it had when last seen. Updated in place.
+
+    Returns:
+        True if the file exists and is new or changed.
+    """
+
+    try:
+        mtime = os.stat(file_path).st_mtime_ns
+    except OSError:
+        return(False)
+
+    if seen_mtimes.get(file_path) == mtime:
+        return(False)
+    seen_mtimes[file_path] = mtime
+    return(True)
+
+
+def feed_queue(db_file_path, hostnames_file_path, shodan_file_path, psql_settings, parse_processes, seen_mtimes):
+    """Add hostnames from all sources to the work queue
+
+    The file and Shodan sources are only read again when they change. PostgreSQL is queried every time.
+
+    Args:
+        db_file_path: Full path to SQLite3 database file.
+        hostnames_file_path: Full path to the hostnames file.
+        shodan_file_path: Full path to the Shodan export.
+        psql_settings: Tuple of PostgreSQL server, port, database, username, password and limit. None if disabled
+        parse_processes: How many processes to parse a new Shodan export with.
+        seen_mtimes: Dict of file path to the mtime it had when last read. Updated in place.
+    """
+
+    if file_changed(hostnames_file_path, seen_mtimes):
+        hostnames = import_hostnames.load_hostnames_file(hostnames_file_path)
+        if hostnames:
+            print(f'Queued {enqueue(db_file_path, hostnames, "file")} new hostnames from file')
+
+    if file_changed(shodan_file_path, seen_mtimes):
+        hostnames = import_hostnames.load_shodan_file(shodan_file_path, parse_processes)
+        if hostnames:
+            print(f'Queued {enqueue(db_file_path, hostnames, "shodan")} new hostnames from Shodan')
+
+    if psql_settings:
+        hostnames = import_hostnames.get_hostnames_from_postgres(*psql_settings, interactive=False)
+        if hostnames:
+            print(f'Queued {enqueue(db_file_path, hostnames, "postgres")} new hostnames from PostgreSQL')